@@ -1,13 +1,35 @@
 import os
+import re
 import subprocess as sp
 import logging
 import json
 import argparse
 import datetime
+import time
+import threading
+import collections
+import copy
+import mimetypes
 import boto3
 import platform
-from boto3.dynamodb.conditions import Key
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+from AWSIoTPythonSDK.core.protocol.internal.events import FixedEventMids
+from spool import Spool, DROP_POLICIES, DROP_OLDEST
+import metrics
+import encoding
+import hardware
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
 
 MAX_DISCOVERY_RETRIES = 10
 LOG_FILE = '/var/log/iot.log'
@@ -23,13 +45,52 @@ TOPIC_STATUS_ON = ['1', 'on']
 TOPIC_STATUS_OFF = ['0', 'off']
 TOPIC_STATUS_TOGGLE = ['toggle']
 TOPIC_STATUS_PULSE = ['blink', 'pulse']
+MAX_SUBSCRIPTIONS = 50  # AWS IoT subscriptions per connection
+SUBSCRIPTION_COLLAPSE = 8  # exact filters per topic level before using '+'
+DRAIN_RATE = 10  # spool replay messages per second when back online
+MAX_DRAIN_RATE = 100  # AWS IoT publishes per second per connection
+DRAIN_RETRIES = 5  # consecutive replay failures before waiting for the next online event
+DRAIN_WINDOW = 20  # spooled publishes awaiting their PUBACK while draining
+DRAIN_ACK_TIMEOUT = 10  # seconds without a PUBACK before unacknowledged spooled publishes are sent again
+RECONNECT_INTERVAL = 30  # seconds between connect attempts while spooling
+DISPATCH_WORKERS = 4
+DISPATCH_MAX_PENDING = 16  # waiting messages per subscriber callback
+DISPATCH_DROP_OLDEST = 'drop_oldest'
+DISPATCH_DROP_NEWEST = 'drop_newest'
+DISPATCH_COALESCE = 'coalesce'
+DISPATCH_POLICIES = [DISPATCH_DROP_OLDEST, DISPATCH_DROP_NEWEST, DISPATCH_COALESCE]
+AWS_MAX_POOL_CONNECTIONS = 10  # kept-alive HTTPS connections per AWS client
+S3_UPLOAD_CONCURRENCY = 4  # multipart parts of one file uploaded at once, at most AWS_MAX_POOL_CONNECTIONS
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                    multipart_chunksize=8 * 1024 * 1024,
+                                    max_concurrency=S3_UPLOAD_CONCURRENCY,
+                                    use_threads=True)
+FACES_TABLE = 'faces'
+FACE_CACHE_SIZE = 256
+FACE_CACHE_TTL = 3600  # seconds
+BATCH_GET_MAX_KEYS = 100  # DynamoDB BatchGetItem limit
+BATCH_GET_RETRIES = 5
+SHADOW_REFRESH = 3600  # seconds between full shadow reports
+SHADOW_ACK_TIMEOUT = 60  # seconds before an unacknowledged shadow report is given up
+SHADOW_COALESCE_WINDOW = 0.2  # seconds
+BATCH_WINDOW = 10  # seconds
+BATCH_MAX_READINGS = 100
+EVENT_HOLD = 0  # seconds an input state must hold before it is reported
+EVENT_WINDOW = 0  # seconds after a report in which further changes are coalesced (0 is off)
+MAX_INFLIGHT_TIMES = 1000  # unacked publishes whose start time is kept for the ack latency histogram
+DISCONNECT_ACK_TIMEOUT = 10  # seconds disconnect() waits for outstanding PUBACKs
+
+_aws_lock = threading.Lock()
+_aws_session = None
+_aws_clients = {}
+_aws_max_pool_connections = AWS_MAX_POOL_CONNECTIONS
 
 
 def topic_search(topic, input):
     topics = tokenizer(topic, '/')
     for i in topics:
         if input.startswith(i):
-            temp = filter(None, input.replace(i, '').split('/'))
+            temp = list(filter(None, input.replace(i, '').split('/')))
             command = None
             if len(temp) > 0:
                 command = temp.pop(0)
@@ -57,6 +118,170 @@ def tokenizer(s, c, suffix=None):
     return res
 
 
+def topic_matches(topic_filter, topic):
+    """Returns True if topic (or every topic matched by another filter) matches topic_filter"""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or topic_levels[i] == '#':
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def plan_subscriptions(topics, commands=None, arg_commands=None,
+                       collapse=SUBSCRIPTION_COLLAPSE, max_filters=MAX_SUBSCRIPTIONS):
+    """Returns the minimal list of topic filters covering commands (None for any command)
+    sent to any level of topics, falling back to the root wildcards when over max_filters (None for no limit)"""
+    if topics is None:
+        return []
+    commands = list(commands) if commands is not None else None
+    arg_commands = list(arg_commands or [])
+    prefixes = []
+    for t in topics:
+        for p in tokenizer(t, '/'):
+            if p not in prefixes:
+                prefixes.append(p)
+    filters = []
+    for p in prefixes:
+        if commands is None:
+            wanted = ['{}/+'.format(p), '{}/+/+'.format(p)]
+        elif len(commands) + len(arg_commands) > collapse:
+            wanted = ['{}/+'.format(p)]
+            if len(arg_commands) > 0:
+                wanted.append('{}/+/+'.format(p))
+        else:
+            wanted = ['{}/{}'.format(p, c) for c in commands]
+            wanted.extend(['{}/{}/+'.format(p, c) for c in arg_commands])
+        filters.extend(wanted)
+    filters = minimal_filters(filters)
+    if max_filters is not None and len(filters) > max_filters:
+        return root_filters(topics)
+    return filters
+
+
+def minimal_filters(filters):
+    """Returns filters without duplicates and without filters covered by another one"""
+    unique = []
+    for f in filters:
+        if f not in unique:
+            unique.append(f)
+    return [f for f in unique if not any(g != f and topic_matches(g, f) for g in unique)]
+
+
+def root_filters(topics):
+    """Returns the wildcard filters of the root levels of topics"""
+    return minimal_filters(['{}/#'.format(t.split('/').pop(0)) for t in topics or []])
+
+
+def merge_subscriptions(plans, roots, max_filters=MAX_SUBSCRIPTIONS):
+    """Plans the filters of several routers sharing a connection, whose subscription limit applies to them all.
+
+    plans[i] are the filters router i needs and roots[i] its root wildcards. Routers with the most
+    filters fall back to their root wildcards until the merged filters fit in max_filters. Returns
+    (filters, chosen) with chosen[i] the filters router i ended up with.
+    """
+    chosen = [list(p) for p in plans]
+    for i in sorted(range(len(plans)), key=lambda i: -len(plans[i])):
+        filters = minimal_filters([f for c in chosen for f in c])
+        if len(filters) <= max_filters:
+            return filters, chosen
+        chosen[i] = list(roots[i])
+    return minimal_filters([f for c in chosen for f in c]), chosen
+
+
+class TopicRouter(object):
+    """Maps inbound topics to (handler, command, arg) using a topic trie built once at subscribe time.
+
+    A message matches when it is any level prefix of a routed topic followed by a command and
+    an optional argument, e.g. routing 'home/garage/light' accepts 'home/garage/light/on',
+    'home/on' and 'home/garage/light/pulse/3'.
+    """
+
+    def __init__(self, topics=None, default=None, name=None):
+        self.name = name
+        self._metric_names = {}
+        self._root = {}
+        self._topics = []
+        self._handlers = {}
+        self._arg_commands = []
+        self._default = default
+        if topics is not None:
+            for t in topics:
+                self.add_topic(t)
+
+    def add_topic(self, topic):
+        self._topics.append(topic)
+        node = self._root
+        for level in topic.split('/'):
+            node = node.setdefault(level, {})
+        node[None] = True  # a routed topic ends here
+
+    def add_handler(self, commands, handler, arg=False):
+        """Registers handler(command, arg) for commands; arg=True if the command takes an argument"""
+        if isinstance(commands, str):
+            commands = [commands]
+        for c in commands:
+            self._handlers[c] = handler
+            if arg and c not in self._arg_commands:
+                self._arg_commands.append(c)
+
+    def subscriptions(self, max_filters=MAX_SUBSCRIPTIONS):
+        """Returns the topic filters needed to receive every routable message"""
+        if self._default is not None:
+            return plan_subscriptions(self._topics, max_filters=max_filters)
+        return plan_subscriptions(self._topics, sorted(self._handlers), self._arg_commands, max_filters=max_filters)
+
+    def roots(self):
+        """Returns the root wildcard filters that receive every routable message, and more"""
+        return root_filters(self._topics)
+
+    def route(self, topic):
+        levels = topic.split('/')
+        nodes = [self._root]
+        for level in levels:
+            node = nodes[-1].get(level)
+            if node is None:
+                break
+            nodes.append(node)
+        # the deepest match may leave no command, e.g. 'home/garage/on' when 'home/garage/on/x' is routed,
+        # so shallower matches are tried where a routed topic ends or turns away from the message
+        for d in range(len(nodes) - 1, 0, -1):
+            rest = [i for i in levels[d:] if i]
+            if len(rest) > 2:
+                break
+            if len(rest) > 0 and (None in nodes[d] or any(k != levels[d] for k in nodes[d] if k is not None)):
+                command = rest[0]
+                arg = rest[1] if len(rest) > 1 else None
+                return self._handlers.get(command, self._default), command, arg
+        return None, None, None
+
+    def _metric_name(self, handler):
+        # devices sharing a process register handlers of the same name, so the router is part of the name
+        metric = self._metric_names.get(handler)
+        if metric is None:
+            name = self.name if self.name is not None else (self._topics[0] if len(self._topics) > 0 else '')
+            metric = self._metric_names[handler] = re.sub(
+                r'[^a-zA-Z0-9_]+', '_', 'handler_{}_{}_seconds'.format(name, handler.__name__))
+        return metric
+
+    def callback(self, client, user_data, message):
+        logging.debug("received {} {}".format(message.topic, message))
+        handler, command, arg = self.route(message.topic)
+        if command is None:
+            logging.debug("not routed: {}".format(message.topic))  # e.g. another router's, on a shared wildcard
+            return
+        if handler is None:
+            logging.warning('Unrecognized command: {}'.format(command))
+            return
+        logging.debug("command: {}".format(command))
+        with metrics.timed(self._metric_name(handler)):
+            handler(command, arg)
+
+
 def file_timestamp_string(timestamp=datetime.datetime.now()):
     return timestamp.strftime(FILE_DATE_FORMAT)
 
@@ -129,24 +354,64 @@ def is_locked(filepath):
     return locked
 
 
+def configure_aws(max_pool_connections=AWS_MAX_POOL_CONNECTIONS):
+    """Sets the connection pool size of AWS clients created after this call"""
+    global _aws_max_pool_connections
+    _aws_max_pool_connections = max_pool_connections
+
+
+def _aws_config():
+    try:
+        return Config(max_pool_connections=_aws_max_pool_connections, tcp_keepalive=True)
+    except TypeError:  # botocore without tcp_keepalive
+        return Config(max_pool_connections=_aws_max_pool_connections)
+
+
+def _get_aws_session():
+    global _aws_session
+    if _aws_session is None:
+        _aws_session = boto3.session.Session()
+    return _aws_session
+
+
+def aws_client(service):
+    """Returns the process-wide client for service, created on first use.
+    Clients are thread-safe and keep their HTTPS connections alive between calls."""
+    client = _aws_clients.get(service)
+    if client is None:
+        with _aws_lock:
+            client = _aws_clients.get(service)
+            if client is None:
+                client = _aws_clients[service] = _get_aws_session().client(service, config=_aws_config())
+    return client
+
+
 def s3_tag(file_name, bucket, tags=None, s3=None):
-    if s3 is None:
-        s3 = boto3.resource('s3')
-    t = s3.meta.client.get_object_tagging(Bucket=bucket, Key=file_name)['TagSet']
+    client = aws_client('s3') if s3 is None else s3.meta.client
+    t = client.get_object_tagging(Bucket=bucket, Key=file_name)['TagSet']
     if tags is not None:
         for k, v in tags.items():
             t.append({'Key': k.strip(), 'Value': v.strip()})
-        s3.meta.client.put_object_tagging(Bucket=bucket, Key=file_name, Tagging={'TagSet': t})
+        client.put_object_tagging(Bucket=bucket, Key=file_name, Tagging={'TagSet': t})
+
+
+def s3_upload_args(file_name, tags=None):
+    """Returns upload ExtraArgs setting content type and tags in the upload request itself"""
+    extra = {}
+    content_type = mimetypes.guess_type(file_name)[0]
+    if content_type is not None:
+        extra['ContentType'] = content_type
+    if tags is not None and len(tags) > 0:
+        extra['Tagging'] = urlencode([(k.strip(), v.strip()) for k, v in tags.items()])
+    return extra
 
 
 def mv_to_s3(file_name, bucket, tags=None):
-    s3 = boto3.resource('s3')
-    s3.meta.client.upload_file(file_name, bucket, file_name)
-    t = []
-    if tags is not None:
-        for k, v in tags.items():
-            t.append({'Key': k.strip(), 'Value': v.strip()})
-        s3.meta.client.put_object_tagging(Bucket=bucket, Key=file_name, Tagging={'TagSet': t})
+    """Uploads file_name with its content type and tags in one request, sending the parts of
+    a large file in parallel over the shared S3 client, then removes it"""
+    with metrics.timed('s3_upload_seconds'):
+        aws_client('s3').upload_file(file_name, bucket, file_name,
+                                     ExtraArgs=s3_upload_args(file_name, tags), Config=S3_TRANSFER_CONFIG)
     rm(file_name)
 
 
@@ -159,8 +424,10 @@ def rm(file_name):
 
 def recognize(file_name, bucket, confidence=75):
     has_person = False
-    client = boto3.client('rekognition')
-    result = client.detect_labels(Image={'S3Object': {'Bucket': bucket, 'Name': file_name}}, MinConfidence=confidence)
+    client = aws_client('rekognition')
+    with metrics.timed('rekognition_labels_seconds'):
+        result = client.detect_labels(Image={'S3Object': {'Bucket': bucket, 'Name': file_name}},
+                                      MinConfidence=confidence)
     if "Labels" in result:
         x = tagify(result['Labels'], 'Name')
         s3_tag(file_name, bucket, {'recognize': x})
@@ -169,20 +436,107 @@ def recognize(file_name, bucket, confidence=75):
     return has_person
 
 
-def identify(collection, file_name, bucket):
-    client = boto3.client('rekognition')
+class FaceCache(object):
+    """Thread-safe LRU cache of FaceId -> name whose entries expire after ttl seconds.
+    Ids without a record are cached as None so unknown faces are not looked up every time."""
+
+    MISSING = object()
+
+    def __init__(self, max_size=FACE_CACHE_SIZE, ttl=FACE_CACHE_TTL):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, face_id):
+        """Returns the cached name (or None), FaceCache.MISSING if not cached or expired"""
+        with self._lock:
+            item = self._items.pop(face_id, None)
+            if item is None or item[1] < time.time():
+                return FaceCache.MISSING
+            self._items[face_id] = item
+            return item[0]
+
+    def put(self, face_id, name):
+        with self._lock:
+            self._items.pop(face_id, None)
+            self._items[face_id] = (name, time.time() + self._ttl)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+
+face_cache = FaceCache()
+_face_cache_warmed = threading.Event()
+
+
+def lookup_faces(face_ids, table=FACES_TABLE):
+    """Returns {FaceId: name or None}, from face_cache or batched BatchGetItem calls"""
+    names = {}
+    missing = []
+    for face_id in set(face_ids):
+        name = face_cache.get(face_id)
+        if name is FaceCache.MISSING:
+            missing.append(face_id)
+        else:
+            names[face_id] = name
+    client = aws_client('dynamodb')
+    unprocessed = set()
+    for i in range(0, len(missing), BATCH_GET_MAX_KEYS):
+        request = {table: {'Keys': [{'id': {'S': face_id}} for face_id in missing[i:i + BATCH_GET_MAX_KEYS]],
+                           'ProjectionExpression': '#i, #n',
+                           'ExpressionAttributeNames': {'#i': 'id', '#n': 'name'}}}
+        for retry in range(BATCH_GET_RETRIES):
+            response = client.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(table, []):
+                names[item['id']['S']] = item['name']['S']
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            time.sleep(0.05 * 2 ** retry)
+        if request:
+            logging.warning("lookup_faces {} keys unprocessed".format(len(request[table]['Keys'])))
+            unprocessed.update(key['id']['S'] for key in request[table]['Keys'])
+    for face_id in missing:
+        names.setdefault(face_id, None)
+        if face_id not in unprocessed:  # not looked up, so not known to be unknown
+            face_cache.put(face_id, names[face_id])
+    return names
+
+
+def warm_face_cache(table=FACES_TABLE):
+    """Loads every FaceId -> name in table into face_cache, returns the number of faces loaded"""
+    count = 0
+    pages = aws_client('dynamodb').get_paginator('scan').paginate(
+        TableName=table, ProjectionExpression='#i, #n', ExpressionAttributeNames={'#i': 'id', '#n': 'name'})
+    for page in pages:
+        for item in page['Items']:
+            face_cache.put(item['id']['S'], item['name']['S'])
+            count += 1
+    _face_cache_warmed.set()
+    logging.info("warm_face_cache loaded {} faces".format(count))
+    return count
+
+
+def identify(collection, file_name, bucket, warm=False):
+    """Tags the S3 image with the names of the known faces in it.
+    warm=True loads the whole faces table into face_cache before the first lookup in the process."""
+    client = aws_client('rekognition')
     try:
-        result = client.search_faces_by_image(Image={"S3Object": {"Bucket": bucket, "Name": file_name, }},
-                                              CollectionId=collection)
-        table = boto3.resource('dynamodb').Table('faces')
+        if warm and not _face_cache_warmed.is_set():
+            warm_face_cache()
+        with metrics.timed('rekognition_faces_seconds'):
+            result = client.search_faces_by_image(Image={"S3Object": {"Bucket": bucket, "Name": file_name, }},
+                                                  CollectionId=collection)
+        matches = [i['Face']['FaceId'] for i in result['FaceMatches']]
+        names = lookup_faces(matches)
         hits = {}
-        for i in result['FaceMatches']:
-            record = table.query(KeyConditionExpression=Key('id').eq(i['Face']['FaceId']))['Items']
-            if len(record) > 0:
-                if record[0]['name'] in hits:
-                    hits[record[0]['name']] += 1
+        for face_id in matches:
+            name = names.get(face_id)
+            if name is not None:
+                if name in hits:
+                    hits[name] += 1
                 else:
-                    hits[record[0]['name']] = 1
+                    hits[name] = 1
         if len(hits) > 0:
             s3_tag(file_name, bucket, {'identities': '+'.join(hits)})
     except Exception as e:
@@ -197,45 +551,540 @@ def iot_payload(target, doc):
     return json.dumps({STATE: {target: doc}})
 
 
+def decode_payload(message):
+    """Returns the payload of a received message decoded per the encoding level of its topic"""
+    return encoding.decode_message(message.topic, message.payload)[1]
+
+
+def deadband_arg(s):
+    """Parses a --deadband key=value argument"""
+    key, value = s.split('=', 1)
+    return key, float(value)
+
+
+def deep_merge(target, doc):
+    """Merges doc into target, nested documents key by key with values from doc winning"""
+    for k, v in doc.items():
+        if isinstance(v, dict) and isinstance(target.get(k), dict):
+            deep_merge(target[k], v)
+        else:
+            target[k] = copy.deepcopy(v)
+    return target
+
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+class ShadowCache(object):
+    """Last reported shadow state per thing, used to report only the keys that changed.
+
+    A numeric value that moved less than the deadband for its key since it was last reported
+    counts as unchanged. Every refresh seconds the whole cached state is reported again so the
+    shadow recovers from lost updates; refresh=0 reports everything every time. With path set
+    the cache is kept in that file so one-shot scripts also report only changes.
+
+    Reports are compared with the delivered state merged with the reports still in flight, so a
+    value changed back before the earlier report was acknowledged is still sent. A report that
+    fails or is not acknowledged within ack_timeout seconds is rolled back and its keys count
+    as unknown until they are reported again.
+    """
+
+    def __init__(self, deadbands=None, refresh=SHADOW_REFRESH, path=None, ack_timeout=SHADOW_ACK_TIMEOUT):
+        self._deadbands = deadbands or {}
+        self._refresh = refresh
+        self._path = path
+        self._ack_timeout = ack_timeout
+        self._lock = threading.Lock()
+        self._things = {}
+        self._sending = {}  # thing -> [(changes, refresh, sent time)] in send order
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._things = json.load(f)
+            except (IOError, ValueError) as e:
+                logging.warning("shadow cache {} unreadable: {}".format(path, e))
+
+    def _changes(self, reported, doc):
+        changes = {}
+        for k, v in doc.items():
+            old = reported.get(k)
+            if isinstance(v, dict) and isinstance(old, dict):
+                nested = self._changes(old, v)
+                if len(nested) > 0:
+                    changes[k] = nested
+            elif k in reported and _is_number(v) and _is_number(old) and k in self._deadbands:
+                if abs(v - old) >= self._deadbands[k]:
+                    changes[k] = v
+            elif k not in reported or v != old:
+                changes[k] = v
+        return changes
+
+    @staticmethod
+    def _forget(reported, changes):
+        for k, v in changes.items():
+            if isinstance(v, dict) and isinstance(reported.get(k), dict):
+                ShadowCache._forget(reported[k], v)
+            else:
+                reported.pop(k, None)
+
+    def _save(self):
+        tmp = '{}.tmp'.format(self._path)
+        with open(tmp, 'w') as f:
+            json.dump(self._things, f)
+        os.rename(tmp, self._path)
+
+    def _expire(self, thing, entry):
+        sending = self._sending.get(thing, [])
+        while len(sending) > 0 and time.time() - sending[0][2] > self._ack_timeout:
+            changes, refresh, _ = sending.pop(0)
+            logging.warning("shadow {} report not acknowledged in {}s".format(thing, self._ack_timeout))
+            if not refresh:  # the next report is a full refresh anyway
+                self._forget(entry['reported'], changes)
+
+    def delta(self, thing, doc):
+        """Returns (changes, refresh): the part of doc to report for thing, and whether it is a full refresh.
+        Unless empty, changes are in flight until commit() or rollback() is called with the same dict."""
+        with self._lock:
+            entry = self._things.get(thing)
+            if entry is None:
+                entry = self._things[thing] = {'reported': {}, 'refreshed': 0}
+            self._expire(thing, entry)
+            sending = self._sending.setdefault(thing, [])
+            expected = copy.deepcopy(entry['reported'])
+            for changes, _, _ in sending:
+                deep_merge(expected, changes)
+            refresh = time.time() - entry['refreshed'] >= self._refresh and \
+                (self._refresh == 0 or not any(r for _, r, _ in sending))
+            if refresh:
+                changes = deep_merge(expected, doc)
+            else:
+                changes = copy.deepcopy(self._changes(expected, doc))
+            if len(changes) > 0:
+                sending.append((changes, refresh, time.time()))
+            return changes, refresh
+
+    def _done(self, thing, changes):
+        sending = self._sending.get(thing, [])
+        for i, report in enumerate(sending):
+            if report[0] is changes:
+                return sending.pop(i)
+        return None
+
+    def commit(self, thing, changes, refresh=False):
+        """Records changes returned by delta() as reported for thing, once their report was delivered"""
+        with self._lock:
+            self._done(thing, changes)
+            entry = self._things.setdefault(thing, {'reported': {}, 'refreshed': 0})
+            deep_merge(entry['reported'], changes)
+            if refresh:
+                entry['refreshed'] = time.time()
+            if self._path is not None:
+                try:
+                    self._save()
+                except (IOError, OSError) as e:
+                    logging.warning("shadow cache {} not saved: {}".format(self._path, e))
+
+    def rollback(self, thing, changes):
+        """Gives up changes returned by delta() whose report failed; their keys are reported again next time"""
+        with self._lock:
+            report = self._done(thing, changes)
+            entry = self._things.get(thing)
+            if report is not None and not report[1] and entry is not None:
+                self._forget(entry['reported'], changes)
+
+
+def _call_all(callbacks):
+    def call():
+        for callback in callbacks:
+            callback()
+    return call
+
+
+class ShadowCoalescer(object):
+    """Merges shadow reports for the same thing made within window seconds into one update.
+
+    The first report for a thing opens its window and later ones are deep-merged into it, newer
+    values winning. When the window closes flush(thing, doc, acked) is called with the merged
+    document and a callback that runs the acked callbacks of the merged reports.
+    A critical report closes the window at once so state changes are not delayed.
+    """
+
+    def __init__(self, flush, window=SHADOW_COALESCE_WINDOW):
+        self._flush = flush
+        self._window = window
+        self._pending = {}
+        self._acked = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # keeps updates for a thing in order
+
+    def add(self, thing, doc, critical=False, acked=None):
+        with self._lock:
+            pending = self._pending.get(thing)
+            if pending is None:
+                pending = self._pending[thing] = {}
+                if not critical:
+                    timer = self._timers[thing] = threading.Timer(self._window, self.flush, [thing])
+                    timer.daemon = True
+                    timer.start()
+            deep_merge(pending, doc)
+            if acked is not None:
+                self._acked.setdefault(thing, []).append(acked)
+        if critical:
+            self.flush(thing)
+
+    def flush(self, thing=None):
+        """Sends the pending update for thing, or for every thing"""
+        with self._flush_lock:
+            with self._lock:
+                things = list(self._pending) if thing is None else [thing]
+                updates = []
+                for t in things:
+                    timer = self._timers.pop(t, None)
+                    if timer is not None:
+                        timer.cancel()
+                    if t in self._pending:
+                        updates.append((t, self._pending.pop(t), self._acked.pop(t, [])))
+            for t, doc, callbacks in updates:
+                try:
+                    self._flush(t, doc, _call_all(callbacks) if len(callbacks) > 0 else None)
+                except Exception as e:
+                    logging.error("shadow {} update failed: {}".format(t, e))
+
+
+class TelemetryBatcher(object):
+    """Buffers readings per topic and publishes each batch as one columnar document.
+
+    A batch is published window seconds after its first reading, or as soon as it holds
+    max_readings, by calling publish(topic, doc) with
+    {"t0": first timestamp, "dt": [ms after t0], field: [values]}. Fields missing from a reading are null.
+    """
+
+    def __init__(self, publish, window=BATCH_WINDOW, max_readings=BATCH_MAX_READINGS):
+        self._publish = publish
+        self._window = window
+        self._max_readings = max_readings
+        self._batches = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # keeps batches for a topic in order
+
+    def add(self, topic, reading, timestamp=None):
+        with self._lock:
+            batch = self._batches.get(topic)
+            if batch is None:
+                batch = self._batches[topic] = []
+                timer = self._timers[topic] = threading.Timer(self._window, self.flush, [topic])
+                timer.daemon = True
+                timer.start()
+            batch.append((time.time() if timestamp is None else timestamp, reading))
+            full = len(batch) >= self._max_readings
+        if full:
+            self.flush(topic)
+
+    @staticmethod
+    def columns(batch):
+        """Returns the columnar document for [(timestamp, reading)]"""
+        t0 = batch[0][0]
+        doc = {'t0': round(t0, 3), 'dt': [int(round((t - t0) * 1000)) for t, _ in batch]}
+        for _, reading in batch:
+            for k in reading:
+                if k not in doc:
+                    doc[k] = [r.get(k) for _, r in batch]
+        return doc
+
+    def flush(self, topic=None):
+        """Publishes the pending batch for topic, or for every topic"""
+        with self._flush_lock:
+            with self._lock:
+                topics = list(self._batches) if topic is None else [topic]
+                batches = []
+                for t in topics:
+                    timer = self._timers.pop(t, None)
+                    if timer is not None:
+                        timer.cancel()
+                    if t in self._batches:
+                        batches.append((t, self._batches.pop(t)))
+            for t, batch in batches:
+                try:
+                    self._publish(t, self.columns(batch))
+                except Exception as e:
+                    logging.error("telemetry {} batch of {} failed: {}".format(t, len(batch), e))
+
+
+class EventShaper(object):
+    """Rate-limits the state changes of a chattering binary input and reports them off the caller's thread.
+
+    update(state) only stores the latest state, so it never blocks a GPIO callback and a burst of
+    edges overwrites one slot instead of queuing. A worker thread calls report(state, count) once
+    the state has held for hold seconds and at least window seconds have passed since the last
+    report; count is the number of edges the report stands for. A burst that ends in the state
+    last reported is not reported again.
+    """
+
+    def __init__(self, report, hold=EVENT_HOLD, window=EVENT_WINDOW):
+        self._report = report
+        self._hold = hold
+        self._window = window
+        self._state = None
+        self._changed = 0
+        self._edges = 0
+        self._reported = None
+        self._reported_time = 0
+        self._condition = threading.Condition()
+        t = threading.Thread(target=self._run, name='event-shaper')
+        t.daemon = True
+        t.start()
+
+    def update(self, state):
+        with self._condition:
+            if state == self._state:
+                return
+            self._state = state
+            self._changed = time.time()
+            self._edges += 1
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._state == self._reported:
+                    self._condition.wait()
+                due = max(self._changed + self._hold, self._reported_time + self._window)
+                if time.time() < due:
+                    self._condition.wait(due - time.time())
+                    continue
+                state = self._reported = self._state
+                count = self._edges
+                self._edges = 0
+                self._reported_time = time.time()
+            metrics.registry.increment('events_reported')
+            metrics.registry.increment('events_coalesced', count - 1)
+            try:
+                self._report(state, count)
+            except Exception as e:
+                logging.error("event report {} failed: {}".format(state, e))
+
+
+class Dispatcher(object):
+    """Bounded worker pool that runs subscriber callbacks off the MQTT network thread.
+
+    Jobs submitted with the same key run one at a time in arrival order, different keys run
+    concurrently. Each key holds at most max_pending waiting jobs; when full the policy drops
+    the oldest or the newest job, or coalesces the waiting jobs down to the newest one.
+    """
+
+    def __init__(self, workers=DISPATCH_WORKERS, max_pending=DISPATCH_MAX_PENDING, policy=DISPATCH_DROP_OLDEST):
+        if policy not in DISPATCH_POLICIES:
+            raise ValueError("unknown dispatch policy {}".format(policy))
+        self._max_pending = max_pending
+        self._policy = policy
+        self._pending = {}
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='dispatch-{}'.format(i))
+            t.daemon = True
+            t.start()
+
+    def submit(self, key, fn, *args):
+        """Queues fn(*args) behind earlier jobs for key, returns False if it was dropped"""
+        with self._lock:
+            jobs = self._pending.get(key)
+            if jobs is None:
+                jobs = self._pending[key] = collections.deque()
+                self._ready.put(key)
+            elif len(jobs) >= self._max_pending:
+                if self._policy == DISPATCH_DROP_NEWEST:
+                    logging.warning("dispatch queue full, dropped newest job for {}".format(key))
+                    return False
+                elif self._policy == DISPATCH_COALESCE:
+                    logging.warning("dispatch queue full, coalesced {} jobs for {}".format(len(jobs), key))
+                    jobs.clear()
+                else:
+                    logging.warning("dispatch queue full, dropped oldest job for {}".format(key))
+                    jobs.popleft()
+            jobs.append((fn, args))
+            return True
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                fn, args = self._pending[key].popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.exception("dispatch {} failed: {}".format(key, e))
+            with self._lock:
+                if len(self._pending[key]) > 0:
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+
+    @property
+    def pending(self):
+        """Number of jobs waiting to run"""
+        with self._lock:
+            return sum(len(jobs) for jobs in self._pending.values())
+
+
 def iot_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-e", "--endpoint", required=True, help="Your AWS IoT custom endpoint")
     parser.add_argument("-r", "--rootCA", required=True, help="Root CA file path")
     parser.add_argument("-c", "--cert", required=True, help="Certificate file path")
     parser.add_argument("-k", "--key", required=True, help="Private key file path")
+    parser.add_argument("--port", help="MQTT port", type=int, default=8883)
     parser.add_argument("-t", "--topic", nargs='*', help="MQTT topic(s)")
     parser.add_argument("-l", "--log_level", help="Log Level", default=logging.INFO)
     parser.add_argument("--thing", help="thing name", default=platform.node().split('.')[0])
+    parser.add_argument("--spool_dir", help="spool offline publishes to this directory (one per process)")
+    parser.add_argument("--spool_max_mb", help="max spool size in MB", type=float, default=64)
+    parser.add_argument("--spool_max_age", help="discard spooled publishes older than n seconds", type=float,
+                        default=7 * 24 * 3600)
+    parser.add_argument("--spool_policy", help="when the spool is full %s" % DROP_POLICIES, choices=DROP_POLICIES,
+                        default=DROP_OLDEST)
+    parser.add_argument("--drain_rate", help="initial spool replay rate (messages/sec)", type=float,
+                        default=DRAIN_RATE)
+    parser.add_argument("--max_drain_rate", help="max spool replay rate (messages/sec)", type=float,
+                        default=MAX_DRAIN_RATE)
+    parser.add_argument("--workers", help="callback worker threads (0 runs callbacks on the MQTT thread)", type=int,
+                        default=DISPATCH_WORKERS)
+    parser.add_argument("--max_pending", help="waiting messages per subscriber callback", type=int,
+                        default=DISPATCH_MAX_PENDING)
+    parser.add_argument("--queue_policy", help="when a callback queue is full %s" % DISPATCH_POLICIES,
+                        choices=DISPATCH_POLICIES, default=DISPATCH_DROP_OLDEST)
+    parser.add_argument("--aws_pool_connections", help="kept-alive connections per AWS client (S3, Rekognition)",
+                        type=int, default=AWS_MAX_POOL_CONNECTIONS)
+    parser.add_argument("--deadband", help="report numeric shadow key only after it moves this much (key=value)",
+                        nargs='*', type=deadband_arg, default=[])
+    parser.add_argument("--shadow_refresh", help="seconds between full shadow reports (0 reports every key)",
+                        type=float, default=SHADOW_REFRESH)
+    parser.add_argument("--shadow_cache", help="keep the last reported shadow state in this file")
+    parser.add_argument("--coalesce_ms", help="merge shadow reports made within this many ms (0 is off)",
+                        type=float, default=0)
+    parser.add_argument("--encoding", help="payload encoding for sensor topics", choices=encoding.names(),
+                        default=encoding.JSON)
+    parser.add_argument("--schema", help="send sensor readings as arrays in the script's fixed field order",
+                        action='store_true')
+    parser.add_argument("--batch_window", help="publish readings in batches every n seconds (0 is off)",
+                        type=float, default=0)
+    parser.add_argument("--batch_size", help="max readings per batch", type=int, default=BATCH_MAX_READINGS)
+    parser.add_argument("--metrics_port", help="serve metrics over HTTP on this localhost port (0 is off)", type=int,
+                        default=0)
+    parser.add_argument("--metrics_interval", help="publish a metrics summary every n seconds (0 is off)",
+                        type=float, default=0)
+    parser.add_argument("--metrics_topic", help="publish the metrics summary here instead of the thing shadow")
+    parser.add_argument("--hardware", help="device backend (default $IOT_HARDWARE or pi)", choices=hardware.BACKENDS,
+                        default=hardware.backend)
+    parser.add_argument("--trace_dir", help="recorded traces replayed by simulated devices", default=hardware.trace_dir)
+    parser.add_argument("--speed", help="replay speed of simulated devices (1 is real time)", type=float,
+                        default=hardware.speed)
     return parser
 
 
+def mqtt_from_args(args):
+    configure_aws(args.aws_pool_connections)
+    spool = None
+    if args.spool_dir is not None:
+        spool = Spool(args.spool_dir, max_bytes=int(args.spool_max_mb * 1024 * 1024), max_age=args.spool_max_age,
+                      drop_policy=args.spool_policy)
+    dispatcher = None
+    if args.workers > 0:
+        dispatcher = Dispatcher(args.workers, args.max_pending, args.queue_policy)
+    shadow_cache = ShadowCache(dict(args.deadband), args.shadow_refresh, args.shadow_cache)
+    mqtt = MQTT(args.endpoint, args.rootCA, args.cert, args.key, port=args.port,
+                spool=spool, drain_rate=args.drain_rate, max_drain_rate=args.max_drain_rate, dispatcher=dispatcher,
+                shadow_cache=shadow_cache, coalesce_window=args.coalesce_ms / 1000.0,
+                batch_window=args.batch_window, batch_size=args.batch_size,
+                payload_encoding=args.encoding, use_schemas=args.schema)
+    if args.metrics_port > 0:
+        metrics.serve(args.metrics_port)
+    if args.metrics_interval > 0:
+        mqtt.report_metrics(args.metrics_interval, args.thing, args.metrics_topic)
+    return mqtt
+
+
 class MQTT:
-    def __init__(self, end_point, root_ca_path, certificate_path, private_key_path):
+    def __init__(self, end_point, root_ca_path, certificate_path, private_key_path, port=8883,
+                 spool=None, drain_rate=DRAIN_RATE, max_drain_rate=MAX_DRAIN_RATE, dispatcher=None, shadow_cache=None,
+                 coalesce_window=0, batch_window=0, batch_size=BATCH_MAX_READINGS, payload_encoding=encoding.JSON,
+                 use_schemas=False):
         self._end_point = end_point
         self._root_ca_path = root_ca_path
         self._certificate_path = certificate_path
         self._private_key_path = private_key_path
         self._client = AWSIoTMQTTClient(None)
         self._client.configureCredentials(self._root_ca_path, self._private_key_path, self._certificate_path)
-        self._client.configureEndpoint(self._end_point, 8883)
-        self._client.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
-        self._client.configureDrainingFrequency(2)  # Draining: 2 Hz
+        self._client.configureEndpoint(self._end_point, port)
+        if spool is None:
+            self._client.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
+            self._client.configureDrainingFrequency(2)  # Draining: 2 Hz
+        else:
+            self._client.configureOfflinePublishQueueing(0)  # offline publishes raise and go to the spool
         self._client.configureConnectDisconnectTimeout(10)  # 10 sec
         self._client.configureMQTTOperationTimeout(5)  # 5 sec
         self._client.onOnline = self.online_callback
         self._client.onOffline = self.offline_callback
         self._connected = False
+        self._connect_lock = threading.Lock()
+        self._spool = spool
+        self._drain_rate = drain_rate
+        self._max_drain_rate = max_drain_rate
+        self._drain_thread = None
+        self._drain_lock = threading.Lock()
+        self._connect_time = 0
+        self._subscriptions = {}
+        self._routers = []  # (router, its filters)
+        self._router_filters = []
+        self._dispatcher = dispatcher
+        self._shadow_cache = shadow_cache
+        self._coalescer = None
+        if coalesce_window > 0:
+            self._coalescer = ShadowCoalescer(self._report_shadow, coalesce_window)
+        self._batcher = None
+        if batch_window > 0:
+            self._batcher = TelemetryBatcher(self._publish_batch, batch_window, batch_size)
+        self._batch_schemas = {}  # topic: schema of its readings
+        self._encoding = payload_encoding
+        self._use_schemas = use_schemas
+        self._inflight = collections.OrderedDict()
+        self._early_acks = collections.OrderedDict()  # mid: time of acks that came before publishAsync returned
+        self._inflight_lock = threading.Lock()
+        self._metrics_stop = threading.Event()
+        metrics.registry.gauge('mqtt_connected', lambda: int(self._connected))
+        metrics.registry.gauge('mqtt_inflight', lambda: len(self._inflight))
+        if dispatcher is not None:
+            metrics.registry.gauge('dispatch_pending', lambda: dispatcher.pending)
+        if spool is not None:
+            metrics.registry.gauge('spool_bytes', lambda: spool.size)
 
     def online_callback(self):
         logging.info("mqtt online")
+        metrics.registry.increment('mqtt_online')
         self._connected = True
+        self._start_drain()
 
     def offline_callback(self):
         logging.info("mqtt offline")
+        metrics.registry.increment('mqtt_offline')
         self._connected = False
 
     def publish_callback(self, mid):
         logging.info("mqtt published {}".format(mid))
+        with self._inflight_lock:
+            inflight = self._inflight.pop(mid, None)
+            if inflight is None:
+                self._early_acks[mid] = time.time()
+                if len(self._early_acks) > MAX_INFLIGHT_TIMES:
+                    self._early_acks.popitem(last=False)
+        if inflight is not None:
+            start, acked = inflight
+            metrics.registry.observe('mqtt_publish_ack_seconds', time.time() - start)
+            if acked is not None:
+                acked()
 
     @property
     def connected(self):
@@ -244,25 +1093,296 @@ class MQTT:
     def connect(self):
         # use the presence of group_ca_path to determine if local or cloud
         if not self._connected:
-            logging.debug("mqtt connect {}".format(self._end_point))
-            self._client.connect()
+            with self._connect_lock:  # devices sharing the connection publish from their own threads
+                if not self._connected:
+                    logging.debug("mqtt connect {}".format(self._end_point))
+                    self._client.connect()
+                    self._connected = True  # onOnline may only arrive after the next publish
 
-    def publish(self, topic, payload, qos=1):
+    def publish(self, topic, payload, qos=1, acked=None, failed=None):
+        """Publishes payload; acked() is called once the broker acknowledged it or it is safe in the spool,
+        failed() if it could be neither sent nor spooled. Returns False if neither will be called because
+        the SDK queued the publish while offline."""
         logging.info("mqtt publish {} {}".format(topic, payload))
+        if self._spool is not None:
+            self._spool_publish(topic, payload, qos, acked, failed)
+            return True
         self.connect()
         try:
-            self._client.publishAsync(topic, payload, qos, ackCallback=self.publish_callback)
+            return self._publish_async(topic, payload, qos, acked)
         except Exception as e:
-            logging.error("mqtt publish {} {} error: {}".format(topic, payload, e.message))
+            metrics.registry.increment('mqtt_publish_errors')
+            logging.error("mqtt publish {} {} error: {}".format(topic, payload, e))
+            if failed is not None:
+                failed()
+            return True
+
+    def publish_doc(self, topic, doc, schema=None):
+        """Publishes doc to a non-shadow topic in the configured encoding, named by a trailing topic level"""
+        if not self._use_schemas:
+            schema = None
+        self.publish(encoding.hint_topic(topic, self._encoding, schema), encoding.encode(doc, self._encoding, schema))
+
+    def _publish_batch(self, topic, doc):
+        schema = self._batch_schemas.get(topic) if self._use_schemas else None
+        self.publish(encoding.hint_topic(topic, self._encoding, schema),
+                     encoding.encode_columns(doc, self._encoding, schema))
+
+    def publish_reading(self, topic, reading, schema=None, message=None):
+        """Publishes a sensor reading dict, batched with others for the topic if batching is on.
+        schema names the registered field order used when schemas are on. message is sent as the
+        MESSAGE field when the reading goes out on its own as a document with field names."""
+        if self._batcher is not None:
+            self._batch_schemas[topic] = schema
+            self._batcher.add(topic, reading)
+        else:
+            if message is not None and not (self._use_schemas and schema is not None):
+                reading = dict(reading, **{MESSAGE: message})
+            self.publish_doc(topic, reading, schema)
+
+    def report_shadow(self, thing, doc, critical=False, acked=None):
+        """Publishes doc as the reported state of thing, leaving out keys that have not changed.
+        Reports are merged for the coalesce window unless critical. acked() is called once the
+        update was delivered, or at once if nothing changed."""
+        if self._coalescer is not None:
+            self._coalescer.add(thing, doc, critical, acked)
+        else:
+            self._report_shadow(thing, doc, acked)
+
+    def _report_shadow(self, thing, doc, acked=None):
+        failed = None
+        if self._shadow_cache is not None:
+            doc, refresh = self._shadow_cache.delta(thing, doc)
+            if len(doc) == 0:
+                logging.debug("mqtt shadow {} unchanged".format(thing))
+                metrics.registry.increment('shadow_unchanged')
+                if acked is not None:
+                    acked()
+                return
+            acked = self._shadow_committer(thing, doc, refresh, acked)
+            failed = lambda: self._shadow_cache.rollback(thing, doc)
+        self.publish(iot_thing_topic(thing), iot_payload(REPORTED, doc), acked=acked, failed=failed)
+
+    def _shadow_committer(self, thing, doc, refresh, acked):
+        def commit():
+            self._shadow_cache.commit(thing, doc, refresh)
+            if acked is not None:
+                acked()
+        return commit
+
+    def _publish_async(self, topic, payload, qos, acked=None):
+        """Publishes without waiting for the PUBACK; acked() is called once it arrives (at once for QoS 0).
+        Returns False if the SDK queued the publish while offline, in which case acked() is not called."""
+        start = time.time()
+        mid = self._client.publishAsync(topic, payload, qos, ackCallback=self.publish_callback)
+        if mid == FixedEventMids.QUEUED_MID:  # every offline publish gets this mid and no ack
+            metrics.registry.increment('mqtt_queued')
+            return False
+        if qos > 0:
+            # the ack may already have come while publishAsync was still returning
+            with self._inflight_lock:
+                ack_time = self._early_acks.pop(mid, 0)
+                early = ack_time >= start  # an ack from before the call belongs to an older publish
+                if not early:
+                    self._inflight[mid] = (start, acked)
+                    if len(self._inflight) > MAX_INFLIGHT_TIMES:
+                        self._inflight.popitem(last=False)
+            if early:
+                metrics.registry.observe('mqtt_publish_ack_seconds', ack_time - start)
+                if acked is not None:
+                    acked()
+        metrics.registry.increment('mqtt_published')
+        if qos == 0 and acked is not None:
+            acked()
+        return True
+
+    def _spool_publish(self, topic, payload, qos, acked=None, failed=None):
+        # publish directly unless offline or older publishes are still waiting in the spool
+        if not self._spool.pending():
+            try:
+                if not self._connected and time.time() - self._connect_time > RECONNECT_INTERVAL:
+                    self._connect_time = time.time()
+                    self.connect()
+                self._publish_async(topic, payload, qos, acked)
+                return
+            except Exception as e:
+                logging.warning("mqtt publish {} spooled: {}".format(topic, e))
+        if self._spool.append(topic, payload, qos):
+            metrics.registry.increment('mqtt_spooled')
+            if acked is not None:
+                acked()  # the spool delivers it at least once
+        elif failed is not None:
+            failed()
+        self._start_drain()
+
+    def _start_drain(self):
+        if self._spool is None or not self._connected:
+            return
+        with self._drain_lock:
+            if self._drain_thread is None or not self._drain_thread.is_alive():
+                self._drain_thread = threading.Thread(target=self._drain, name='spool-drain')
+                self._drain_thread.daemon = True
+                self._drain_thread.start()
+
+    def _drain(self):
+        """Replays the spool until it is empty, then exits unless a publish was spooled meanwhile"""
+        sent = 0
+        while True:
+            n, done = self._replay()
+            sent += n
+            with self._drain_lock:
+                # _start_drain finds this thread alive until it is cleared here, so pending() is checked under the lock
+                if not done or not self._spool.pending():
+                    if self._spool.in_flight > 0:
+                        self._spool.rewind()  # the next drain sends them again
+                    self._drain_thread = None
+                    break
+        logging.info("mqtt drained {} spooled publishes".format(sent))
+
+    def _replay(self):
+        """Replays the spool with up to DRAIN_WINDOW publishes awaiting their PUBACK, doubling the rate after
+        each clean batch and halving it on errors. A record leaves the spool when its PUBACK arrives; if
+        none arrives for DRAIN_ACK_TIMEOUT the unacknowledged records are sent again.
+        Returns (publishes sent, True if the spool was emptied)."""
+        rate = self._drain_rate
+        sent = 0
+        failures = 0
+        acked = self._spool.acked
+        progress = time.time()
+        while self._connected and failures < DRAIN_RETRIES:
+            if self._spool.acked != acked:
+                acked = self._spool.acked
+                progress = time.time()
+                failures = 0
+            record = self._spool.read() if self._spool.in_flight < DRAIN_WINDOW else None
+            if record is None:
+                if self._spool.in_flight == 0:
+                    return sent, True
+                if time.time() - progress > DRAIN_ACK_TIMEOUT:
+                    logging.warning("mqtt drain: no PUBACK in {}s, resending".format(DRAIN_ACK_TIMEOUT))
+                    self._spool.rewind()
+                    failures += 1
+                    progress = time.time()
+                    rate = max(self._drain_rate, rate / 2)
+                time.sleep(1.0 / rate)
+                continue
+            position, topic, payload, qos = record
+            try:
+                self._publish_async(topic, payload, qos, lambda p=position: self._spool.ack(p))
+            except Exception as e:
+                logging.warning("mqtt drain {} error: {}".format(topic, e))
+                self._spool.rewind()
+                failures += 1
+                rate = max(self._drain_rate, rate / 2)
+                time.sleep(1.0 / rate)
+                continue
+            sent += 1
+            if sent % max(1, int(rate)) == 0:
+                rate = min(self._max_drain_rate, rate * 2)
+            time.sleep(1.0 / rate)
+        return sent, False
 
     def subscribe(self, topic, callback, qos=1):
         logging.info("mqtt subscribe {}".format(topic))
+        # the SDK keeps one callback per filter, so handlers sharing a filter are fanned out here
+        if topic in self._subscriptions:
+            self._subscriptions[topic].append(callback)
+            return
+        self._subscriptions[topic] = [callback]
+        if topic in self._router_filters:
+            return
         self.connect()
         try:
-            self._client.subscribe(topic, qos, callback)
+            self._client.subscribe(topic, qos, self._fan_out(topic))
         except Exception as e:
-            logging.error("mqtt subscribe {} error: {}".format(topic, e.message))
+            del self._subscriptions[topic]
+            logging.error("mqtt subscribe {} error: {}".format(topic, e))
+
+    def _fan_out(self, topic):
+        def deliver(client, user_data, message):
+            metrics.registry.increment('mqtt_received')
+            callbacks = list(self._subscriptions.get(topic, []))
+            if topic in self._router_filters:
+                # a filter may be shared, so each router only gets the messages its own filters match
+                callbacks.extend(r.callback for r, filters in self._routers
+                                 if any(topic_matches(f, message.topic) for f in filters))
+            for callback in callbacks:
+                if self._dispatcher is not None:
+                    # one queue per callback keeps each device's commands in order
+                    self._dispatcher.submit(callback, self._run_callback, callback, time.time(),
+                                            client, user_data, message)
+                else:
+                    self._run_callback(callback, None, client, user_data, message)
+        return deliver
+
+    def _run_callback(self, callback, queued, client, user_data, message):
+        if queued is not None:
+            metrics.registry.observe('dispatch_wait_seconds', time.time() - queued)
+        with metrics.timed('mqtt_callback_seconds'):
+            callback(client, user_data, message)
+
+    def subscribe_router(self, router, qos=1):
+        """Subscribes router.callback, planning the filters of all routers on the connection together
+        so that they and the other subscriptions stay within MAX_SUBSCRIPTIONS"""
+        routers = [r for r, filters in self._routers] + [router]
+        others = len([f for f in self._subscriptions if f not in self._router_filters])
+        filters, chosen = merge_subscriptions([r.subscriptions(max_filters=None) for r in routers],
+                                              [r.roots() for r in routers], MAX_SUBSCRIPTIONS - others)
+        old = self._router_filters
+        self._routers = list(zip(routers, chosen))
+        self._router_filters = filters
+        for topic in old:
+            if topic not in filters and topic not in self._subscriptions:
+                logging.info("mqtt unsubscribe {}".format(topic))
+                try:
+                    self._client.unsubscribe(topic)
+                except Exception as e:
+                    logging.error("mqtt unsubscribe {} error: {}".format(topic, e))
+        for topic in filters:
+            if topic not in old and topic not in self._subscriptions:
+                logging.info("mqtt subscribe {}".format(topic))
+                self.connect()
+                try:
+                    self._client.subscribe(topic, qos, self._fan_out(topic))
+                except Exception as e:
+                    logging.error("mqtt subscribe {} error: {}".format(topic, e))
+
+    def report_metrics(self, interval, thing, topic=None):
+        """Publishes the metrics summary every interval seconds to the thing shadow, or to topic if set"""
+        def report():
+            while not self._metrics_stop.wait(interval):
+                try:
+                    summary = metrics.registry.summary()
+                    if topic is None:
+                        self.report_shadow(thing, {'metrics': summary})
+                    else:
+                        self.publish(topic, json.dumps({'thing': thing, 'metrics': summary}))
+                except Exception as e:
+                    logging.error("mqtt metrics report failed: {}".format(e))
+
+        t = threading.Thread(target=report, name='metrics-report')
+        t.daemon = True
+        t.start()
+
+    def _wait_for_acks(self, timeout):
+        """Waits up to timeout seconds for every outstanding publish to be acknowledged, returns True if they were"""
+        deadline = time.time() + timeout
+        while len(self._inflight) > 0 and time.time() < deadline:
+            time.sleep(0.05)
+        return len(self._inflight) == 0
 
     def disconnect(self):
+        self._metrics_stop.set()
+        if self._coalescer is not None:
+            self._coalescer.flush()
+        if self._batcher is not None:
+            self._batcher.flush()
+        if self._connected and not self._wait_for_acks(DISCONNECT_ACK_TIMEOUT):
+            logging.warning("mqtt disconnect with {} publishes unacknowledged".format(len(self._inflight)))
         self._connected = False
+        if self._spool is not None:
+            drain_thread = self._drain_thread
+            if drain_thread is not None:
+                drain_thread.join()
+            self._spool.close()
         return self._client.disconnect()
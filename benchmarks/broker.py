@@ -0,0 +1,296 @@
+"""Minimal MQTT 3.1.1 broker and publishing client over TLS, standing in for the AWS IoT endpoint.
+
+Supports what the awsiot scripts use: CONNECT, SUBSCRIBE/UNSUBSCRIBE with '+' and '#' filters,
+QoS 0/1 PUBLISH, PINGREQ and DISCONNECT. No sessions, retained messages or authentication.
+Each subscriber has a bounded outbound queue; messages that do not fit are counted as dropped.
+"""
+
+import os
+import ssl
+import sys
+import time
+import socket
+import struct
+import logging
+import threading
+import subprocess as sp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import awsiot
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+OUTBOUND_QUEUE = 10000  # messages buffered per subscriber
+
+
+def make_certificate(directory, name='localhost'):
+    """Creates a self-signed certificate and key for name, returns (cert path, key path)"""
+    cert = os.path.join(directory, '{}.cert.pem'.format(name))
+    key = os.path.join(directory, '{}.private.key'.format(name))
+    sp.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                   '-keyout', key, '-out', cert, '-subj', '/CN={}'.format(name),
+                   '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+                  stdout=open(os.devnull, 'w'), stderr=sp.STDOUT)
+    return cert, key
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        digit = n % 128
+        n //= 128
+        if n > 0:
+            digit |= 0x80
+        out.append(digit)
+        if n == 0:
+            return bytes(out)
+
+
+def encode_string(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return struct.pack('!H', len(s)) + s
+
+
+def packet(packet_type, flags, body):
+    return bytes(bytearray([(packet_type << 4) | flags])) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, qos=0, packet_id=1):
+    if not isinstance(payload, bytes):
+        payload = payload.encode('utf-8')
+    body = encode_string(topic)
+    if qos > 0:
+        body += struct.pack('!H', packet_id)
+    return packet(PUBLISH, qos << 1, body + payload)
+
+
+def read_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def read_packet(sock):
+    """Returns (type, flags, body) of the next packet on sock"""
+    header = bytearray(read_exact(sock, 1))[0]
+    length = 0
+    multiplier = 1
+    while True:
+        digit = bytearray(read_exact(sock, 1))[0]
+        length += (digit & 0x7f) * multiplier
+        multiplier *= 128
+        if digit & 0x80 == 0:
+            break
+    return header >> 4, header & 0x0f, read_exact(sock, length) if length > 0 else b''
+
+
+def decode_string(body, offset):
+    n = struct.unpack('!H', body[offset:offset + 2])[0]
+    return body[offset + 2:offset + 2 + n].decode('utf-8'), offset + 2 + n
+
+
+class Connection(object):
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.filters = {}
+        self.outbound = queue.Queue(OUTBOUND_QUEUE)
+        self._packet_id = 0
+
+    def send(self, data):
+        try:
+            self.outbound.put_nowait(data)
+            return True
+        except queue.Full:
+            return False
+
+    def deliver(self, topic, payload, qos):
+        packet_id = 0
+        if qos > 0:
+            self._packet_id = self._packet_id % 65535 + 1
+            packet_id = self._packet_id
+        return self.send(publish_packet(topic, payload, qos, packet_id))
+
+    def write(self):
+        while True:
+            data = self.outbound.get()
+            if data is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except (socket.error, ssl.SSLError):
+                return
+
+    def read(self):
+        try:
+            while True:
+                packet_type, flags, body = read_packet(self.sock)
+                if packet_type == CONNECT:
+                    self.send(packet(CONNACK, 0, b'\x00\x00'))
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic, offset = decode_string(body, 0)
+                    if qos > 0:
+                        self.send(packet(PUBACK, 0, body[offset:offset + 2]))
+                        offset += 2
+                    self.broker.route(topic, body[offset:], qos)
+                elif packet_type == SUBSCRIBE:
+                    packet_id = body[0:2]
+                    offset = 2
+                    granted = bytearray()
+                    while offset < len(body):
+                        topic_filter, offset = decode_string(body, offset)
+                        qos = min(bytearray(body[offset:offset + 1])[0], 1)
+                        offset += 1
+                        self.filters[topic_filter] = qos
+                        granted.append(qos)
+                    self.send(packet(SUBACK, 0, packet_id + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    offset = 2
+                    while offset < len(body):
+                        topic_filter, offset = decode_string(body, offset)
+                        self.filters.pop(topic_filter, None)
+                    self.send(packet(UNSUBACK, 0, body[0:2]))
+                elif packet_type == PINGREQ:
+                    self.send(packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    break
+        except (EOFError, socket.error, ssl.SSLError):
+            pass
+        finally:
+            self.broker.remove(self)
+            self.outbound.put(None)
+            self.sock.close()
+
+
+class Broker(object):
+    """TLS MQTT broker on 127.0.0.1; port 0 picks a free port"""
+
+    def __init__(self, cert, key, port=0):
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(cert, key)
+        self._context = context
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', port))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+        self._connections = []
+        self._lock = threading.Lock()
+        self.received = 0
+        self.routed = 0
+        self.dropped = 0
+
+    def start(self):
+        t = threading.Thread(target=self._accept, name='broker')
+        t.daemon = True
+        t.start()
+        return self
+
+    def _accept(self):
+        while True:
+            sock, address = self._server.accept()
+            try:
+                sock = self._context.wrap_socket(sock, server_side=True)
+            except (ssl.SSLError, socket.error) as e:
+                logging.warning("broker handshake failed: {}".format(e))
+                sock.close()
+                continue
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            c = Connection(self, sock)
+            with self._lock:
+                self._connections.append(c)
+            for target in (c.read, c.write):
+                t = threading.Thread(target=target)
+                t.daemon = True
+                t.start()
+
+    def remove(self, connection):
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+
+    def route(self, topic, payload, qos):
+        self.received += 1
+        with self._lock:
+            connections = list(self._connections)
+        for c in connections:
+            granted = [q for f, q in list(c.filters.items()) if awsiot.topic_matches(f, topic)]
+            if len(granted) > 0:
+                if c.deliver(topic, payload, min(qos, max(granted))):
+                    self.routed += 1
+                else:
+                    self.dropped += 1
+
+
+class Publisher(object):
+    """Pipelined QoS 1 publishing client; acks are counted by a reader thread"""
+
+    def __init__(self, port, ca, host='localhost'):
+        context = ssl.create_default_context(cafile=ca)
+        self._sock = context.wrap_socket(socket.create_connection((host, port)), server_hostname=host)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock.sendall(packet(CONNECT, 0, encode_string('MQTT') + b'\x04\x02\x00\x3c' + encode_string('bench')))
+        if read_packet(self._sock)[0] != CONNACK:
+            raise IOError("no CONNACK")
+        self._packet_id = 0
+        self._lock = threading.Lock()
+        self.acked = 0
+        t = threading.Thread(target=self._read)
+        t.daemon = True
+        t.start()
+
+    def _read(self):
+        try:
+            while True:
+                if read_packet(self._sock)[0] == PUBACK:
+                    self.acked += 1
+        except (EOFError, socket.error, ssl.SSLError):
+            pass
+
+    def publish(self, topic, payload, qos=1):
+        with self._lock:
+            self._packet_id = self._packet_id % 65535 + 1
+            self._sock.sendall(publish_packet(topic, payload, qos, self._packet_id))
+
+    def close(self):
+        try:
+            self._sock.sendall(packet(DISCONNECT, 0, b''))
+        finally:
+            self._sock.close()
+
+
+if __name__ == "__main__":
+    import tempfile
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="listen port", type=int, default=8883)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    cert, key = make_certificate(directory)
+    Broker(cert, key, args.port).start()
+    print("broker listening on {} (root CA {})".format(args.port, cert))
+    while True:
+        time.sleep(1)
@@ -0,0 +1,31 @@
+"""Stand-in for the supervisor XML-RPC interface so supervisor_sub can be loaded and driven without supervisord"""
+
+import sys
+import types
+
+
+class Supervisor(object):
+    def getAllProcessInfo(self):
+        return [{'name': 'relay_sub', 'statename': 'RUNNING'}, {'name': 'pir_pub', 'statename': 'RUNNING'}]
+
+    def startProcess(self, name):
+        return True
+
+    def stopProcess(self, name):
+        return True
+
+
+class ServerProxy(object):
+    def __init__(self, *args, **kwargs):
+        self.supervisor = Supervisor()
+
+
+def install():
+    """Registers the fake supervisor xmlrpc modules"""
+    xmlrpclib = types.ModuleType('xmlrpclib')
+    xmlrpclib.ServerProxy = ServerProxy
+    supervisor = types.ModuleType('supervisor')
+    supervisor.xmlrpc = types.ModuleType('supervisor.xmlrpc')
+    supervisor.xmlrpc.SupervisorTransport = lambda *args, **kwargs: None
+    for module in (xmlrpclib, supervisor, supervisor.xmlrpc):
+        sys.modules[module.__name__] = module
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""Publish path benchmark for many simulated devices sharing one connection.
+
+Starts the local TLS broker stand-in and then loads each device script as often as requested, the
+way iot_daemon does. Every device uses the simulated hardware backend on its own pin, so each one
+replays its own trace. After --duration seconds the benchmark reports the messages the broker
+received, the process CPU time and the awsiot metrics, e.g. the publish ack latency.
+
+    python benchmarks/fleet.py pir_pub:200 dht_pub:50 --speed 60 --duration 30 -- --coalesce_ms 500
+
+Arguments after '--' are passed to every device.
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import awsiot
+import metrics
+import hardware
+import iot_daemon
+import broker
+
+# script: script args for the device on pin
+SCENARIOS = {
+    'pir_pub': lambda pin: ['-p', str(pin), '-s', 'motion'],
+    'input_pub': lambda pin: ['-p', str(pin), '-s', 'input'],
+    'dht_pub': lambda pin: ['-p', str(pin), '--interval', '2'],
+    'ultrasonic_distance_pub': lambda pin: ['--trigger_pin', str(pin), '--echo_pin', str(pin)],
+}
+
+
+def fleet(spec):
+    """Parses 'script:count'"""
+    script, _, count = spec.partition(':')
+    if script not in SCENARIOS:
+        raise argparse.ArgumentTypeError("no scenario for {}, choose from {}".format(script, sorted(SCENARIOS)))
+    return script, int(count or 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("devices", help="script:count, e.g. pir_pub:100", nargs='+', type=fleet)
+    parser.add_argument("--duration", help="seconds to run", type=float, default=30)
+    parser.add_argument("--speed", help="trace replay speed (1 is real time)", type=float, default=1)
+    parser.add_argument("--trace_dir", help="recorded traces (generated if not found)")
+    parser.add_argument("-l", "--log_level", help="Log Level", default=logging.WARNING)
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        argv, extra = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level, format=awsiot.LOG_FORMAT)
+
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    cert, key = broker.make_certificate(directory)
+    stand_in = broker.Broker(cert, key).start()
+
+    common = ['-e', 'localhost', '--port', str(stand_in.port), '-r', cert, '-c', cert, '-k', key,
+              '--hardware', hardware.SIM, '--speed', str(args.speed)]
+    if args.trace_dir is not None:
+        common += ['--trace_dir', os.path.abspath(args.trace_dir)]
+    mqtt = awsiot.mqtt_from_args(awsiot.iot_arg_parser().parse_args(common + extra))
+
+    modules = []
+    for script, count in args.devices:
+        for pin in range(count):
+            name = '{}_{}'.format(script, pin)
+            module = iot_daemon.load_script(name, os.path.join(iot_daemon.SCRIPT_DIR, '{}.py'.format(script)))
+            module.start(module.arg_parser().parse_args(
+                common + ['-t', 'fleet/{}/{}'.format(script, pin), '--thing', name] + SCENARIOS[script](pin) + extra),
+                mqtt)
+            modules.append(module)
+            if hasattr(module, 'run'):
+                t = threading.Thread(target=iot_daemon.run_device, args=(name, module), name=name)
+                t.daemon = True
+                t.start()
+
+    started = time.time()
+    cpu = os.times()
+    time.sleep(args.duration)
+    elapsed = time.time() - started
+    cpu = sum(os.times()[:2]) - sum(cpu[:2])
+    received = stand_in.received
+
+    print("{} devices, {:.0f} s at {}x: broker received {} messages ({:.1f} msg/s), cpu {:.1f} s ({:.0f}%), "
+          "{} threads".format(len(modules), elapsed, args.speed, received, received / elapsed, cpu,
+                              100 * cpu / elapsed, threading.active_count()))
+    summary = metrics.registry.summary()
+    for name in sorted(summary):
+        print("{:<32} {}".format(name, summary[name]))
+    for module in modules:
+        if hasattr(module, 'stop'):
+            module.stop()
+    mqtt.disconnect()
+    os._exit(0)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""Publish-to-handler latency and throughput benchmark for the subscriber scripts.
+
+Starts the local TLS broker stand-in, loads a subscriber script with simulated hardware on a real
+awsiot.MQTT client and publishes its commands at each requested rate. For every rate it reports
+publish-to-handler latency percentiles, handler run time, achieved throughput and dropped
+messages, then the highest rate sustained without drops within --max_p99.
+
+    python benchmarks/load.py relay_sub --rates 50 100 200 400 --duration 5 -- --workers 4
+
+Arguments after '--' are passed to the script (and so to awsiot.mqtt_from_args).
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import awsiot
+import hardware
+import iot_daemon
+import broker
+import fake_supervisor
+
+# script: (script args, handler functions to time, commands to publish)
+SCENARIOS = {
+    'relay_sub': (['-p', '17', '-d', '0'], ['on', 'off', 'pulse'], ['on', 'off', 'pulse']),
+    'output_sub': (['-p', '18'], ['on', 'off', 'pulse'], ['on', 'off', 'pulse/1']),
+    'supervisor_sub': ([], ['get_all_process_info', 'start_process', 'stop_process'],
+                       ['getAllProcessInfo', 'startProcess/bench', 'stopProcess/bench']),
+    'camera_sub': (['-s', 'bench'], ['archive', 'web_snapshot', 'archive_recording', 'workspace_snapshot'],
+                   ['snapshot', 'archive', 'recognize']),
+}
+SETTLE_TIME = 5  # seconds without progress before the remaining messages count as dropped
+
+_current = threading.local()
+
+
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latencies = []
+            self.durations = []
+            self.last = None
+
+    def record(self, latency, duration):
+        with self._lock:
+            self.latencies.append(latency)
+            self.durations.append(duration)
+            self.last = time.time()
+
+    @property
+    def handled(self):
+        return len(self.latencies)
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def instrument_router():
+    """Makes the send time carried in each payload visible to the handler it is routed to"""
+    callback = awsiot.TopicRouter.callback
+
+    def timed_callback(self, client, user_data, message):
+        _current.sent = json.loads(message.payload.decode('utf-8'))['t']
+        callback(self, client, user_data, message)
+
+    awsiot.TopicRouter.callback = timed_callback
+
+
+def instrument_handler(module, name, stats):
+    handler = getattr(module, name)
+
+    def timed(cmd, arg):
+        start = time.time()
+        handler(cmd, arg)
+        stats.record(start - _current.sent, time.time() - start)
+
+    setattr(module, name, timed)
+
+
+def run_rate(publisher, topics, rate, duration, stats):
+    stats.reset()
+    count = int(rate * duration)
+    start = time.time()
+    for i in range(count):
+        delay = start + i / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        publisher.publish(topics[i % len(topics)], json.dumps({'t': time.time(), 'seq': i}))
+    handled = -1
+    progress = time.time()
+    while stats.handled < count and time.time() - progress < SETTLE_TIME:
+        if stats.handled != handled:
+            handled = stats.handled
+            progress = time.time()
+        time.sleep(0.05)
+    elapsed = (stats.last or time.time()) - start
+    return {'rate': rate, 'sent': count, 'handled': stats.handled, 'dropped': count - stats.handled,
+            'p50': percentile(stats.latencies, 50) * 1000, 'p90': percentile(stats.latencies, 90) * 1000,
+            'p99': percentile(stats.latencies, 99) * 1000, 'max': percentile(stats.latencies, 100) * 1000,
+            'handler': percentile(stats.durations, 50) * 1000, 'throughput': stats.handled / elapsed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script", choices=sorted(SCENARIOS))
+    parser.add_argument("--rates", help="messages per second", nargs='*', type=float,
+                        default=[25, 50, 100, 200, 400, 800])
+    parser.add_argument("--duration", help="seconds per rate", type=float, default=5)
+    parser.add_argument("--max_p99", help="p99 latency (ms) still considered sustainable", type=float, default=100)
+    parser.add_argument("-l", "--log_level", help="Log Level", default=logging.WARNING)
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        argv, extra = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level, format=awsiot.LOG_FORMAT)
+
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    cert, key = broker.make_certificate(directory)
+    stand_in = broker.Broker(cert, key).start()
+
+    fake_supervisor.install()
+    instrument_router()
+    stats = Stats()
+    script_args, handlers, commands = SCENARIOS[args.script]
+    module = iot_daemon.load_script(args.script, os.path.join(iot_daemon.SCRIPT_DIR, '{}.py'.format(args.script)))
+    for name in handlers:
+        instrument_handler(module, name, stats)
+
+    topic = 'bench/{}'.format(args.script)
+    device_args = module.arg_parser().parse_args(
+        ['-e', 'localhost', '--port', str(stand_in.port), '-r', cert, '-c', cert, '-k', key, '-t', topic,
+         '--hardware', hardware.SIM] +
+        script_args + extra)
+    module.start(device_args, awsiot.mqtt_from_args(device_args))
+
+    publisher = broker.Publisher(stand_in.port, cert)
+    topics = ['{}/{}'.format(topic, c) for c in commands]
+    sustainable = None
+    print("{:>8} {:>7} {:>7} {:>7} {:>8} {:>8} {:>8} {:>8} {:>10} {:>9}".format(
+        'rate', 'sent', 'handled', 'dropped', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'handler ms', 'msg/s'))
+    for rate in args.rates:
+        r = run_rate(publisher, topics, rate, args.duration, stats)
+        print("{rate:>8.0f} {sent:>7} {handled:>7} {dropped:>7} {p50:>8.1f} {p90:>8.1f} {p99:>8.1f} {max:>8.1f} "
+              "{handler:>10.2f} {throughput:>9.1f}".format(**r))
+        if r['dropped'] == 0 and r['p99'] <= args.max_p99:
+            sustainable = rate
+    print("max sustainable rate: {} msg/s (broker routed {}, dropped {})".format(
+        sustainable, stand_in.routed, stand_in.dropped))
+    publisher.close()
+    os._exit(0)
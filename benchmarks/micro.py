@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""Microbenchmarks for the awsiot helpers on the per-message and per-reading path.
+
+Times topic_search, tokenizer, TopicRouter.route, iot_payload, iot_thing_topic, tagify,
+camel_case and the payload encodings across topic depths, subscribed topic counts and payload
+sizes, and reports the best time per call. Results can be saved as a baseline and later runs compared against it:
+
+    python benchmarks/micro.py --compare benchmarks/baselines/x86_64.json
+    python benchmarks/micro.py --save benchmarks/baselines/armv6l.json
+
+benchmarks/baselines/x86_64.json was recorded on an x86_64 development machine with Python 2.7, the
+interpreter the scripts run on. Timings only compare on the same kind of machine, so record a baseline
+on each target, e.g. a Pi Zero. A baseline keeps the Python version it was recorded with and --compare
+refuses a baseline from another major.minor version.
+
+With --compare the exit status is 1 if any case is slower than the baseline by more than
+--tolerance percent.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import awsiot
+import encoding
+
+TOPIC_DEPTHS = [2, 4, 8]
+TOPIC_COUNTS = [1, 4, 16]
+PAYLOAD_SIZES = [2, 20, 200]  # keys in the reported document
+LABEL_COUNTS = [5, 50]  # Rekognition labels passed to tagify
+REPEAT = 5
+MIN_TIME = 0.2  # seconds per repeat
+
+
+def cases():
+    """Returns [(name, fn)] for every benchmark case"""
+    result = []
+    for depth in TOPIC_DEPTHS:
+        topic = '/'.join('level{}'.format(i) for i in range(depth))
+        message = '{}/on'.format(topic)
+        result.append(('tokenizer/depth{}'.format(depth), lambda t=topic: awsiot.tokenizer(t, '/')))
+        for count in TOPIC_COUNTS:
+            topics = [topic] + ['{}{}'.format(topic, i) for i in range(1, count)]
+            router = awsiot.TopicRouter(topics)
+
+            def search(topics=topics, message=message):
+                for t in topics:
+                    awsiot.topic_search(t, message)
+
+            result.append(('topic_search/depth{}/topics{}'.format(depth, count), search))
+            result.append(('router.route/depth{}/topics{}'.format(depth, count),
+                           lambda r=router, m=message: r.route(m)))
+    for size in PAYLOAD_SIZES:
+        doc = dict(('sensor{}'.format(i), i * 1.5) for i in range(size))
+        result.append(('iot_payload/keys{}'.format(size), lambda d=doc: awsiot.iot_payload(awsiot.REPORTED, d)))
+    result.append(('iot_thing_topic', lambda: awsiot.iot_thing_topic('garage-pi')))
+    for count in LABEL_COUNTS:
+        labels = [{'Name': 'Label{}'.format(i), 'Confidence': 90.0} for i in range(count)]
+        result.append(('tagify/labels{}'.format(count), lambda l=labels: awsiot.tagify(l, 'Name')))
+    result.append(('camel_case', lambda: awsiot.camel_case('used disk space root')))
+    encoding.register_schema('bench', [('temperature', 10), ('humidity', 10)])
+    reading = {'temperature': 21.5, 'humidity': 48.7}
+    batch = awsiot.TelemetryBatcher.columns([(1500000000.0 + i, reading) for i in range(100)])
+    for name in encoding.names():
+        result.append(('encode/{}/reading'.format(name), lambda n=name: encoding.encode(reading, n)))
+        result.append(('encode/{}/schema'.format(name), lambda n=name: encoding.encode(reading, n, 'bench')))
+        result.append(('encode/{}/batch100'.format(name), lambda n=name: encoding.encode(batch, n)))
+        result.append(('encode/{}/batch100/schema'.format(name),
+                       lambda n=name: encoding.encode_columns(batch, n, 'bench')))
+    return result
+
+
+def measure(fn):
+    """Returns the best time per call in microseconds"""
+    number = 1
+    while True:
+        start = time.time()
+        for _ in range(number):
+            fn()
+        elapsed = time.time() - start
+        if elapsed >= MIN_TIME:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(MIN_TIME / elapsed) + 1)
+    best = elapsed
+    for _ in range(REPEAT - 1):
+        start = time.time()
+        for _ in range(number):
+            fn()
+        best = min(best, time.time() - start)
+    return best / number * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save", help="write results to this baseline file")
+    parser.add_argument("--compare", help="compare results with this baseline file")
+    parser.add_argument("--tolerance", help="percent slower than baseline reported as a regression", type=float,
+                        default=10.0)
+    parser.add_argument("-k", "--filter", help="only run cases whose name contains this")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            recorded = json.load(f)
+        python = recorded.get('python', 'unknown')
+        if python.split('.')[:2] != platform.python_version().split('.')[:2]:
+            print("{} was recorded with Python {}, not comparable with Python {}".format(
+                args.compare, python, platform.python_version()))
+            sys.exit(2)
+        baseline = recorded['results']
+
+    results = {}
+    regressions = 0
+    print("{:<36} {:>10} {:>10} {:>8}".format('case', 'us/call', 'baseline', 'change'))
+    for name, fn in cases():
+        if args.filter is not None and args.filter not in name:
+            continue
+        results[name] = measure(fn)
+        line = "{:<36} {:>10.2f}".format(name, results[name])
+        if name in baseline:
+            change = (results[name] - baseline[name]) / baseline[name] * 100.0
+            line += " {:>10.2f} {:>+7.1f}%".format(baseline[name], change)
+            if change > args.tolerance:
+                line += " SLOWER"
+                regressions += 1
+        print(line)
+
+    if args.save is not None:
+        directory = os.path.dirname(args.save)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.save, 'w') as f:
+            json.dump({'machine': platform.machine(), 'python': platform.python_version(),
+                       'created': awsiot.timestamp_string(), 'results': results}, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    if regressions > 0:
+        print("{} case(s) slower than baseline by more than {}%".format(regressions, args.tolerance))
+        sys.exit(1)
@@ -1,40 +1,116 @@
 #!/usr/bin/env python
 
-import json
 import awsiot
+import metrics
+import encoding
 import logging
-import Adafruit_DHT
+import sys
+import time
+import collections
+import hardware
 
-DHT11 = 11
-DHT22 = 22
-AM2302 = 22
-SENSORS = [DHT11, DHT22, AM2302]
+SENSORS = [hardware.DHT11, hardware.DHT22, hardware.AM2302]
+SCHEMA = encoding.DHT
+MIN_READ_INTERVAL = 2  # seconds, DHT22 sampling limit
+TEMPERATURE_RANGE = (-40, 80)  # Centigrade, readings outside are spurious
+HUMIDITY_RANGE = (0, 100)
 
 
 def pub(temp, humid):
     if args.topic is not None and len(args.topic) > 0:
         for t in args.topic:
-            publisher.publish(t,
-                              json.dumps({"temperature": temp, "humidity": humid,
-                                          awsiot.MESSAGE: "temperature: {} humidity: {}".format(temp, humid)}))
-    publisher.publish(awsiot.iot_thing_topic(args.thing),
-                      awsiot.iot_payload(awsiot.REPORTED, {'temperature': temp, 'humidity': humid}))
+            publisher.publish_reading(t, {"temperature": temp, "humidity": humid}, SCHEMA,
+                                      "temperature: {} humidity: {}".format(temp, humid))
+    publisher.report_shadow(args.thing, {'temperature': temp, 'humidity': humid})
 
 
-if __name__ == "__main__":
-    parser = awsiot.iot_arg_parser()
-    parser.add_argument("-p", "--pin", help="gpio pin (using BCM numbering)", type=int, required=True)
-    parser.add_argument("-y", "--dht_type", help="DHT sensor type %s" % SENSORS, type=int, default=Adafruit_DHT.DHT22)
-    args = parser.parse_args()
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
 
-    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
 
-    publisher = awsiot.MQTT(args.endpoint, args.rootCA, args.cert, args.key)
+def valid(temperature, humidity):
+    return humidity is not None and temperature is not None and \
+        TEMPERATURE_RANGE[0] <= temperature <= TEMPERATURE_RANGE[1] and \
+        HUMIDITY_RANGE[0] <= humidity <= HUMIDITY_RANGE[1]
+
 
-    humidity, temperature = Adafruit_DHT.read_retry(args.dht_type, args.pin)
+def report():
+    with metrics.timed('dht_read_seconds'):
+        humidity, temperature = hardware.dht_read_retry(args.dht_type, args.pin)
     if humidity is not None and temperature is not None:
         logging.info("DHT {} temperature {} humidity {}".format(args.pin, temperature, humidity))
         pub(temperature, humidity)
     else:
         logging.warn("Can't read temperature/humidity from DHT {}".format(args.pin))
-    publisher.disconnect()
\ No newline at end of file
+
+
+def arg_parser():
+    parser = awsiot.iot_arg_parser()
+    parser.add_argument("-p", "--pin", help="gpio pin (using BCM numbering)", type=int, required=True)
+    parser.add_argument("-y", "--dht_type", help="DHT sensor type %s" % SENSORS, type=int, default=hardware.DHT22)
+    parser.add_argument("--interval", help="keep running and sample every n seconds (0 reports once)", type=float,
+                        default=0)
+    parser.add_argument("--median_window", help="readings in the rolling median", type=int, default=5)
+    parser.add_argument("--temperature_deadband", help="temperature change (C) that is published", type=float,
+                        default=0.5)
+    parser.add_argument("--humidity_deadband", help="humidity change (%%) that is published", type=float,
+                        default=2.0)
+    parser.add_argument("--heartbeat", help="publish at least every n seconds", type=float, default=900)
+    return parser
+
+
+def start(a, client):
+    global args, publisher
+    args = a
+    publisher = client
+    hardware.configure(args)
+    if args.interval <= 0:
+        report()
+
+
+def run():
+    """Samples every interval seconds and publishes the rolling median of the valid samples when it
+    moves past a deadband or the heartbeat is due"""
+    if args.interval <= 0:
+        return
+    temperatures = collections.deque(maxlen=args.median_window)
+    humidities = collections.deque(maxlen=args.median_window)
+    last = None
+    last_time = 0
+    while True:
+        started = time.time()
+        with metrics.timed('dht_read_seconds'):
+            humidity, temperature = hardware.dht_read(args.dht_type, args.pin)  # one attempt, no retry sleeps
+        if valid(temperature, humidity):
+            temperatures.append(temperature)
+            humidities.append(humidity)
+            # a median over the window drops the DHT's occasional one-off spikes; until the window
+            # fills it is the median of the samples so far, so the first reading goes out at once
+            reading = (round(median(temperatures), 1), round(median(humidities), 1))
+            if last is None or time.time() - last_time >= args.heartbeat or \
+                    abs(reading[0] - last[0]) >= args.temperature_deadband or \
+                    abs(reading[1] - last[1]) >= args.humidity_deadband:
+                logging.info("DHT {} temperature {} humidity {}".format(args.pin, reading[0], reading[1]))
+                pub(reading[0], reading[1])
+                last = reading
+                last_time = time.time()
+        else:
+            metrics.registry.increment('dht_bad_reads')
+            logging.debug("DHT {} bad read {} {}".format(args.pin, temperature, humidity))
+        time.sleep(max(MIN_READ_INTERVAL, args.interval - (time.time() - started)))
+
+
+if __name__ == "__main__":
+    args = arg_parser().parse_args()
+
+    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
+
+    start(args, awsiot.mqtt_from_args(args))
+
+    try:
+        run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    publisher.disconnect()
+    sys.exit()
@@ -1,84 +1,96 @@
 #!/usr/bin/env python
 
 import awsiot
+import metrics
 import logging
 import sys
 import time
-import RPi.GPIO as GPIO
-import numpy as np
+import ultrasonic
+import filters
+import hardware
 
+FRESH = 'fresh'  # command argument that skips the sampled readings
 
-def get_distance(trigger, echo, iterations=5, time_between_iterations=1, rounding_digits=2):
+
+def get_distance(iterations=5, fresh=False, rounding_digits=2):
+    """Returns the median of the sampled readings, or of iterations new pings if fresh or none are recent"""
     results = []
-    for i in range(iterations):
-        GPIO.output(trigger, False)
-        time.sleep(0.05)
-        GPIO.output(trigger, True)
-        time.sleep(0.02)
-        GPIO.output(trigger, False)
-        start_time = time.time()
-        stop_time = time.time()
-        while GPIO.input(echo) == 0:
-            start_time = time.time()
-        while GPIO.input(echo) == 1:
-            stop_time = time.time()
-        time_lapsed = stop_time - start_time
-        val = (time_lapsed * 34300) / 2
-        logging.info('measured distance {} cm'.format(val))
-        results.append(val)
-        time.sleep(time_between_iterations)
+    if sampler is not None and not fresh:
+        results = sampler.readings(args.max_age)
     if len(results) == 0:
+        metrics.registry.increment('distance_fresh_reads')
+        results = sensor.pings(iterations)
+    logging.info('measured distances {} cm'.format(results))
+    distance = filters.robust_median(results)
+    if distance is None:
         return None
-    return round(np.median(results), rounding_digits)
+    return round(distance, rounding_digits)
 
 
-def callback(client, user_data, message):
-    logging.debug("received {} {}".format(message.topic, message))
-    distance = get_distance(args.trigger_pin, args.echo_pin, args.iterations)
+def measure(cmd, arg):
+    with metrics.timed('distance_read_seconds'):
+        distance = get_distance(args.iterations, arg == FRESH)
     logging.info('median distance {} cm'.format(distance))
     if distance:
-        for topic in args.topic:
-            if args.min_value <= distance <= args.max_value:
-                if awsiot.topic_search(topic, message.topic):
-                    mqtt.publish(awsiot.iot_thing_topic(args.thing),
-                                 awsiot.iot_payload(awsiot.REPORTED, {'distance': distance}))
-                else:
-                    logging.warning('Unrecognized command')
-            else:
-                logging.warning(
-                    'calculated distance ({} cm) outside range {} - {}'.format(distance, args.min_value, args.max_value))
+        if args.min_value <= distance <= args.max_value:
+            mqtt.report_shadow(args.thing, {'distance': distance})
+        else:
+            logging.warning(
+                'calculated distance ({} cm) outside range {} - {}'.format(distance, args.min_value, args.max_value))
     else:
         logging.error('unable to calculate distance')
 
 
-if __name__ == "__main__":
+def arg_parser():
     parser = awsiot.iot_arg_parser()
     parser.add_argument("--trigger_pin", help="trigger gpio pin (using BCM numbering)", type=int, required=True)
     parser.add_argument("--echo_pin", help="echo gpio pin (using BCM numbering)", type=int, required=True)
     parser.add_argument("--iterations", help="number of iterations to determine median value", type=int, default=5)
     parser.add_argument("--max_value", help="max distance", type=float, default=400.0)
+    parser.add_argument("--sample_interval", help="seconds between background readings (0 measures on request)",
+                        type=float, default=ultrasonic.SAMPLE_INTERVAL)
+    parser.add_argument("--window", help="background readings kept", type=int, default=ultrasonic.SAMPLE_WINDOW)
+    parser.add_argument("--max_age", help="answer from background readings up to n seconds old", type=float,
+                        default=5)
     parser.add_argument("--min_value", help="min distance", type=float, default=2.0)
-    args = parser.parse_args()
+    return parser
 
-    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
+
+def start(a, client):
+    global args, mqtt, sensor, sampler
+    args = a
+    mqtt = client
 
     # initialize hardware
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(args.trigger_pin, GPIO.OUT)
-    GPIO.setup(args.echo_pin, GPIO.IN)
+    hardware.configure(args)
+    hardware.gpio_setup()
+    sensor = hardware.Ultrasonic(args.trigger_pin, args.echo_pin)
+    sampler = None
+    if args.sample_interval > 0:
+        sampler = ultrasonic.Sampler(sensor, args.sample_interval, args.window)
+
+    router = awsiot.TopicRouter(args.topic, default=measure)
+    mqtt.subscribe_router(router)
+
 
-    # initialize iot
-    mqtt = awsiot.MQTT(args.endpoint, args.rootCA, args.cert, args.key)
+def stop():
+    if sampler is not None:
+        sampler.stop()
+    sensor.close()
+    hardware.gpio_cleanup()
+
+
+if __name__ == "__main__":
+    args = arg_parser().parse_args()
+
+    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
 
-    if args.topic is not None and len(args.topic) > 0:
-        for t in args.topic:
-            mqtt.subscribe('{}/#'.format(t.split('/').pop(0)), callback)
-            time.sleep(2)  # pause
+    start(args, awsiot.mqtt_from_args(args))
 
     # Loop forever
     try:
         while True:
             time.sleep(0.5)  # sleep needed because CPU race
     except (KeyboardInterrupt, SystemExit):
-        GPIO.cleanup()
+        stop()
         sys.exit()
@@ -1,42 +1,121 @@
 #!/usr/bin/env python
 
-import json
 import awsiot
+import metrics
 import logging
-import platform
+import sys
+import time
+import threading
 import psutil
-import subprocess as sp
 
+THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+ONE_SHOT_CPU_INTERVAL = 0.1  # seconds cpu load is measured over when there is no earlier sample
 
-def os_execute(s):
-    """Returns string result of os call"""
+
+def get_cpu_temperature():
+    """Returns cpu temperature in Centigrade, None if the kernel doesn't report one"""
     try:
-        return sp.check_output(s.split()).rstrip('\n')
-    except Exception as ex:
+        with open(THERMAL_ZONE) as f:
+            return int(f.read()) / 1000.0
+    except (IOError, ValueError):
         return None
 
 
-def get_rpi_cpu_temperature():
-    """Returns raspberry pi cpu temperature in Centigrade"""
-    temp = os_execute('/opt/vc/bin/vcgencmd measure_temp')
-    return float(temp.split('=')[1].strip('\'C'))
+def sample(cpu_interval=None):
+    """Returns current readings; cpu load covers the time since the last sample unless cpu_interval is set"""
+    mem = psutil.virtual_memory()
+    s = {"ramAvailable": int(mem.available / (1024 * 1024)), "cpuLoad": psutil.cpu_percent(interval=cpu_interval)}
+    temp = get_cpu_temperature()
+    if temp is not None:
+        s["cpuTemp"] = temp
+    return s
 
 
-if __name__ == "__main__":
+def add_sample(s):
+    with samples_lock:
+        for k, v in s.items():
+            samples.setdefault(k, []).append(v)
+
+
+def significant_change(s):
+    """Returns True if a reading in s moved past its change threshold since the last report"""
+    for k, threshold in (("cpuLoad", args.cpu_change), ("cpuTemp", args.temp_change),
+                         ("ramAvailable", args.ram_change)):
+        if k in s and k in last_reported and abs(s[k] - last_reported[k]) >= threshold:
+            return True
+    return False
+
+
+def report():
+    global samples
+    # run() keeps sampling on its own thread while iot_daemon calls report() on the scheduler thread
+    with samples_lock:
+        taken, samples = samples, {}
+    if len(taken) == 0:
+        taken = dict((k, [v]) for k, v in sample().items())
+    properties = {}
+    for k, values in taken.items():
+        properties[k] = round(sum(values) / float(len(values)), 1)
+        if args.interval > 0:
+            properties[k + "Min"] = min(values)
+            properties[k + "Max"] = max(values)
+    properties["ramAvailable"] = int(properties["ramAvailable"])
+    properties["usedDiskSpaceRoot"] = int(psutil.disk_usage('/').used / (1024 * 1024))
+    last_reported.update(properties)
+
+    publisher.report_shadow(args.thing, properties)
+
+
+def arg_parser():
     parser = awsiot.iot_arg_parser()
-    args = parser.parse_args()
+    parser.add_argument("--interval", help="keep running and report every n seconds (0 reports once)", type=float,
+                        default=0)
+    parser.add_argument("--sample_interval", help="seconds between samples", type=float, default=5)
+    parser.add_argument("--cpu_change", help="cpu load change (%%) reported at once", type=float, default=50)
+    parser.add_argument("--temp_change", help="cpu temperature change (C) reported at once", type=float, default=5)
+    parser.add_argument("--ram_change", help="available RAM change (MB) reported at once", type=float, default=100)
+    return parser
+
+
+def start(a, client):
+    global args, publisher, samples, samples_lock, last_reported
+    args = a
+    publisher = client
+    samples = {}
+    samples_lock = threading.Lock()
+    last_reported = {}
+    if args.interval <= 0:
+        # nothing to measure the cpu load from yet, so a short measurement; later reports use the load since it
+        add_sample(sample(ONE_SHOT_CPU_INTERVAL))
+        report()
+    else:
+        psutil.cpu_percent(interval=None)  # starts the non-blocking cpu load measurement
+
+
+def run():
+    if args.interval <= 0:
+        return
+    next_report = time.time() + args.interval
+    while True:
+        time.sleep(args.sample_interval)
+        with metrics.timed('host_sample_seconds'):
+            s = sample()
+        add_sample(s)
+        if time.time() >= next_report or significant_change(s):
+            report()
+            next_report = time.time() + args.interval
+
+
+if __name__ == "__main__":
+    args = arg_parser().parse_args()
 
     logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
 
-    publisher = awsiot.MQTT(args.endpoint, args.rootCA, args.cert, args.key)
+    start(args, awsiot.mqtt_from_args(args))
 
-    properties = {}
-    mem = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
-    if platform.machine().startswith('arm') and platform.system() == 'Linux':  # raspberry pi
-        properties["cpuTemp"] = get_rpi_cpu_temperature()
-    properties["ramAvailable"] = int(mem.available / (1024 * 1024))
-    properties["usedDiskSpaceRoot"] = int(disk.used / (1024 * 1024))
-    properties["cpuLoad"] = psutil.cpu_percent(interval=3)
-
-    publisher.publish(awsiot.iot_thing_topic(args.thing), awsiot.iot_payload(awsiot.REPORTED, properties))
+    try:
+        run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    publisher.disconnect()
+    sys.exit()
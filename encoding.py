@@ -0,0 +1,375 @@
+"""Payload encoders for non-shadow topics, selected by name, with an optional fixed schema per sensor.
+
+The encoding is named by a trailing topic level so subscribers can decode without configuration:
+'home/garage/distance/$cbor' is CBOR, '$cbor:distance' is CBOR with the 'distance' schema, and a
+topic without the level is plain JSON. A schema sends a document as the array of its field values
+in schema order, leaving the field names off the wire, and sends fields with a scale as fixed-point
+integers, e.g. 22.3 with scale 10 as 223, so sensor readings take one to three bytes.
+
+Payloads are what the SDK publishes: a str for JSON and a bytearray for the binary encodings. CBOR
+and msgpack are smaller than JSON; they are also quicker to encode only with a C codec. CBOR is
+encoded by cbor2's C extension when it is installed (Python 3), otherwise in pure Python, which is
+slower than the json module's C encoder and so a payload size option only. msgpack is always C.
+"""
+
+import json
+import struct
+import numbers
+import threading
+
+JSON = 'json'
+CBOR = 'cbor'
+MSGPACK = 'msgpack'
+HINT_PREFIX = '$'
+SCHEMA_SEPARATOR = ':'
+DHT = 'dht'  # dht_pub readings
+DISTANCE = 'distance'  # ultrasonic_distance_pub readings
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+try:
+    struct.pack('>e', 1.0)
+    _half_precision = True
+except struct.error:  # Python < 3.6
+    _half_precision = False
+
+_encoders = {}
+_schemas = {}
+
+
+def register(name, encode, decode):
+    """Adds an encoding: encode(doc) returns the payload as a str or bytearray, decode(payload) returns the doc"""
+    _encoders[name] = (encode, decode)
+
+
+def names():
+    return sorted(_encoders)
+
+
+def register_schema(name, fields):
+    """Registers the fixed field order used to encode documents with schema name. A field is a name,
+    or (name, scale) to send its value as the integer value * scale, e.g. ('temperature', 10)"""
+    _schemas[name] = [(f, None) if isinstance(f, (str, text_type)) else tuple(f) for f in fields]
+
+
+def _scale(v, scale):
+    if scale is None or v is None or v is True or v is False:
+        return v
+    return int(round(v * scale))
+
+
+def _unscale(v, scale):
+    if scale is None or v is None:
+        return v
+    return v / float(scale)
+
+
+def encode(doc, encoding=JSON, schema=None):
+    if schema is not None:
+        doc = [_scale(doc.get(f), scale) for f, scale in _schemas[schema]]
+    return _encoders[encoding][0](doc)
+
+
+def encode_columns(doc, encoding=JSON, schema=None):
+    """Encodes a columnar batch {field: [values]}; schema scales the columns of its fields, the names stay"""
+    if schema is not None:
+        doc = dict(doc)
+        for f, scale in _schemas[schema]:
+            if scale is not None and f in doc:
+                doc[f] = [None if v is None else int(round(v * scale)) for v in doc[f]]
+    return _encoders[encoding][0](doc)
+
+
+def decode(payload, encoding=JSON, schema=None):
+    """Returns the document in payload; with schema, an array is a document and a map a columnar batch"""
+    doc = _encoders[encoding][1](payload)
+    if schema is not None:
+        if schema not in _schemas:
+            raise ValueError("unknown schema {}".format(schema))
+        if isinstance(doc, dict):
+            for f, scale in _schemas[schema]:
+                if scale is not None and f in doc:
+                    doc[f] = [_unscale(v, scale) for v in doc[f]]
+        else:
+            doc = dict((f, _unscale(v, scale)) for (f, scale), v in zip(_schemas[schema], doc))
+    return doc
+
+
+def hint_topic(topic, encoding=JSON, schema=None):
+    """Returns topic with the encoding level appended; plain JSON topics are unchanged"""
+    if encoding == JSON and schema is None:
+        return topic
+    hint = encoding if schema is None else encoding + SCHEMA_SEPARATOR + schema
+    return '{}/{}{}'.format(topic, HINT_PREFIX, hint)
+
+
+def split_topic(topic):
+    """Returns (topic without the encoding level, encoding, schema)"""
+    base, _, last = topic.rpartition('/')
+    if last.startswith(HINT_PREFIX):
+        encoding, _, schema = last[len(HINT_PREFIX):].partition(SCHEMA_SEPARATOR)
+        if encoding in _encoders:
+            return base, encoding, schema or None
+    return topic, JSON, None
+
+
+def decode_message(topic, payload):
+    """Returns (topic without the encoding level, decoded payload) for a received message"""
+    topic, encoding, schema = split_topic(topic)
+    return topic, decode(payload, encoding, schema)
+
+
+def _json_encode(doc):
+    return json.dumps(doc, separators=(',', ':'))
+
+
+def _json_decode(payload):
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    return json.loads(payload)
+
+
+_small_heads = [[struct.pack('>B', major << 5 | n) for n in range(24)] for major in range(8)]
+_head8 = struct.Struct('>BB')
+_head16 = struct.Struct('>BH')
+_head32 = struct.Struct('>BI')
+_head64 = struct.Struct('>BQ')
+_single = struct.Struct('>f')
+_double = struct.Struct('>d')
+if _half_precision:
+    _half = struct.Struct('>e')
+
+
+def _cbor_head(major, n):
+    if n < 24:
+        return _small_heads[major][n]
+    elif n < 0x100:
+        return _head8.pack(major << 5 | 24, n)
+    elif n < 0x10000:
+        return _head16.pack(major << 5 | 25, n)
+    elif n < 0x100000000:
+        return _head32.pack(major << 5 | 26, n)
+    return _head64.pack(major << 5 | 27, n)
+
+
+def _cbor_float(v):
+    """Returns v in the smallest of half, single or double precision that holds it exactly"""
+    if _half_precision:
+        try:
+            half = _half.pack(v)
+            if _half.unpack(half)[0] == v:
+                return b'\xf9' + half
+        except OverflowError:
+            pass
+    try:
+        single = _single.pack(v)
+        if _single.unpack(single)[0] == v:
+            return b'\xfa' + single
+    except OverflowError:
+        pass
+    return b'\xfb' + _double.pack(v)
+
+
+def _cbor_none(v, out):
+    out.append(b'\xf6')
+
+
+def _cbor_bool(v, out):
+    out.append(b'\xf5' if v else b'\xf4')
+
+
+def _cbor_int(v, out):
+    out.append(_cbor_head(0, v) if v >= 0 else _cbor_head(1, -1 - v))
+
+
+def _cbor_float_item(v, out):
+    out.append(_cbor_float(v))
+
+
+def _cbor_bytes(v, out):
+    out.append(_cbor_head(2, len(v)))
+    out.append(bytes(v))
+
+
+def _cbor_text(v, out):
+    data = v.encode('utf-8') if isinstance(v, text_type) else v
+    out.append(_cbor_head(3, len(data)))
+    out.append(data)
+
+
+def _cbor_array(v, out):
+    out.append(_cbor_head(4, len(v)))
+    for i in v:
+        _cbor_encode_item(i, out)
+
+
+def _cbor_map(v, out):
+    out.append(_cbor_head(5, len(v)))
+    for k, i in v.items():
+        _cbor_encode_item(k, out)
+        _cbor_encode_item(i, out)
+
+
+def _cbor_item_encoder(v):
+    """Returns the encoder for a type missing from _cbor_item_encoders, e.g. a subclass"""
+    if isinstance(v, bool):
+        return _cbor_bool
+    elif isinstance(v, numbers.Integral):
+        return _cbor_int
+    elif isinstance(v, float):
+        return _cbor_float_item
+    elif isinstance(v, bytearray) or (bytes is not str and isinstance(v, bytes)):
+        return _cbor_bytes
+    elif isinstance(v, (str, text_type)):
+        return _cbor_text
+    elif isinstance(v, (list, tuple)):
+        return _cbor_array
+    elif isinstance(v, dict):
+        return _cbor_map
+    raise TypeError("can't encode {} as CBOR".format(type(v)))
+
+
+# looked up by exact type, which is much quicker per item than a chain of isinstance checks
+_cbor_item_encoders = {type(None): _cbor_none, bool: _cbor_bool, int: _cbor_int, float: _cbor_float_item,
+                       bytearray: _cbor_bytes, str: _cbor_text, text_type: _cbor_text, list: _cbor_array,
+                       tuple: _cbor_array, dict: _cbor_map}
+if bytes is not str:
+    _cbor_item_encoders[bytes] = _cbor_bytes
+try:
+    _cbor_item_encoders[long] = _cbor_int
+except NameError:  # Python 3
+    pass
+
+
+def _cbor_encode_item(v, out):
+    encoder = _cbor_item_encoders.get(type(v))
+    if encoder is None:
+        encoder = _cbor_item_encoder(v)
+    encoder(v, out)
+
+
+def _py_cbor_encode(doc):
+    out = []
+    _cbor_encode_item(doc, out)
+    return bytearray(b''.join(out))
+
+
+try:
+    import cbor2
+
+    _c_cbor = cbor2.dumps.__module__.endswith('_cbor2')  # the C extension, not cbor2's Python fallback
+except ImportError:
+    _c_cbor = False
+
+
+def cbor_encode(doc):
+    """Encodes doc as CBOR (RFC 7049) with definite lengths and the smallest integer and float sizes"""
+    if _c_cbor:
+        return bytearray(cbor2.dumps(doc, canonical=True))  # canonical picks the smallest exact float
+    return _py_cbor_encode(doc)
+
+
+def _half_to_float(h):
+    exponent = (h >> 10) & 0x1f
+    fraction = h & 0x3ff
+    if exponent == 0:
+        value = fraction * 2.0 ** -24
+    elif exponent == 0x1f:
+        value = float('nan') if fraction else float('inf')
+    else:
+        value = (fraction + 1024) * 2.0 ** (exponent - 25)
+    return -value if h & 0x8000 else value
+
+
+def _cbor_decode_item(data, i):
+    initial = data[i]
+    major = initial >> 5
+    info = initial & 0x1f
+    i += 1
+    if major == 7:
+        if info == 20:
+            return False, i
+        elif info == 21:
+            return True, i
+        elif info in (22, 23):
+            return None, i
+        elif info == 25:
+            return _half_to_float(struct.unpack('>H', bytes(data[i:i + 2]))[0]), i + 2
+        elif info == 26:
+            return struct.unpack('>f', bytes(data[i:i + 4]))[0], i + 4
+        elif info == 27:
+            return struct.unpack('>d', bytes(data[i:i + 8]))[0], i + 8
+        raise ValueError("unsupported CBOR simple value {}".format(info))
+    if info < 24:
+        n = info
+    elif info == 24:
+        n = data[i]
+        i += 1
+    elif info == 25:
+        n = struct.unpack('>H', bytes(data[i:i + 2]))[0]
+        i += 2
+    elif info == 26:
+        n = struct.unpack('>I', bytes(data[i:i + 4]))[0]
+        i += 4
+    elif info == 27:
+        n = struct.unpack('>Q', bytes(data[i:i + 8]))[0]
+        i += 8
+    else:
+        raise ValueError("unsupported CBOR length {}".format(info))
+    if major == 0:
+        return n, i
+    elif major == 1:
+        return -1 - n, i
+    elif major == 2:
+        return bytes(data[i:i + n]), i + n
+    elif major == 3:
+        return bytes(data[i:i + n]).decode('utf-8'), i + n
+    elif major == 4:
+        items = []
+        for _ in range(n):
+            item, i = _cbor_decode_item(data, i)
+            items.append(item)
+        return items, i
+    elif major == 5:
+        doc = {}
+        for _ in range(n):
+            k, i = _cbor_decode_item(data, i)
+            doc[k], i = _cbor_decode_item(data, i)
+        return doc, i
+    return _cbor_decode_item(data, i)  # tag: the tagged item
+
+
+def cbor_decode(payload):
+    data = bytearray(payload)
+    doc, i = _cbor_decode_item(data, 0)
+    if i != len(data):
+        raise ValueError("{} bytes after CBOR item".format(len(data) - i))
+    return doc
+
+
+register(JSON, _json_encode, _json_decode)
+register(CBOR, cbor_encode, cbor_decode)
+register_schema(DHT, [('temperature', 10), ('humidity', 10)])  # DHT22 resolution 0.1
+register_schema(DISTANCE, [('distance', 10)])  # published to 0.1 cm
+
+try:
+    import msgpack
+
+    try:
+        from msgpack._cmsgpack import Packer  # the C extension
+    except ImportError:
+        Packer = msgpack.Packer
+    _packers = threading.local()  # a Packer reuses its buffer, so one per thread
+
+    def msgpack_encode(doc):
+        packer = getattr(_packers, 'packer', None)
+        if packer is None:
+            packer = _packers.packer = Packer(use_bin_type=True)
+        return bytearray(packer.pack(doc))
+
+    register(MSGPACK, msgpack_encode, lambda payload: msgpack.unpackb(payload, raw=False))
+except ImportError:
+    pass
@@ -0,0 +1,128 @@
+"""Smoothing and outlier rejection for noisy sensor readings such as ultrasonic distances.
+
+Readings are kept in preallocated NumPy ring buffers, so a filter allocates nothing per sample
+beyond NumPy's own temporaries. Outliers are judged by their modified z-score against the median
+absolute deviation (MAD) of the window, which a few spurious echoes cannot drag along the way they
+drag a mean. Every raw reading enters the window, so a real change of level is accepted once it
+makes up half of the window.
+"""
+
+import math
+import numpy as np
+
+WINDOW = 9
+MEDIAN = 'median'
+EMA = 'ema'
+KALMAN = 'kalman'
+METHODS = [MEDIAN, EMA, KALMAN]
+EMA_ALPHA = 0.3
+MAD_THRESHOLD = 3.5  # modified z-score above which a reading is an outlier (Iglewicz and Hoaglin)
+MAD_SCALE = 0.6745  # makes the MAD of normally distributed readings comparable to a standard deviation
+MIN_DEVIATION = 0.5  # noise floor for the MAD, in reading units, so a perfectly steady window isn't too strict
+MIN_READINGS = 3  # readings in the window before outliers are judged
+KALMAN_PROCESS_VARIANCE = 0.5
+KALMAN_MEASUREMENT_VARIANCE = 4.0
+
+
+def speed_of_sound(temperature):
+    """Returns the speed of sound in cm/s in dry air at temperature Centigrade"""
+    return 33130.0 * math.sqrt(1 + temperature / 273.15)
+
+
+def inliers(values, threshold=MAD_THRESHOLD, min_deviation=MIN_DEVIATION):
+    """Returns the boolean mask of values within threshold modified z-scores of their median"""
+    values = np.asarray(values, dtype=float)
+    median = np.median(values)
+    deviation = np.abs(values - median)
+    mad = max(np.median(deviation), min_deviation)
+    return MAD_SCALE * deviation / mad <= threshold
+
+
+def robust_median(values, threshold=MAD_THRESHOLD, min_deviation=MIN_DEVIATION):
+    """Returns the median of values after dropping outliers, None if there are no values"""
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return None
+    if len(values) >= MIN_READINGS:
+        values = values[inliers(values, threshold, min_deviation)]
+    return float(np.median(values))
+
+
+class RingBuffer(object):
+    """Fixed-size window of floats in a preallocated array"""
+
+    def __init__(self, size):
+        self._data = np.empty(size, dtype=float)
+        self._next = 0
+        self._count = 0
+
+    def append(self, value):
+        self._data[self._next] = value
+        self._next = (self._next + 1) % len(self._data)
+        self._count = min(self._count + 1, len(self._data))
+
+    def __len__(self):
+        return self._count
+
+    def window(self):
+        """Returns a view of the values held, in storage order; appends write into it"""
+        return self._data[:self._count]
+
+
+class Kalman1D(object):
+    """Kalman filter for a slowly changing scalar observed with noise"""
+
+    def __init__(self, process_variance=KALMAN_PROCESS_VARIANCE, measurement_variance=KALMAN_MEASUREMENT_VARIANCE):
+        self.q = process_variance
+        self.r = measurement_variance
+        self.x = None
+        self.p = measurement_variance
+
+    def update(self, z):
+        if self.x is None:
+            self.x = float(z)
+            return self.x
+        p = self.p + self.q
+        k = p / (p + self.r)
+        self.x += k * (z - self.x)
+        self.p = (1 - k) * p
+        return self.x
+
+
+class Filter(object):
+    """Rolling filter: rejects MAD outliers over the last size readings and smooths the rest
+    by rolling median, exponential moving average or Kalman filter."""
+
+    def __init__(self, size=WINDOW, method=MEDIAN, alpha=EMA_ALPHA, threshold=MAD_THRESHOLD,
+                 min_deviation=MIN_DEVIATION, kalman=None):
+        if method not in METHODS:
+            raise ValueError("unknown filter method {}".format(method))
+        self.method = method
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_deviation = min_deviation
+        self._buffer = RingBuffer(size)
+        self._ema = None
+        self._kalman = kalman if kalman is not None else Kalman1D()
+
+    def is_outlier(self, value):
+        if len(self._buffer) < MIN_READINGS:
+            return False
+        window = self._buffer.window()
+        median = np.median(window)
+        mad = max(np.median(np.abs(window - median)), self.min_deviation)
+        return MAD_SCALE * abs(value - median) / mad > self.threshold
+
+    def update(self, value):
+        """Adds a reading and returns the filtered value, None if the reading is an outlier"""
+        value = float(value)
+        outlier = self.is_outlier(value)
+        self._buffer.append(value)
+        if outlier:
+            return None
+        if self.method == EMA:
+            self._ema = value if self._ema is None else self.alpha * value + (1 - self.alpha) * self._ema
+            return self._ema
+        elif self.method == KALMAN:
+            return self._kalman.update(value)
+        return float(np.median(self._buffer.window()))
@@ -0,0 +1,428 @@
+"""Raspberry Pi devices behind one interface, with simulated stand-ins that replay recorded traces.
+
+Device scripts create their devices here instead of importing gpiozero, RPi.GPIO, Adafruit_DHT and
+picamera. The 'pi' backend hands out the real devices. The 'sim' backend needs none of those
+libraries: every device replays a trace, so many virtual devices can run in one process on any box.
+
+A trace is a text file of lines 'seconds value [value ...]', comma or whitespace separated, with
+seconds counted from the start of the recording, '#' comments and 'nan' for a failed reading. For a
+device of kind k on pin p the trace directory is searched for 'k_p.trace' and then 'k.trace':
+
+    button, motion  state 0 or 1
+    dht             temperature (C) and humidity (%)
+    distance        distance (cm) at the speed of sound at 20C, keyed by the trigger pin
+
+A device with no trace file replays a generated one. Traces loop, and they play at speed times real
+time. The simulated camera writes the files in '<trace dir>/camera' in turn, or a minimal JPEG.
+"""
+
+import os
+import math
+import time
+import heapq
+import bisect
+import random
+import shutil
+import logging
+import itertools
+import threading
+import collections
+
+PI = 'pi'
+SIM = 'sim'
+BACKENDS = [PI, SIM]
+DHT11 = 11
+DHT22 = 22
+AM2302 = 22
+DHT_RETRIES = 15
+DHT_RETRY_DELAY = 2  # seconds
+TRACE_LENGTH = 600  # records in a generated trace
+JPEG = b'\xff\xd8\xff\xd9'
+PiInfo = collections.namedtuple('PiInfo', ['model', 'pcb_revision'])
+SIMULATED_PI = PiInfo('3B+', '1.3')
+
+backend = os.environ.get('IOT_HARDWARE', PI)
+trace_dir = os.environ.get('IOT_TRACE_DIR')
+speed = float(os.environ.get('IOT_SPEED', 1))
+
+
+def configure(args):
+    """Selects the backend, trace directory and replay speed from the --hardware, --trace_dir and --speed args"""
+    global backend, trace_dir, speed
+    if args.hardware not in BACKENDS:
+        raise ValueError("unknown hardware backend {}".format(args.hardware))
+    if args.speed <= 0:
+        raise ValueError("replay speed must be positive")
+    backend = args.hardware
+    trace_dir = args.trace_dir
+    speed = args.speed
+
+
+def simulated():
+    return backend == SIM
+
+
+class Scheduler(object):
+    """Fires the timed events of all simulated devices from a single thread"""
+
+    def __init__(self):
+        self._events = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def call_at(self, when, fn):
+        with self._condition:
+            heapq.heappush(self._events, (when, next(self._sequence), fn))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='hardware-sim')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._events) == 0:
+                    self._condition.wait()
+                delay = self._events[0][0] - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                fn = heapq.heappop(self._events)[2]
+            try:
+                fn()
+            except Exception as e:
+                logging.exception("simulated device event failed: {}".format(e))
+
+
+scheduler = Scheduler()
+
+
+def read_trace(path):
+    """Returns the (seconds, values) records of a trace file in time order"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].replace(',', ' ').split()
+            if len(fields) > 1:
+                records.append((float(fields[0]), tuple(float(v) for v in fields[1:])))
+    if len(records) == 0:
+        raise ValueError("empty trace {}".format(path))
+    return sorted(records, key=lambda r: r[0])
+
+
+def generate_trace(kind, pin):
+    """Returns a plausible trace for a device without a recording, the same for every run"""
+    rng = random.Random('{}_{}'.format(kind, pin))
+    records = []
+    t = 0.0
+    for i in range(TRACE_LENGTH):
+        if kind in ('button', 'motion'):
+            active = i % 2 == 0
+            records.append((t, (1.0 if active else 0.0,)))
+            # short presses or motion, then longer idle spells; the odd contact bounce in between
+            t += rng.choice([0.002, rng.uniform(1, 10)]) if active else rng.uniform(10, 60)
+        elif kind == 'dht':
+            if rng.random() < 0.03:
+                records.append((t, (float('nan'), float('nan'))))
+            else:
+                phase = 2 * math.pi * t / 3600
+                records.append((t, (round(21 + 2 * math.sin(phase) + rng.gauss(0, 0.1), 1),
+                                    round(45 - 5 * math.sin(phase) + rng.gauss(0, 0.5), 1))))
+            t += 2
+        elif kind == 'distance':
+            r = rng.random()
+            if r < 0.01:
+                records.append((t, (float('nan'),)))
+            elif r < 0.03:
+                records.append((t, (rng.uniform(2, 400),)))
+            else:
+                records.append((t, (100 + 20 * math.sin(2 * math.pi * t / 60) + rng.gauss(0, 0.5),)))
+            t += 0.1
+        else:
+            raise ValueError("no generated trace for {}".format(kind))
+    return records
+
+
+class Trace(object):
+    """A trace replayed in a loop from the time it is created"""
+
+    def __init__(self, records):
+        self.times = [r[0] for r in records]
+        self.values = [r[1] for r in records]
+        gap = (self.times[-1] - self.times[0]) / (len(records) - 1) if len(records) > 1 else 1
+        self.duration = self.times[-1] + gap  # the last record holds for a typical gap before the loop restarts
+        self.start = time.time()
+
+    def value(self):
+        """Returns the values recorded at the current replay position"""
+        position = ((time.time() - self.start) * speed) % self.duration
+        return self.values[bisect.bisect_right(self.times, position) - 1]
+
+    def when(self, index):
+        """Returns the time record index of the n-th loop is due, index counting across loops"""
+        loop, i = divmod(index, len(self.times))
+        return self.start + (loop * self.duration + self.times[i]) / speed
+
+    def record(self, index):
+        return self.values[index % len(self.values)]
+
+
+def trace(kind, pin):
+    """Returns the Trace for a device, from the trace directory or generated"""
+    if trace_dir is not None:
+        for name in ('{}_{}.trace'.format(kind, pin), '{}.trace'.format(kind)):
+            path = os.path.join(trace_dir, name)
+            if os.path.exists(path):
+                return Trace(read_trace(path))
+    return Trace(generate_trace(kind, pin))
+
+
+def sleep(seconds):
+    """Sleeps for seconds of replay time"""
+    time.sleep(seconds / speed)
+
+
+def _reading(v):
+    return None if math.isnan(v) else v
+
+
+class SimulatedInput(object):
+    """Binary input that replays a trace and calls its callbacks from the scheduler thread"""
+
+    KIND = 'button'
+    ACTIVATED = 'when_activated'
+    DEACTIVATED = 'when_deactivated'
+
+    def __init__(self, pin=None, *args, **kwargs):
+        self.pin = pin
+        self.when_activated = None
+        self.when_deactivated = None
+        self.is_active = False
+        self.closed = False
+        self._trace = trace(self.KIND, pin)
+        self._index = 0
+        scheduler.call_at(self._trace.when(0), self._replay)
+
+    @property
+    def value(self):
+        return 1 if self.is_active else 0
+
+    def _replay(self):
+        if self.closed:
+            return
+        active = self._trace.record(self._index)[0] != 0
+        self._index += 1
+        scheduler.call_at(self._trace.when(self._index), self._replay)
+        if active != self.is_active:
+            self.is_active = active
+            callback = getattr(self, self.ACTIVATED if active else self.DEACTIVATED)
+            if callback is not None:
+                callback()
+
+    def close(self):
+        self.closed = True
+
+
+class SimulatedButton(SimulatedInput):
+    KIND = 'button'
+    ACTIVATED = 'when_pressed'
+    DEACTIVATED = 'when_released'
+
+    def __init__(self, pin=None, *args, **kwargs):
+        self.when_pressed = None
+        self.when_released = None
+        SimulatedInput.__init__(self, pin)
+
+
+class SimulatedMotionSensor(SimulatedInput):
+    KIND = 'motion'
+    ACTIVATED = 'when_motion'
+    DEACTIVATED = 'when_no_motion'
+
+    def __init__(self, pin=None, *args, **kwargs):
+        self.when_motion = None
+        self.when_no_motion = None
+        SimulatedInput.__init__(self, pin)
+
+
+class SimulatedOutputDevice(object):
+    """Output that remembers its value and counts its changes"""
+
+    def __init__(self, pin=None, active_high=True, initial_value=False, *args, **kwargs):
+        self.pin = pin
+        self.active_high = active_high
+        self.value = 1 if initial_value else 0
+        self.changes = 0
+        self._blinks = 0
+
+    @property
+    def is_active(self):
+        return self.value == 1
+
+    def _set(self, value):
+        if value != self.value:
+            self.value = value
+            self.changes += 1
+
+    def on(self):
+        self._blinks += 1
+        self._set(1)
+
+    def off(self):
+        self._blinks += 1
+        self._set(0)
+
+    def toggle(self):
+        self._blinks += 1
+        self._set(1 - self.value)
+
+    def blink(self, on_time=1, off_time=1, n=None, background=True):
+        """Blinks n times (forever if None) until on(), off() or toggle() is called"""
+        self._blinks += 1
+        blinks = self._blinks
+        n = int(n) if n is not None else None
+        done = threading.Event()
+
+        def step(i):
+            if self._blinks != blinks:
+                done.set()
+                return
+            if n is not None and i >= 2 * n:
+                self._set(0)
+                done.set()
+                return
+            self._set(1 if i % 2 == 0 else 0)
+            scheduler.call_at(time.time() + (on_time if i % 2 == 0 else off_time) / speed, lambda: step(i + 1))
+
+        step(0)
+        if not background:
+            done.wait()
+
+    def close(self):
+        self.off()
+
+
+class SimulatedCamera(object):
+    """Camera that writes the frames of the trace directory in turn, or a minimal JPEG"""
+
+    def __init__(self, *args, **kwargs):
+        self.resolution = (1920, 1080)
+        self.rotation = 0
+        self.frames = []
+        self._frame = 0
+        if trace_dir is not None and os.path.isdir(os.path.join(trace_dir, 'camera')):
+            directory = os.path.join(trace_dir, 'camera')
+            self.frames = [os.path.join(directory, f) for f in sorted(os.listdir(directory))]
+
+    def capture(self, filename, *args, **kwargs):
+        if len(self.frames) > 0:
+            shutil.copyfile(self.frames[self._frame % len(self.frames)], filename)
+            self._frame += 1
+        else:
+            with open(filename, 'wb') as f:
+                f.write(JPEG)
+
+    def start_recording(self, filename, *args, **kwargs):
+        open(filename, 'wb').close()
+
+    def wait_recording(self, timeout=0):
+        sleep(timeout)
+
+    def stop_recording(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def Button(pin, *args, **kwargs):
+    if simulated():
+        return SimulatedButton(pin, *args, **kwargs)
+    import gpiozero
+    return gpiozero.Button(pin, *args, **kwargs)
+
+
+def MotionSensor(pin, *args, **kwargs):
+    if simulated():
+        return SimulatedMotionSensor(pin, *args, **kwargs)
+    import gpiozero
+    return gpiozero.MotionSensor(pin, *args, **kwargs)
+
+
+def OutputDevice(pin, *args, **kwargs):
+    if simulated():
+        return SimulatedOutputDevice(pin, *args, **kwargs)
+    import gpiozero
+    return gpiozero.OutputDevice(pin, *args, **kwargs)
+
+
+def DigitalOutputDevice(pin, *args, **kwargs):
+    if simulated():
+        return SimulatedOutputDevice(pin, *args, **kwargs)
+    import gpiozero
+    return gpiozero.DigitalOutputDevice(pin, *args, **kwargs)
+
+
+def PiCamera(*args, **kwargs):
+    if simulated():
+        return SimulatedCamera(*args, **kwargs)
+    import picamera
+    return picamera.PiCamera(*args, **kwargs)
+
+
+def Ultrasonic(trigger, echo, *args, **kwargs):
+    """Returns an HC-SR04 on BCM trigger and echo pins, see ultrasonic.Ultrasonic"""
+    import ultrasonic
+    if simulated():
+        return ultrasonic.SimulatedUltrasonic(trigger, echo, *args, **kwargs)
+    return ultrasonic.Ultrasonic(trigger, echo, *args, **kwargs)
+
+
+_dht_traces = {}
+
+
+def dht_read(sensor, pin):
+    """Returns (humidity, temperature) from one attempt at reading a DHT sensor, None for a failed read"""
+    if simulated():
+        if pin not in _dht_traces:
+            _dht_traces[pin] = trace('dht', pin)
+        temperature, humidity = _dht_traces[pin].value()
+        return _reading(humidity), _reading(temperature)
+    import Adafruit_DHT
+    return Adafruit_DHT.read(sensor, pin)
+
+
+def dht_read_retry(sensor, pin, retries=DHT_RETRIES, delay_seconds=DHT_RETRY_DELAY):
+    """Returns (humidity, temperature) from up to retries attempts delay_seconds apart"""
+    if not simulated():
+        import Adafruit_DHT
+        return Adafruit_DHT.read_retry(sensor, pin, retries, delay_seconds)
+    for i in range(retries):
+        humidity, temperature = dht_read(sensor, pin)
+        if humidity is not None and temperature is not None:
+            return humidity, temperature
+        sleep(delay_seconds)
+    return None, None
+
+
+def pi_info():
+    """Returns the board's info, with at least model and pcb_revision"""
+    if simulated():
+        return SIMULATED_PI
+    import gpiozero
+    return gpiozero.pi_info()
+
+
+def gpio_setup():
+    """Puts RPi.GPIO in BCM pin numbering"""
+    if not simulated():
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+
+
+def gpio_cleanup():
+    if not simulated():
+        import RPi.GPIO as GPIO
+        GPIO.cleanup()
@@ -1,32 +1,46 @@
 #!/usr/bin/env python
 
-import json
 import awsiot
 import logging
+import hardware
 from signal import pause
-from gpiozero import Button
 
 
-def pub(topic, value):
+def pub(topic, value, count=1):
     if topic is not None and len(topic) > 0:
         for t in topic:
-            publisher.publish(t,
-                              json.dumps(
-                                  {args.shadow_var: value, awsiot.MESSAGE: "{} {}".format(args.shadow_var, value)}))
-    publisher.publish(awsiot.iot_thing_topic(args.thing), awsiot.iot_payload(awsiot.REPORTED, {args.shadow_var: value}))
+            doc = {args.shadow_var: value, awsiot.MESSAGE: "{} {}".format(args.shadow_var, value)}
+            if args.edge_count:
+                doc['count'] = count
+            publisher.publish_doc(t, doc)
+    publisher.report_shadow(args.thing, {args.shadow_var: value}, critical=True)
+
+
+def report(pressed, count):
+    if pressed:
+        logging.info("{} {} {} ({} edges)".format(args.shadow_var, args.pin, args.high_value, count))
+        pub(args.topic, args.high_value, count)
+    else:
+        logging.info("{} {} {} ({} edges)".format(args.shadow_var, args.pin, args.low_value, count))
+        pub(args.low_topic, args.low_value, count)
+
+
+def change(state):
+    if shaper is None:
+        report(state, 1)  # no shaping, published from the GPIO callback
+    else:
+        shaper.update(state)
 
 
 def high():
-    logging.info("{} {} {}".format(args.shadow_var, args.pin, args.high_value))
-    pub(args.topic, args.high_value)
+    change(True)
 
 
 def low():
-    logging.info("{} {} {}".format(args.shadow_var, args.pin, args.low_value))
-    pub(args.low_topic, args.low_value)
+    change(False)
 
 
-if __name__ == "__main__":
+def arg_parser():
     parser = awsiot.iot_arg_parser()
     parser.add_argument("-p", "--pin", help="gpio pin (using BCM numbering)", type=int, required=True)
     parser.add_argument("-u", "--pull_up",
@@ -44,19 +58,39 @@ if __name__ == "__main__":
     parser.add_argument("-y", "--high_value", help="high value", default=1)
     parser.add_argument("-z", "--low_value", help="low value", default=0)
     parser.add_argument("-o", "--low_topic", nargs='*', help="Low topic (defaults to topic if not assigned")
-    args = parser.parse_args()
+    parser.add_argument("--hold", help="seconds a state must hold before it is reported", type=float,
+                        default=awsiot.EVENT_HOLD)
+    parser.add_argument("--window", help="seconds after a report in which changes are coalesced (0 is off)",
+                        type=float, default=awsiot.EVENT_WINDOW)
+    parser.add_argument("--edge_count", help="add the number of edges each event stands for as 'count'",
+                        action='store_true')
+    return parser
+
+
+def start(a, client):
+    global args, publisher, inp, shaper
+    args = a
+    publisher = client
+    shaper = None
+    if args.hold > 0 or args.window > 0:
+        shaper = awsiot.EventShaper(report, args.hold, args.window)
 
     # default low_topic to topic if not defined
     if args.low_topic is None or len(args.low_topic) == 0:
         args.low_topic = args.topic
 
-    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
-
-    publisher = awsiot.MQTT(args.endpoint, args.rootCA, args.cert, args.key)
-
-    inp = Button(args.pin, pull_up=args.pull_up, bounce_time=args.bounce_time)
+    hardware.configure(args)
+    inp = hardware.Button(args.pin, pull_up=args.pull_up, bounce_time=args.bounce_time)
 
     inp.when_pressed = high
     inp.when_released = low
 
+
+if __name__ == "__main__":
+    args = arg_parser().parse_args()
+
+    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
+
+    start(args, awsiot.mqtt_from_args(args))
+
     pause()
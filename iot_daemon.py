@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""Runs several device scripts in one process over a single MQTT connection.
+
+The config file is JSON:
+
+    {
+        "args": ["-e", "abc123.iot.us-east-1.amazonaws.com", "-r", "root-CA.crt",
+                 "-c", "thing.cert.pem", "-k", "thing.private.key", "--spool_dir", "/var/spool/iot"],
+        "devices": [
+            {"script": "relay_sub", "args": ["-p", "17", "-t", "home/garage/door"]},
+            {"script": "pir_pub", "args": ["-p", "4", "-s", "motion", "-t", "home/garage/motion"]},
+            {"script": "dht_pub", "args": ["-p", "22"], "interval": 300}
+        ]
+    }
+
+"args" configure the shared connection and are prepended to each device's "args", so a device
+takes exactly the options of its script. A device that sets a connection option differently is
+not started, since the connection it would configure is the shared one. Devices with an
+"interval" call the script's report() every interval seconds from their own thread, and scripts
+with a run() loop get their own thread too.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import awsiot
+
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+    spec_from_file_location = None
+    import imp
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# options of the shared connection and of the process, only the config's "args" can set them
+SHARED_OPTIONS = ['endpoint', 'rootCA', 'cert', 'key', 'port',
+                  'spool_dir', 'spool_max_mb', 'spool_max_age', 'spool_policy', 'drain_rate', 'max_drain_rate',
+                  'workers', 'max_pending', 'queue_policy', 'aws_pool_connections',
+                  'deadband', 'shadow_refresh', 'shadow_cache', 'coalesce_ms',
+                  'encoding', 'schema', 'batch_window', 'batch_size',
+                  'metrics_port', 'metrics_interval', 'metrics_topic',
+                  'hardware', 'trace_dir', 'speed']
+
+
+def load_script(name, path):
+    """Loads a separate copy of a device script so every device keeps its own module globals"""
+    if spec_from_file_location is None:
+        return imp.load_source(name, path)
+    spec = spec_from_file_location(name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def shared_overrides(common_args, device_args):
+    """Returns the shared options device_args sets differently from common_args"""
+    return [o for o in SHARED_OPTIONS if getattr(device_args, o) != getattr(common_args, o)]
+
+
+def run_device(name, module):
+    try:
+        module.run()
+    except Exception as e:
+        logging.exception("device {} stopped: {}".format(name, e))
+
+
+def report_device(name, module, interval, stop):
+    """Calls the device's report() every interval seconds until stop is set"""
+    while not stop.wait(interval):
+        try:
+            module.report()
+        except Exception as e:
+            logging.exception("device {} report failed: {}".format(name, e))
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", help="device config file (JSON)")
+    parser.add_argument("-l", "--log_level", help="Log Level", default=logging.INFO)
+    return parser
+
+
+if __name__ == "__main__":
+    args = arg_parser().parse_args()
+
+    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    common = config.get('args', [])
+
+    common_args = awsiot.iot_arg_parser().parse_args(common)
+    mqtt = awsiot.mqtt_from_args(common_args)
+
+    stop = threading.Event()
+    devices = []
+    for i, d in enumerate(config['devices']):
+        name = '{}_{}'.format(d['script'], i)
+        try:
+            module = load_script(name, os.path.join(SCRIPT_DIR, '{}.py'.format(d['script'])))
+            device_args = module.arg_parser().parse_args(common + d.get('args', []))
+            overrides = shared_overrides(common_args, device_args)
+            if len(overrides) > 0:
+                raise ValueError("set {} in the config's args, they are shared by every device".format(
+                    ', '.join('--' + o for o in overrides)))
+            module.start(device_args, mqtt)
+        except (Exception, SystemExit) as e:
+            logging.exception("device {} failed to start: {}".format(name, e))
+            continue
+        logging.info("device {} started".format(name))
+        devices.append((name, module))
+        if hasattr(module, 'run'):
+            t = threading.Thread(target=run_device, args=(name, module), name=name)
+            t.daemon = True
+            t.start()
+        if d.get('interval') is not None:
+            # a report can block for a while (a DHT read retries for up to 30s), so it gets its own thread
+            t = threading.Thread(target=report_device, args=(name, module, d['interval'], stop),
+                                 name='{}-report'.format(name))
+            t.daemon = True
+            t.start()
+
+    # Loop forever
+    try:
+        while True:
+            time.sleep(0.5)  # sleep needed because CPU race
+    except (KeyboardInterrupt, SystemExit):
+        stop.set()
+        for name, module in devices:
+            if hasattr(module, 'stop'):
+                module.stop()
+        mqtt.disconnect()
+        sys.exit()
@@ -0,0 +1,162 @@
+import time
+import logging
+import threading
+import contextlib
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# histogram bucket upper bounds in seconds, roughly logarithmic from 0.5 ms to 30 s
+BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0]
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets; percentiles are the upper bound of the bucket they fall in"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        if self.count == 0:
+            return 0.0
+        rank = self.count * pct / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+
+class Metrics(object):
+    """Thread-safe registry of counters, gauges and latency histograms.
+
+    Gauges are either set directly or read from a function when the metrics are collected,
+    e.g. queue depths. Names should be valid shadow keys and Prometheus metric names.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_fns = {}
+        self._histograms = {}
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def gauge(self, name, fn):
+        """Registers fn() as the source of gauge name"""
+        with self._lock:
+            self._gauge_fns[name] = fn
+
+    def observe(self, name, seconds):
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                h = self._histograms[name] = Histogram()
+            h.observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Records the run time of the with block in histogram name, including when it raises"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def _read_gauges(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+            fns = list(self._gauge_fns.items())
+        for name, fn in fns:
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                logging.warning("gauge {} failed: {}".format(name, e))
+        return gauges
+
+    def summary(self):
+        """Returns a compact dict: counters and gauges by name, histograms as [count, p50 ms, p99 ms, max ms]"""
+        result = self._read_gauges()
+        with self._lock:
+            result.update(self._counters)
+            for name, h in self._histograms.items():
+                result[name] = [h.count, round(h.percentile(50) * 1000, 1), round(h.percentile(99) * 1000, 1),
+                                round(h.max * 1000, 1)]
+        return result
+
+    def text(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        lines = []
+        gauges = self._read_gauges()
+        with self._lock:
+            for name in sorted(self._counters):
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(name, self._counters[name]))
+            for name in sorted(gauges):
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, float(gauges[name])))
+            for name in sorted(self._histograms):
+                h = self._histograms[name]
+                lines.append('# TYPE {} histogram'.format(name))
+                seen = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    seen += n
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, seen))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, h.count))
+                lines.append('{}_sum {}'.format(name, h.sum))
+                lines.append('{}_count {}'.format(name, h.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Metrics()
+
+
+def timed(name):
+    """Times the with block into the process-wide registry"""
+    return registry.timed(name)
+
+
+def serve(port, metrics=registry, address='127.0.0.1'):
+    """Serves metrics.text() over HTTP on address:port from a daemon thread, returns the server"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("metrics {}".format(format % args))
+
+    server = HTTPServer((address, port), Handler)
+    t = threading.Thread(target=server.serve_forever, name='metrics-http')
+    t.daemon = True
+    t.start()
+    logging.info("metrics on http://{}:{}/".format(address, server.server_address[1]))
+    return server
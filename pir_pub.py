@@ -1,40 +1,49 @@
 #!/usr/bin/env python
 
-import json
 import awsiot
+import hardware
 import logging
 from signal import pause
 
-try:
-    from gpiozero import MotionSensor
-except ImportError:
-    logging.error("Unable to import gpiozero")
-    pass
 
-
-def pub(topic, value):
+def pub(topic, value, count=1):
     if topic is not None and len(topic) > 0:
         for t in topic:
-            publisher.publish(t,
-                              json.dumps(
-                                  {args.shadow_var: value, awsiot.MESSAGE: "{} {}".format(args.shadow_var, value)}))
-    publisher.publish(awsiot.iot_thing_topic(args.thing), awsiot.iot_payload(awsiot.REPORTED, {args.shadow_var: value}))
+            doc = {args.shadow_var: value, awsiot.MESSAGE: "{} {}".format(args.shadow_var, value)}
+            if args.edge_count:
+                doc['count'] = count
+            publisher.publish_doc(t, doc)
+    publisher.report_shadow(args.thing, {args.shadow_var: value}, critical=True)
+
+
+def report(active, count):
+    if active:
+        logging.info("{} {} {} ({} edges)".format(args.shadow_var, args.pin, args.high_value, count))
+        pub(args.topic, args.high_value, count)
+    else:
+        logging.info("{} {} {} ({} edges)".format(args.shadow_var, args.pin, args.low_value, count))
+        if args.low_topic:
+            pub(args.low_topic, args.low_value, count)
+        else:
+            pub(args.topic, args.low_value, count)
+
+
+def change(state):
+    if shaper is None:
+        report(state, 1)  # no shaping, published from the GPIO callback
+    else:
+        shaper.update(state)
 
 
 def motion():
-    logging.info("{} {} {}".format(args.shadow_var, args.pin, args.high_value))
-    pub(args.topic, args.high_value)
+    change(True)
 
 
 def no_motion():
-    logging.info("{} {} {}".format(args.shadow_var, args.pin, args.low_value))
-    if args.low_topic:
-        pub(args.low_topic, args.low_value)
-    else:
-        pub(args.topic, args.low_value)
+    change(False)
 
 
-if __name__ == "__main__":
+def arg_parser():
     parser = awsiot.iot_arg_parser()
     parser.add_argument("-p", "--pin", help="gpio pin (using BCM numbering)", type=int, required=True)
     parser.add_argument("-q", "--queue_len",
@@ -53,18 +62,38 @@ if __name__ == "__main__":
     parser.add_argument("-y", "--high_value", help="high value", default=1)
     parser.add_argument("-z", "--low_value", help="low value", default=0)
     parser.add_argument("-o", "--low_topic", nargs='*', help="Low topic")
-    args = parser.parse_args()
+    parser.add_argument("--hold", help="seconds a state must hold before it is reported", type=float,
+                        default=awsiot.EVENT_HOLD)
+    parser.add_argument("--window", help="seconds after a report in which changes are coalesced (0 is off)",
+                        type=float, default=awsiot.EVENT_WINDOW)
+    parser.add_argument("--edge_count", help="add the number of edges each event stands for as 'count'",
+                        action='store_true')
+    return parser
 
-    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
 
-    publisher = awsiot.MQTT(args.endpoint, args.rootCA, args.cert, args.key)
+def start(a, client):
+    global args, publisher, pir, shaper
+    args = a
+    publisher = client
+    shaper = None
+    if args.hold > 0 or args.window > 0:
+        shaper = awsiot.EventShaper(report, args.hold, args.window)
 
-    pir = MotionSensor(args.pin,
-                       queue_len=args.queue_len,
-                       sample_rate=args.sample_rate,
-                       threshold=args.threshold)
+    hardware.configure(args)
+    pir = hardware.MotionSensor(args.pin,
+                                queue_len=args.queue_len,
+                                sample_rate=args.sample_rate,
+                                threshold=args.threshold)
 
     pir.when_motion = motion
     pir.when_no_motion = no_motion
 
+
+if __name__ == "__main__":
+    args = arg_parser().parse_args()
+
+    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
+
+    start(args, awsiot.mqtt_from_args(args))
+
     pause()
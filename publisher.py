@@ -9,7 +9,7 @@ if __name__ == "__main__":
     parser = awsiot.iot_arg_parser()
     args = parser.parse_args()
 
-    publisher = awsiot.MQTT(args.endpoint, args.rootCA, args.cert, args.key)
+    publisher = awsiot.mqtt_from_args(args)
 
     logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
 
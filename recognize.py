@@ -2,18 +2,31 @@ from __future__ import print_function
 import boto3
 import json
 import io
-import uuid
+import logging
+import threading
 from PIL import Image
 import PIL.Image
+from botocore.config import Config
 
-dynamodb = boto3.client('dynamodb')
-s3 = boto3.client('s3')
-rekognition = boto3.client('rekognition')
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+RECORD_WORKERS = 4  # S3 records processed at once
+FACE_WORKERS = 8  # face searches at once per record
+
+config = Config(max_pool_connections=RECORD_WORKERS * (FACE_WORKERS + 2))
+dynamodb = boto3.client('dynamodb', config=config)
+s3 = boto3.client('s3', config=config)
+rekognition = boto3.client('rekognition', config=config)
 
 SNAPSHOTS = 'snapshots.snerted.com'
 COLLECTION = 'snerted'
 CONFIDENCE = 75
 DDB_TABLE = 'faces'
+MIN_FACE_PIXELS = 80  # smallest face side kept when decoding at reduced JPEG scale
+MAX_CROP_PIXELS = 480  # face crops are downscaled to fit this before upload to Rekognition
 
 
 def tagify(arr, field):
@@ -24,71 +37,125 @@ def tagify(arr, field):
     return '+'.join(o)
 
 
+def parallel_map(fn, items, workers):
+    """Returns [fn(i) for i in items] running up to workers calls at once, raising the first error"""
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    todo = queue.Queue()
+    for i in enumerate(items):
+        todo.put(i)
+
+    def work():
+        while True:
+            try:
+                i, item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[i] = fn(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return results
+
+
+def draft_scale(size, faces):
+    """Returns the largest JPEG reduction (1, 2, 4 or 8) keeping every face at least MIN_FACE_PIXELS"""
+    smallest = min(min(f['BoundingBox']['Width'] * size[0], f['BoundingBox']['Height'] * size[1]) for f in faces)
+    for scale in (8, 4, 2):
+        if smallest / scale >= MIN_FACE_PIXELS:
+            return scale
+    return 1
+
+
+def identify_face(image, face):
+    """Returns the name of the person whose face is at face['BoundingBox'] in image, None if no match"""
+    image_width = image.size[0]
+    image_height = image.size[1]
+    box = face['BoundingBox']
+
+    x1 = int(box['Left'] * image_width) * 0.9
+    y1 = int(box['Top'] * image_height) * 0.9
+    x2 = int(box['Left'] * image_width + box['Width'] * image_width) * 1.10
+    y2 = int(box['Top'] * image_height + box['Height'] * image_height) * 1.10
+    image_crop = image.crop((x1, y1, x2, y2))
+    image_crop.thumbnail((MAX_CROP_PIXELS, MAX_CROP_PIXELS))
+
+    stream = io.BytesIO()
+    image_crop.save(stream, format="JPEG", quality=90)
+    image_crop_binary = stream.getvalue()
+    print("Cropped image: {},{} - {},{} sent {}".format(x1, y1, x2, y2, image_crop.size))
+    # Submit individually cropped image to Amazon Rekognition
+    try:
+        response = rekognition.search_faces_by_image(
+            CollectionId=COLLECTION,
+            Image={'Bytes': image_crop_binary}
+        )
+        if len(response['FaceMatches']) > 0:
+            match = response['FaceMatches'][0]
+            face = dynamodb.get_item(
+                TableName=DDB_TABLE,
+                Key={'id': {'S': match['Face']['FaceId']}}
+            )
+            if 'Item' in face:
+                return face['Item']['name']['S']
+            else:
+                return 'Unknown'
+    except Exception as e:
+        logging.warning("search_faces_by_image failed: {}".format(e))
+    return None
+
+
+def process_record(record):
+    bucket = record['s3']['bucket']['name']
+    key = record['s3']['object']['key']
+    tags = {}
+
+    # detect objects, detect faces, read the image into memory and read its tags at the same time
+    labels, faces, body, existing_tags = parallel_map(lambda call: call(), [
+        lambda: rekognition.detect_labels(
+            Image={'S3Object': {'Bucket': bucket, 'Name': key}}, MinConfidence=CONFIDENCE),
+        lambda: rekognition.detect_faces(Image={'S3Object': {'Bucket': bucket, 'Name': key}}),
+        lambda: s3.get_object(Bucket=bucket, Key=key)['Body'].read(),
+        lambda: s3.get_object_tagging(Bucket=bucket, Key=key)['TagSet']
+    ], 4)
+    if "Labels" in labels:
+        tags['recognize'] = tagify(labels['Labels'], 'Name')
+
+    all_faces = faces['FaceDetails']
+    print("All faces: {}".format(all_faces))
+    if len(all_faces) > 0:
+        image = Image.open(io.BytesIO(body))
+        print("Main image width: {} height: {}".format(image.size[0], image.size[1]))
+        scale = draft_scale(image.size, all_faces)
+        if scale > 1:
+            image.draft('RGB', (image.size[0] // scale, image.size[1] // scale))
+        image.load()  # decode once, before the crops are taken concurrently
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        print("Decoded width: {} height: {}".format(image.size[0], image.size[1]))
+        names = [n for n in parallel_map(lambda face: identify_face(image, face), all_faces, FACE_WORKERS)
+                 if n is not None]
+        if len(names) > 0:
+            tags['identities'] = '+'.join(names)
+
+    # add the tags
+    if len(tags) > 0:
+        for k, v in tags.items():
+            existing_tags.append({'Key': k.strip(), 'Value': v.strip()})
+        s3.put_object_tagging(Bucket=bucket, Key=key, Tagging={'TagSet': existing_tags})
+
+
 def lambda_handler(event, context):
     print("Received event: {}".format(json.dumps(event)))
 
     if 'Records' in event:
-        for record in event['Records']:
-            bucket = record['s3']['bucket']['name']
-            key = record['s3']['object']['key']
-            tags = {}
-
-            # detect objects
-            result = rekognition.detect_labels(
-                Image={'S3Object': {'Bucket': bucket, 'Name': key}}, MinConfidence=CONFIDENCE)
-            if "Labels" in result:
-                tags['recognize'] = tagify(result['Labels'], 'Name')
-
-            # detect faces
-            response = rekognition.detect_faces(Image={'S3Object': {'Bucket': bucket, 'Name': key}})
-            all_faces = response['FaceDetails']
-            download_path = '/tmp/{}{}'.format(uuid.uuid4(), key)
-            s3.download_file(bucket, key, download_path)
-            image = Image.open(download_path)
-            stream = io.BytesIO()
-            image.save(stream, format="JPEG")
-            image_width = image.size[0]
-            image_height = image.size[1]
-            print("Main image width: {} height: {}".format(image_width, image_height))
-            names = []
-            print("All faces: {}".format(all_faces))
-            for face in all_faces:
-                box = face['BoundingBox']
-
-                x1 = int(box['Left'] * image_width) * 0.9
-                y1 = int(box['Top'] * image_height) * 0.9
-                x2 = int(box['Left'] * image_width + box['Width'] * image_width) * 1.10
-                y2 = int(box['Top'] * image_height + box['Height'] * image_height) * 1.10
-                image_crop = image.crop((x1, y1, x2, y2))
-
-                stream = io.BytesIO()
-                image_crop.save(stream, format="JPEG")
-                image_crop_binary = stream.getvalue()
-                print("Cropped image: {},{} - {},{}".format(x1, y1, x2, y2))
-                # Submit individually cropped image to Amazon Rekognition
-                try:
-                    response = rekognition.search_faces_by_image(
-                        CollectionId=COLLECTION,
-                        Image={'Bytes': image_crop_binary}
-                    )
-                    if len(response['FaceMatches']) > 0:
-                        match = response['FaceMatches'][0]
-                        face = dynamodb.get_item(
-                            TableName=DDB_TABLE,
-                            Key={'id': {'S': match['Face']['FaceId']}}
-                        )
-                        if 'Item' in face:
-                            names.append(face['Item']['name']['S'])
-                        else:
-                            names.append('Unknown')
-                except Exception as e:
-                    print("search_faces_by_image failed: {}".format(e.message))
-            if len(names) > 0:
-                tags['identities'] = '+'.join(names)
-
-            # add the tags
-            existing_tags = s3.get_object_tagging(Bucket=bucket, Key=key)['TagSet']
-            if tags is not None:
-                for k, v in tags.items():
-                    existing_tags.append({'Key': k.strip(), 'Value': v.strip()})
-                s3.put_object_tagging(Bucket=bucket, Key=key, Tagging={'TagSet': existing_tags})
+        parallel_map(process_record, event['Records'], RECORD_WORKERS)
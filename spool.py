@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import base64
+import logging
+import threading
+import collections
+
+SEGMENT_SUFFIX = '.seg'
+SEGMENT_FORMAT = '{:012d}' + SEGMENT_SUFFIX
+INDEX_FILE = 'index.json'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DROP_POLICIES = [DROP_OLDEST, DROP_NEWEST]
+INDEX_SAVE_RECORDS = 64  # save the read position at least every n records
+INDEX_SAVE_INTERVAL = 1.0  # ... or every n seconds
+
+
+class Spool(object):
+    """Persistent append-only publish spool.
+
+    Records are JSON lines appended to numbered segment files. read() hands out records in order
+    and a record is only consumed once ack() confirms its delivery; index.json keeps the position
+    of the oldest record not yet acknowledged, so after a restart or rewind() every record that
+    was in flight is sent again (delivery is at-least-once).
+    Size is capped by max_bytes (dropping the oldest segment or refusing new records,
+    per drop_policy) and records older than max_age seconds are discarded when read.
+    A spool directory must only be used by one process.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, max_age=7 * 24 * 3600, segment_bytes=1024 * 1024,
+                 drop_policy=DROP_OLDEST):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError("unknown drop policy {}".format(drop_policy))
+        self._path = path
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._segment_bytes = segment_bytes
+        self._drop_policy = drop_policy
+        self._lock = threading.RLock()
+        self._writer = None
+        self._reader = None
+        self._outstanding = collections.OrderedDict()  # position -> acknowledged, in read order
+        self.acked = 0
+        self._unsaved = 0
+        self._saved_time = time.time()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._segments = sorted(int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(path) if f.endswith(SEGMENT_SUFFIX))
+        self._bytes = sum(os.path.getsize(self._segment_path(n)) for n in self._segments)
+        self._read_segment, self._read_offset = self._load_index()
+        self._send_segment, self._send_offset = self._read_segment, self._read_offset
+
+    def _segment_path(self, n):
+        return os.path.join(self._path, SEGMENT_FORMAT.format(n))
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self._path, INDEX_FILE)) as f:
+                index = json.load(f)
+            if index['segment'] in self._segments:
+                return index['segment'], index['offset']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            if len(self._segments) > 0:
+                logging.warning("spool index {} unreadable: {}".format(self._path, e))
+        if len(self._segments) > 0:
+            return self._segments[0], 0
+        return None, 0
+
+    def _save_index(self):
+        if self._read_segment is None:
+            return
+        tmp = os.path.join(self._path, INDEX_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'segment': self._read_segment, 'offset': self._read_offset}, f)
+        os.rename(tmp, os.path.join(self._path, INDEX_FILE))
+        self._unsaved = 0
+        self._saved_time = time.time()
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def _roll(self):
+        self._close_writer()
+        n = self._segments[-1] + 1 if len(self._segments) > 0 else 0
+        self._segments.append(n)
+        if self._read_segment is None:
+            self._read_segment, self._read_offset = n, 0
+            self._send_segment, self._send_offset = n, 0
+        self._expire()
+
+    def _drop_segment(self, n):
+        self._close_reader()
+        path = self._segment_path(n)
+        try:
+            self._bytes -= os.path.getsize(path)
+            os.remove(path)
+        except OSError as e:
+            logging.error("spool failed to remove {}: {}".format(path, e))
+        self._segments.remove(n)
+        for position in [p for p in self._outstanding if p[0] == n]:
+            del self._outstanding[position]
+        if self._read_segment == n:
+            self._read_segment = self._segments[0] if len(self._segments) > 0 else None
+            self._read_offset = 0
+        if self._send_segment == n:
+            self._send_segment, self._send_offset = self._read_segment, self._read_offset
+        self._save_index()
+
+    def _expire(self):
+        """Drops whole segments (other than the one being written) older than max_age"""
+        if self._max_age is None:
+            return
+        oldest = time.time() - self._max_age
+        while len(self._segments) > 1 and os.path.getmtime(self._segment_path(self._segments[0])) < oldest:
+            logging.warning("spool expired segment {}".format(self._segments[0]))
+            self._drop_segment(self._segments[0])
+
+    @staticmethod
+    def _record(topic, payload, qos):
+        record = {'t': time.time(), 'topic': topic, 'qos': qos}
+        if isinstance(payload, (bytes, bytearray)):
+            try:
+                record['payload'] = payload.decode('utf-8')
+            except UnicodeDecodeError:
+                record['payload64'] = base64.b64encode(payload).decode('ascii')
+        else:
+            record['payload'] = payload
+        return (json.dumps(record) + '\n').encode('utf-8')
+
+    def append(self, topic, payload, qos=1):
+        """Appends a publish to the spool, returns False if it was dropped"""
+        line = self._record(topic, payload, qos)
+        with self._lock:
+            if self._drop_policy == DROP_NEWEST and self._bytes + len(line) > self._max_bytes:
+                logging.warning("spool full, dropped {}".format(topic))
+                return False
+            if len(self._segments) == 0 or \
+                    os.path.getsize(self._segment_path(self._segments[-1])) >= self._segment_bytes:
+                self._roll()
+            if self._writer is None:
+                self._writer = open(self._segment_path(self._segments[-1]), 'ab')
+            self._writer.write(line)
+            self._writer.flush()
+            self._bytes += len(line)
+            while self._bytes > self._max_bytes and len(self._segments) > 1:
+                logging.warning("spool full, dropped segment {}".format(self._segments[0]))
+                self._drop_segment(self._segments[0])
+            return True
+
+    def read(self):
+        """Returns the next unsent record as (position, topic, payload, qos), None if there is none.
+        The record stays in the spool until ack(position)."""
+        with self._lock:
+            while self._send_segment is not None:
+                if self._reader is None:
+                    self._reader = open(self._segment_path(self._send_segment), 'rb')
+                self._reader.seek(self._send_offset)
+                line = self._reader.readline()
+                if not line.endswith(b'\n'):
+                    if self._send_segment == self._segments[-1]:
+                        return None  # caught up (or the writer is mid-record)
+                    if len(line) > 0:
+                        logging.warning("spool segment {} truncated".format(self._send_segment))
+                    self._skip((self._segments[self._segments.index(self._send_segment) + 1], 0))
+                    continue
+                position = (self._send_segment, self._reader.tell())
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError as e:
+                    logging.warning("spool skipped corrupt record: {}".format(e))
+                    self._skip(position)
+                    continue
+                if self._max_age is not None and record['t'] < time.time() - self._max_age:
+                    self._skip(position)
+                    continue
+                self._send_offset = position[1]
+                self._outstanding[position] = False
+                if 'payload64' in record:
+                    payload = bytearray(base64.b64decode(record['payload64']))  # the SDK takes no bytes
+                else:
+                    payload = record['payload']
+                return position, record['topic'], payload, record['qos']
+            return None
+
+    def _skip(self, position):
+        """Moves past records that are not sent; they are consumed along with the records before them"""
+        if position[0] != self._send_segment:
+            self._close_reader()
+        self._send_segment, self._send_offset = position
+        self._outstanding[position] = True
+        self._advance()
+
+    def _advance(self):
+        moved = False
+        while len(self._outstanding) > 0:
+            position, acked = next(iter(self._outstanding.items()))
+            if not acked:
+                break
+            del self._outstanding[position]
+            while len(self._segments) > 0 and self._segments[0] < position[0]:  # fully consumed
+                self._drop_segment(self._segments[0])
+            self._read_segment, self._read_offset = position
+            moved = True
+        if moved:
+            self._unsaved += 1
+            if self._unsaved >= INDEX_SAVE_RECORDS or time.time() - self._saved_time > INDEX_SAVE_INTERVAL:
+                self._save_index()
+
+    def ack(self, position):
+        """Confirms delivery of the record read at position; the spool is consumed up to the oldest
+        record not yet acknowledged"""
+        with self._lock:
+            if position in self._outstanding:
+                self._outstanding[position] = True
+                self.acked += 1
+                self._advance()
+
+    def rewind(self):
+        """Forgets records read but not acknowledged so read() returns them again"""
+        with self._lock:
+            self._outstanding.clear()
+            self._close_reader()
+            self._send_segment, self._send_offset = self._read_segment, self._read_offset
+
+    @property
+    def in_flight(self):
+        """Returns the number of records read but not yet acknowledged"""
+        with self._lock:
+            return sum(1 for acked in self._outstanding.values() if not acked)
+
+    def pending(self):
+        """Returns True if there are unsent records"""
+        with self._lock:
+            if self._read_segment is None:
+                return False
+            if self._read_segment != self._segments[-1]:
+                return True
+            return self._read_offset < os.path.getsize(self._segment_path(self._read_segment))
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def close(self):
+        with self._lock:
+            self._save_index()
+            self._close_reader()
+            self._close_writer()
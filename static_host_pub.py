@@ -6,35 +6,39 @@ import logging
 import platform
 import psutil
 import datetime
-from gpiozero import *
+import hashlib
+import os
+import socket
+import sys
+import threading
+import hardware
 
 
 NET_INTERFACES = ['en0', 'en1', 'en2', 'en3', 'wlan0', 'wlan1', 'eth0', 'eth1']
+STATE_FILE = '/var/tmp/static_host_pub.state'
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+WATCH_SETTLE = 2  # seconds without further address events before reporting
+WATCH_TIMEOUT = 3600  # seconds between checks when no address events arrive
 
 
-def get_ip(i):
-    if i in psutil.net_if_addrs():
-        try:
-            for k in psutil.net_if_addrs()[i]:
-                family, address, netmask, broadcast, ptp = k
-                if family == 2:
-                    return address
-            return None
-        except Exception as ex:
-            logging.info("get_ip {} {}".format(i, ex.message))
-            return None
-    else:
-        return None
-
+def get_ips():
+    """Returns {interface: IPv4 address or None} for NET_INTERFACES from one interface enumeration"""
+    ips = dict((i, None) for i in NET_INTERFACES)
+    try:
+        for i, addresses in psutil.net_if_addrs().items():
+            if i in ips:
+                for a in addresses:
+                    if a.family == socket.AF_INET:
+                        ips[i] = a.address
+                        break
+    except Exception as ex:
+        logging.info("get_ips {}".format(ex))
+    return ips
 
-if __name__ == "__main__":
-    parser = awsiot.iot_arg_parser()
-    args = parser.parse_args()
-
-    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
-
-    publisher = awsiot.MQTT(args.endpoint, args.rootCA, args.cert, args.key)
 
+def facts():
     properties = {}
     mem = psutil.virtual_memory()
     disk = psutil.disk_usage('/')
@@ -43,14 +47,113 @@ if __name__ == "__main__":
         properties["release"] = platform.mac_ver()[0]
     elif platform.machine().startswith('arm') and platform.system() == 'Linux':  # raspberry pi
         properties["distribution"] = "{} {}".format(platform.dist()[0], platform.dist()[1])
-        properties["hardware"] = "Pi Model {} V{}".format(pi_info().model, pi_info().pcb_revision)
+        pi = hardware.pi_info()
+        properties["hardware"] = "Pi Model {} V{}".format(pi.model, pi.pcb_revision)
     properties["hostname"] = platform.node()
     properties["machine"] = platform.machine()
     properties["system"] = platform.system()
     properties["totalDiskSpaceRoot"] = int(disk.total / (1024 * 1024))
     properties["cpuProcessorCount"] = psutil.cpu_count()
     properties["ramTotal"] = int(mem.total / (1024 * 1024))
-    for iface in NET_INTERFACES:
-        properties["{}IpAddress".format(iface)] = get_ip(iface)
+    for iface, ip in get_ips().items():
+        properties["{}IpAddress".format(iface)] = ip
+    return properties
+
+
+def fingerprint(properties):
+    return hashlib.sha1(json.dumps(properties, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_fingerprint():
+    try:
+        with open(args.state_file) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def write_fingerprint(fp):
+    try:
+        tmp = '{}.tmp'.format(args.state_file)
+        with open(tmp, 'w') as f:
+            f.write(fp)
+        os.rename(tmp, args.state_file)
+    except (IOError, OSError) as ex:
+        logging.warning("unable to save {}: {}".format(args.state_file, ex))
+
+
+def delivered(fp):
+    """Saves the fingerprint of facts once their update is acknowledged"""
+    global force
+    with lock:
+        force = False
+        write_fingerprint(fp)
+
+
+def report():
+    """Publishes the host facts if they changed since the last published facts"""
+    with lock:
+        properties = facts()
+        fp = fingerprint(properties)
+        if not force and fp == read_fingerprint():
+            logging.info("host facts unchanged")
+            return
+        # the fingerprint is only saved once the update is delivered, so an update that is never
+        # acknowledged, e.g. one the SDK queued while offline, is published again next time
+        publisher.report_shadow(args.thing, properties, critical=True, acked=lambda: delivered(fp))
+
+
+def arg_parser():
+    parser = awsiot.iot_arg_parser()
+    parser.add_argument("--state_file", help="fingerprint of the last published facts", default=STATE_FILE)
+    parser.add_argument("--force", help="publish even if nothing changed", action='store_true')
+    parser.add_argument("--watch", help="keep running and report address changes as they happen (Linux)",
+                        action='store_true')
+    return parser
+
+
+def start(a, client):
+    global args, publisher, lock, force
+    args = a
+    publisher = client
+    hardware.configure(args)
+    lock = threading.RLock()  # an update can be acknowledged before report_shadow returns
+    force = args.force
+    report()
+
+
+def run():
+    if not args.watch:
+        return
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+    except (AttributeError, socket.error) as ex:
+        logging.error("unable to watch for address changes: {}".format(ex))
+        return
+    while True:
+        # wait for an address or link event, then for the burst that usually follows to settle
+        sock.settimeout(WATCH_TIMEOUT)
+        try:
+            sock.recv(65536)
+            sock.settimeout(WATCH_SETTLE)
+            while True:
+                sock.recv(65536)
+        except socket.timeout:
+            pass
+        report()
+
+
+if __name__ == "__main__":
+    args = arg_parser().parse_args()
+
+    logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
+
+    start(args, awsiot.mqtt_from_args(args))
 
-    publisher.publish(awsiot.iot_thing_topic(args.thing), awsiot.iot_payload(awsiot.REPORTED, properties))
+    try:
+        run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    publisher.disconnect()
+    sys.exit()
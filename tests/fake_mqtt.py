@@ -0,0 +1,62 @@
+import os
+import threading
+
+from AWSIoTPythonSDK.core.protocol.internal.events import FixedEventMids
+
+import awsiot
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+class FakeClient(object):
+    """Stands in for AWSIoTMQTTClient. Publishes after the first drop are acked from another thread,
+    like the SDK, while auto_ack is set; the others wait in unacked until ack() is called.
+    While queued is set publishes get the SDK's offline queue mid and are never acked. Like the SDK's
+    paho client, it only takes str and bytearray payloads, so bytes fail on Python 3."""
+
+    def __init__(self, drop=0, auto_ack=True):
+        self.published = []
+        self.payloads = []
+        self.unacked = []
+        self.auto_ack = auto_ack
+        self.queued = False
+        self.disconnected = False
+        self._drop = drop
+        self._lock = threading.Lock()
+
+    def publishAsync(self, topic, payload, qos, ackCallback=None):
+        if not isinstance(payload, (str, bytearray, text_type)):
+            raise TypeError('payload must be a string, bytearray, int, float or None.')
+        with self._lock:
+            self.published.append(topic)
+            self.payloads.append(payload)
+            mid = len(self.published)
+        if self.queued:
+            return FixedEventMids.QUEUED_MID
+        if mid > self._drop and self.auto_ack:
+            threading.Timer(0.001, ackCallback, [mid]).start()
+        else:
+            self.unacked.append((mid, ackCallback))
+        return mid
+
+    def ack(self):
+        unacked, self.unacked = self.unacked, []
+        for mid, callback in unacked:
+            callback(mid)
+
+    def disconnect(self):
+        self.disconnected = True
+        return True
+
+
+def connected_mqtt(directory, client, **kwargs):
+    """Returns an MQTT that is online and publishes through client"""
+    credentials = os.path.join(str(directory), 'credentials.pem')
+    open(credentials, 'w').close()  # the SDK only checks the files exist until it connects
+    mqtt = awsiot.MQTT('localhost', credentials, credentials, credentials, **kwargs)
+    mqtt._client = client
+    mqtt._connected = True
+    return mqtt
@@ -0,0 +1,96 @@
+import threading
+
+import awsiot
+import encoding
+from fake_mqtt import FakeClient, connected_mqtt
+
+
+class Published(object):
+    def __init__(self):
+        self.batches = []
+        self.published = threading.Event()
+
+    def __call__(self, topic, doc):
+        self.batches.append((topic, doc))
+        self.published.set()
+
+
+def test_columns():
+    batch = [(100.0, {'temperature': 21.5, 'humidity': 40}),
+             (100.5, {'temperature': 21.6}),
+             (102.0, {'humidity': 41, 'pressure': 1013})]
+    assert awsiot.TelemetryBatcher.columns(batch) == {
+        't0': 100.0,
+        'dt': [0, 500, 2000],
+        'temperature': [21.5, 21.6, None],
+        'humidity': [40, None, 41],
+        'pressure': [None, None, 1013],
+    }
+
+
+def test_batch_published_after_window():
+    published = Published()
+    batcher = awsiot.TelemetryBatcher(published, window=0.05)
+    batcher.add('t', {'v': 1}, 10.0)
+    batcher.add('t', {'v': 2}, 11.0)
+    assert published.batches == []
+    assert published.published.wait(1)
+    assert published.batches == [('t', {'t0': 10.0, 'dt': [0, 1000], 'v': [1, 2]})]
+
+
+def test_full_batch_published_at_once():
+    published = Published()
+    batcher = awsiot.TelemetryBatcher(published, window=10, max_readings=3)
+    for i in range(7):
+        batcher.add('t', {'v': i}, float(i))
+    assert [doc['v'] for _, doc in published.batches] == [[0, 1, 2], [3, 4, 5]]
+    batcher.flush()
+    assert [doc['v'] for _, doc in published.batches] == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_topics_kept_apart():
+    published = Published()
+    batcher = awsiot.TelemetryBatcher(published, window=10)
+    batcher.add('a', {'v': 1}, 1.0)
+    batcher.add('b', {'v': 2}, 1.0)
+    batcher.flush('a')
+    assert published.batches == [('a', {'t0': 1.0, 'dt': [0], 'v': [1]})]
+    batcher.flush()
+    assert published.batches[-1] == ('b', {'t0': 1.0, 'dt': [0], 'v': [2]})
+
+
+def test_failed_publish_not_raised():
+    def publish(topic, doc):
+        raise Exception("offline")
+    batcher = awsiot.TelemetryBatcher(publish, window=10, max_readings=1)
+    batcher.add('t', {'v': 1})
+
+
+def test_mqtt_batches_readings(tmpdir):
+    client = FakeClient()
+    mqtt = connected_mqtt(tmpdir, client, batch_window=10, batch_size=2)
+    mqtt.publish_reading('home/dht', {'temperature': 21.5}, message='temperature')
+    mqtt.publish_reading('home/dht', {'temperature': 21.6}, message='temperature')
+    assert client.published == ['home/dht']
+    doc = encoding.decode(client.payloads[0])
+    assert doc['temperature'] == [21.5, 21.6]
+    assert awsiot.MESSAGE not in doc
+
+
+def test_mqtt_unbatched_reading_keeps_message(tmpdir):
+    client = FakeClient()
+    mqtt = connected_mqtt(tmpdir, client)
+    mqtt.publish_reading('home/dht', {'temperature': 21.5}, message='21.5 C')
+    assert encoding.decode(client.payloads[0]) == {'temperature': 21.5, awsiot.MESSAGE: '21.5 C'}
+
+
+def test_mqtt_batches_scaled_with_schema(tmpdir):
+    encoding.register_schema('test_batch', [('temperature', 10)])
+    client = FakeClient()
+    mqtt = connected_mqtt(tmpdir, client, batch_window=10, batch_size=2, payload_encoding=encoding.CBOR,
+                          use_schemas=True)
+    mqtt.publish_reading('home/dht', {'temperature': 21.5}, 'test_batch')
+    mqtt.publish_reading('home/dht', {'temperature': 21.6}, 'test_batch')
+    assert client.published == ['home/dht/$cbor:test_batch']
+    assert encoding.cbor_decode(client.payloads[0])['temperature'] == [215, 216]
+    assert encoding.decode_message(client.published[0], client.payloads[0])[1]['temperature'] == [21.5, 21.6]
@@ -0,0 +1,67 @@
+import json
+import threading
+
+import awsiot
+from fake_mqtt import FakeClient, connected_mqtt
+
+
+class Flushes(object):
+    def __init__(self):
+        self.updates = []
+        self.flushed = threading.Event()
+
+    def __call__(self, thing, doc, acked):
+        self.updates.append((thing, doc, acked))
+        self.flushed.set()
+
+
+def test_reports_merged_within_window():
+    flushes = Flushes()
+    coalescer = awsiot.ShadowCoalescer(flushes, window=0.05)
+    acked = []
+    coalescer.add('t', {'a': 1, 'n': {'x': 1}}, acked=lambda: acked.append(1))
+    coalescer.add('t', {'a': 2, 'n': {'y': 2}}, acked=lambda: acked.append(2))
+    assert flushes.updates == []
+    assert flushes.flushed.wait(1)
+    [(thing, doc, callback)] = flushes.updates
+    assert (thing, doc) == ('t', {'a': 2, 'n': {'x': 1, 'y': 2}})
+    callback()
+    assert acked == [1, 2]
+
+
+def test_critical_report_flushes_at_once():
+    flushes = Flushes()
+    coalescer = awsiot.ShadowCoalescer(flushes, window=10)
+    coalescer.add('t', {'a': 1})
+    coalescer.add('t', {'b': 2}, critical=True)
+    assert [(t, doc, acked) for t, doc, acked in flushes.updates] == [('t', {'a': 1, 'b': 2}, None)]
+    coalescer.add('t', {'c': 3}, critical=True)
+    assert flushes.updates[-1][:2] == ('t', {'c': 3})
+
+
+def test_things_kept_apart():
+    flushes = Flushes()
+    coalescer = awsiot.ShadowCoalescer(flushes, window=10)
+    coalescer.add('t1', {'a': 1})
+    coalescer.add('t2', {'a': 2})
+    coalescer.flush()
+    assert sorted((t, doc) for t, doc, _ in flushes.updates) == [('t1', {'a': 1}), ('t2', {'a': 2})]
+    coalescer.flush()
+    assert len(flushes.updates) == 2
+
+
+def test_failed_flush_not_raised():
+    def flush(thing, doc, acked):
+        raise Exception("offline")
+    coalescer = awsiot.ShadowCoalescer(flush, window=10)
+    coalescer.add('t', {'a': 1}, critical=True)
+
+
+def test_mqtt_coalesces_reports(tmpdir):
+    client = FakeClient()
+    mqtt = connected_mqtt(tmpdir, client, coalesce_window=0.05)
+    delivered = threading.Event()
+    mqtt.report_shadow('t', {'a': 1})
+    mqtt.report_shadow('t', {'b': 2}, acked=delivered.set)
+    assert delivered.wait(1)
+    assert [json.loads(p)[awsiot.STATE][awsiot.REPORTED] for p in client.payloads] == [{'a': 1, 'b': 2}]
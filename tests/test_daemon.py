@@ -0,0 +1,40 @@
+import os
+import threading
+
+import awsiot
+import iot_daemon
+
+COMMON = ['-e', 'abc123.iot.us-east-1.amazonaws.com', '-r', 'root-CA.crt', '-c', 'thing.cert.pem',
+          '-k', 'thing.private.key', '--encoding', 'cbor']
+
+
+def test_shared_overrides():
+    dht_pub = iot_daemon.load_script('dht_pub_0', os.path.join(iot_daemon.SCRIPT_DIR, 'dht_pub.py'))
+    common_args = awsiot.iot_arg_parser().parse_args(COMMON)
+    device_args = dht_pub.arg_parser().parse_args(COMMON + ['-p', '22', '-t', 'home/garage/dht'])
+    assert iot_daemon.shared_overrides(common_args, device_args) == []
+    device_args = dht_pub.arg_parser().parse_args(COMMON + ['-p', '22', '--encoding', 'json', '--batch_window', '5'])
+    assert iot_daemon.shared_overrides(common_args, device_args) == ['encoding', 'batch_window']
+
+
+class SlowDevice(object):
+    def __init__(self):
+        self.reports = 0
+        self.reported = threading.Event()
+
+    def report(self):
+        self.reports += 1
+        if self.reports == 1:
+            raise IOError("sensor busy")  # a failed report does not stop the next ones
+        self.reported.set()
+
+
+def test_report_device():
+    device = SlowDevice()
+    stop = threading.Event()
+    t = threading.Thread(target=iot_daemon.report_device, args=('slow_0', device, 0.01, stop))
+    t.start()
+    assert device.reported.wait(1)
+    stop.set()
+    t.join(1)
+    assert not t.is_alive()
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+import awsiot
+
+
+def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        threading.Event().wait(0.005)
+    assert condition()
+
+
+def blocked(dispatcher, key, ran):
+    """Submits a job for key that runs until the returned event is set"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def job():
+        started.set()
+        release.wait(1)
+        ran.append(0)
+    dispatcher.submit(key, job)
+    assert started.wait(1)
+    return release
+
+
+def test_same_key_runs_in_order_one_at_a_time():
+    dispatcher = awsiot.Dispatcher(workers=4, max_pending=100)
+    ran = []
+    active = []
+    overlaps = []
+
+    def job(i):
+        active.append(i)
+        if len(active) > 1:
+            overlaps.append(list(active))
+        threading.Event().wait(0.001)
+        ran.append(i)
+        active.remove(i)
+    for i in range(20):
+        assert dispatcher.submit('key', job, i)
+    wait_for(lambda: len(ran) == 20)
+    assert ran == list(range(20))
+    assert overlaps == []
+
+
+def test_keys_run_concurrently():
+    dispatcher = awsiot.Dispatcher(workers=2)
+    ran = []
+    release = blocked(dispatcher, 'slow', ran)
+    done = threading.Event()
+    dispatcher.submit('fast', done.set)
+    assert done.wait(1)
+    release.set()
+
+
+@pytest.mark.parametrize('policy, accepted, expected', [
+    (awsiot.DISPATCH_DROP_OLDEST, [True] * 5, [0, 4, 5]),
+    (awsiot.DISPATCH_DROP_NEWEST, [True, True, False, False, False], [0, 1, 2]),
+    (awsiot.DISPATCH_COALESCE, [True] * 5, [0, 5]),
+])
+def test_policies(policy, accepted, expected):
+    dispatcher = awsiot.Dispatcher(workers=1, max_pending=2, policy=policy)
+    ran = []
+    release = blocked(dispatcher, 'key', ran)
+    assert [dispatcher.submit('key', ran.append, i) for i in range(1, 6)] == accepted
+    assert dispatcher.pending == len(expected) - 1
+    release.set()
+    wait_for(lambda: dispatcher.pending == 0 and len(ran) == len(expected))
+    assert ran == expected
+
+
+def test_failing_job_does_not_stop_key():
+    dispatcher = awsiot.Dispatcher(workers=1)
+    done = threading.Event()
+    dispatcher.submit('key', lambda: 1 / 0)
+    dispatcher.submit('key', done.set)
+    assert done.wait(1)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        awsiot.Dispatcher(policy='drop_all')
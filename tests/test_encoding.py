@@ -0,0 +1,133 @@
+import json
+import math
+import struct
+
+import pytest
+
+import encoding
+
+DOC = {'distance': 48.7, 'temperature': 21.5, 'count': 3, 'negative': -1000, 'big': 2 ** 40,
+       'flag': True, 'off': False, 'none': None, 'name': u'garag\xe9', 'list': [1, 2.25, 'x'],
+       'nested': {'a': [{'b': 1}]}}
+
+
+def test_cbor_round_trip():
+    assert encoding.cbor_decode(encoding.cbor_encode(DOC)) == DOC
+
+
+@pytest.mark.parametrize('value', [0.0, 1.5, -2.75, 48.7, 0.1, 16777216.0, 16777217.0, 1e-7, 3.4e38, 1e300, 1535212395.123456,
+                                   float('inf'), -float('inf')])
+def test_cbor_float_round_trip(value):
+    assert encoding.cbor_decode(encoding.cbor_encode(value)) == value
+
+
+def test_cbor_nan():
+    assert math.isnan(encoding.cbor_decode(encoding.cbor_encode(float('nan'))))
+
+
+def test_cbor_float_sizes():
+    assert len(encoding.cbor_encode(1.5)) == (3 if encoding._half_precision else 5)
+    assert len(encoding.cbor_encode(100000.0)) == 5
+    assert len(encoding.cbor_encode(48.7)) == 9  # not exact in single precision
+    assert len(encoding.cbor_encode(1535212395.123456)) == 9
+
+
+def test_cbor_singles_decoded_verbatim():
+    for value in (16777216.0, 48.7):
+        single = struct.unpack('>f', struct.pack('>f', value))[0]
+        assert encoding.cbor_decode(b'\xfa' + struct.pack('>f', value)) == single
+
+
+def test_cbor_integer_sizes():
+    assert encoding.cbor_encode(23) == b'\x17'
+    assert encoding.cbor_encode(24) == b'\x18\x18'
+    assert encoding.cbor_encode(-1) == b'\x20'
+    assert encoding.cbor_encode(65536) == b'\x1a\x00\x01\x00\x00'
+
+
+def test_cbor_bytes():
+    assert encoding.cbor_decode(encoding.cbor_encode(bytearray(b'\x00\xff'))) == b'\x00\xff'
+
+
+def test_cbor_trailing_bytes():
+    with pytest.raises(ValueError):
+        encoding.cbor_decode(encoding.cbor_encode(1) + b'\x00')
+
+
+def test_schema_round_trip():
+    encoding.register_schema('test_distance', ['distance', 'timestamp'])
+    doc = {'distance': 48.7, 'timestamp': 1535212395}
+    payload = encoding.encode(doc, encoding.CBOR, 'test_distance')
+    assert encoding.cbor_decode(payload) == [48.7, 1535212395]
+    assert encoding.decode(payload, encoding.CBOR, 'test_distance') == doc
+
+
+def test_scaled_schema_round_trip():
+    encoding.register_schema('test_dht', [('temperature', 10), ('humidity', 10), 'timestamp'])
+    doc = {'temperature': -22.3, 'humidity': 48.7, 'timestamp': 1535212395}
+    payload = encoding.encode(doc, encoding.CBOR, 'test_dht')
+    assert encoding.cbor_decode(payload) == [-223, 487, 1535212395]
+    assert encoding.decode(payload, encoding.CBOR, 'test_dht') == doc
+    missing = encoding.encode({'temperature': 22.3}, encoding.CBOR, 'test_dht')
+    assert encoding.decode(missing, encoding.CBOR, 'test_dht') == {'temperature': 22.3, 'humidity': None,
+                                                                   'timestamp': None}
+
+
+@pytest.mark.parametrize('schema, doc', [(encoding.DHT, {'temperature': 22.3, 'humidity': 48.7}),
+                                         (encoding.DISTANCE, {'distance': 48.7})])
+def test_sensor_schema_smaller_than_json(schema, doc):
+    payload = encoding.encode(doc, encoding.CBOR, schema)
+    assert len(payload) < len(encoding._json_encode(sorted(doc.values())))
+    assert len(payload) < len(encoding._json_encode(doc))
+    assert encoding.decode(payload, encoding.CBOR, schema) == doc
+
+
+def test_scaled_schema_columns():
+    encoding.register_schema('test_columns', [('temperature', 10)])
+    doc = {'t0': 100.0, 'dt': [0, 500], 'temperature': [21.5, None], 'humidity': [40.2, 41.0]}
+    payload = encoding.encode_columns(doc, encoding.CBOR, 'test_columns')
+    assert encoding.cbor_decode(payload)['temperature'] == [215, None]
+    assert encoding.decode(payload, encoding.CBOR, 'test_columns') == doc
+    assert len(payload) < len(encoding.encode_columns(doc, encoding.JSON))
+
+
+def test_unknown_schema():
+    with pytest.raises(ValueError):
+        encoding.decode(encoding.cbor_encode([1]), encoding.CBOR, 'no_such_schema')
+
+
+def test_json_is_compact():
+    assert json.loads(encoding.encode(DOC)) == DOC
+    assert ' ' not in encoding.encode({'a': 1, 'b': [1, 2]})
+
+
+@pytest.mark.parametrize('name', encoding.names())
+def test_payloads_publishable(name):
+    # the SDK's paho client takes str or bytearray, not bytes
+    payload = encoding.encode({'temperature': 21.5}, name)
+    assert isinstance(payload, str if name == encoding.JSON else bytearray)
+
+
+def test_python_cbor_encoder(monkeypatch):
+    doc = [1.5, 48.7, 100000.0, -1000, 2 ** 40, u'garag\xe9', None, True, {'a': [1, 2.25]}]
+    payload = encoding.cbor_encode(doc)  # cbor2's C encoder if it is installed
+    monkeypatch.setattr(encoding, '_c_cbor', False)
+    assert encoding.cbor_encode(doc) == payload
+    assert encoding.cbor_decode(encoding.cbor_encode(DOC)) == DOC
+
+
+def test_topic_hints():
+    assert encoding.hint_topic('home/garage/distance') == 'home/garage/distance'
+    assert encoding.hint_topic('home/garage/distance', encoding.CBOR) == 'home/garage/distance/$cbor'
+    assert encoding.hint_topic('home/garage/distance', encoding.CBOR, 'distance') == \
+        'home/garage/distance/$cbor:distance'
+    assert encoding.split_topic('home/garage/distance/$cbor:distance') == \
+        ('home/garage/distance', encoding.CBOR, 'distance')
+    assert encoding.split_topic('home/garage/distance/$cbor') == ('home/garage/distance', encoding.CBOR, None)
+    assert encoding.split_topic('home/garage/$unknown') == ('home/garage/$unknown', encoding.JSON, None)
+
+
+def test_decode_message():
+    topic = encoding.hint_topic('home/garage/distance', encoding.CBOR)
+    assert encoding.decode_message(topic, encoding.encode(DOC, encoding.CBOR)) == ('home/garage/distance', DOC)
+    assert encoding.decode_message('home/garage/distance', b'{"a":1}') == ('home/garage/distance', {'a': 1})
@@ -0,0 +1,132 @@
+import json
+import time
+import threading
+
+import pytest
+
+import awsiot
+import hardware
+import pir_pub
+from fake_mqtt import FakeClient, connected_mqtt
+
+
+class Reports(object):
+    def __init__(self):
+        self.reports = []
+        self.threads = []
+        self.times = []
+        self.reported = threading.Event()
+
+    def __call__(self, state, count):
+        self.reports.append((state, count))
+        self.threads.append(threading.current_thread())
+        self.times.append(time.time())
+        self.reported.set()
+
+    def wait(self):
+        assert self.reported.wait(1)
+        self.reported.clear()
+
+
+def test_change_reported_off_caller_thread():
+    reports = Reports()
+    shaper = awsiot.EventShaper(reports, hold=0, window=0)
+    shaper.update(1)
+    reports.wait()
+    assert reports.reports == [(1, 1)]
+    assert reports.threads[0] is not threading.current_thread()
+
+
+def test_burst_reported_once_with_edge_count():
+    reports = Reports()
+    shaper = awsiot.EventShaper(reports, hold=0.05, window=0)
+    for state in (1, 0, 1, 0, 1):
+        shaper.update(state)
+    reports.wait()
+    time.sleep(0.1)
+    assert reports.reports == [(1, 5)]
+
+
+def test_repeated_state_not_an_edge():
+    reports = Reports()
+    shaper = awsiot.EventShaper(reports, hold=0.05, window=0)
+    for state in (1, 1, 1):
+        shaper.update(state)
+    reports.wait()
+    assert reports.reports == [(1, 1)]
+
+
+def test_burst_back_to_reported_state_not_reported():
+    reports = Reports()
+    shaper = awsiot.EventShaper(reports, hold=0.05, window=0)
+    shaper.update(1)
+    reports.wait()
+    shaper.update(0)
+    shaper.update(1)
+    time.sleep(0.2)
+    assert reports.reports == [(1, 1)]
+
+
+def test_changes_within_window_coalesced():
+    reports = Reports()
+    shaper = awsiot.EventShaper(reports, hold=0, window=0.2)
+    shaper.update(1)
+    reports.wait()
+    shaper.update(0)
+    shaper.update(1)
+    shaper.update(0)
+    reports.wait()
+    assert reports.reports == [(1, 1), (0, 3)]
+    assert reports.times[1] - reports.times[0] >= 0.19
+
+
+def test_failing_report_does_not_stop_shaper():
+    reports = Reports()
+    calls = []
+
+    def report(state, count):
+        calls.append(state)
+        if len(calls) == 1:
+            raise Exception("offline")
+        reports(state, count)
+    shaper = awsiot.EventShaper(report, hold=0, window=0)
+    shaper.update(1)
+    time.sleep(0.05)
+    shaper.update(0)
+    reports.wait()
+    assert reports.reports == [(0, 1)]
+
+
+@pytest.fixture
+def motion_sensor(tmpdir, monkeypatch):
+    """Starts pir_pub with args on a simulated sensor that never fires, returns the client it publishes to"""
+    for name in ('backend', 'trace_dir', 'speed'):
+        monkeypatch.setattr(hardware, name, getattr(hardware, name))  # configure() sets them
+    tmpdir.join('motion.trace').write('0 0\n')
+
+    def start(*args):
+        client = FakeClient()
+        pir_pub.start(pir_pub.arg_parser().parse_args(
+            ['-e', 'localhost', '-r', 'ca', '-c', 'cert', '-k', 'key', '--hardware', hardware.SIM,
+             '--trace_dir', str(tmpdir), '-p', '4', '-s', 'motion', '-t', 'home/motion'] + list(args)),
+            connected_mqtt(tmpdir, client))
+        return client
+    return start
+
+
+def test_unshaped_event_keeps_payload(motion_sensor):
+    client = motion_sensor()
+    pir_pub.motion()  # published on the calling thread when shaping is off
+    assert client.published[0] == 'home/motion'
+    assert json.loads(client.payloads[0]) == {'motion': 1, awsiot.MESSAGE: 'motion 1'}
+
+
+def test_edge_count_on_request(motion_sensor):
+    client = motion_sensor('--hold', '0.05', '--edge_count')
+    pir_pub.motion()
+    pir_pub.no_motion()
+    pir_pub.motion()
+    deadline = time.time() + 1
+    while len(client.published) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert json.loads(client.payloads[0]) == {'motion': 1, 'count': 3, awsiot.MESSAGE: 'motion 1'}
@@ -0,0 +1,91 @@
+import pytest
+
+import awsiot
+
+
+class FakeDynamoDB(object):
+    """Answers batch_get_item from names, leaving the keys in unprocessed unprocessed"""
+
+    def __init__(self, names, unprocessed=()):
+        self.names = names
+        self.unprocessed = set(unprocessed)
+        self.requests = []
+
+    def batch_get_item(self, RequestItems):
+        table, request = list(RequestItems.items())[0]
+        ids = [key['id']['S'] for key in request['Keys']]
+        self.requests.append(ids)
+        left = [i for i in ids if i in self.unprocessed]
+        items = [{'id': {'S': i}, 'name': {'S': self.names[i]}} for i in ids if i in self.names and i not in left]
+        response = {'Responses': {table: items}}
+        if len(left) > 0:
+            response['UnprocessedKeys'] = {table: dict(request, Keys=[{'id': {'S': i}} for i in left])}
+        return response
+
+    def get_paginator(self, operation):
+        assert operation == 'scan'
+        return self
+
+    def paginate(self, **kwargs):
+        items = [{'id': {'S': i}, 'name': {'S': n}} for i, n in sorted(self.names.items())]
+        for i in range(0, len(items), 50):
+            yield {'Items': items[i:i + 50]}
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    client = FakeDynamoDB({'face{}'.format(i): 'name{}'.format(i) for i in range(0, 250, 2)})
+    monkeypatch.setattr(awsiot, 'face_cache', awsiot.FaceCache())
+    monkeypatch.setattr(awsiot, 'aws_client', lambda service: client)
+    monkeypatch.setattr(awsiot.time, 'sleep', lambda seconds: None)
+    return client
+
+
+def test_lookup_faces_chunks(dynamodb):
+    ids = ['face{}'.format(i) for i in range(250)]
+    names = awsiot.lookup_faces(ids + ids[:10])
+    assert [len(r) for r in dynamodb.requests] == [100, 100, 50]
+    assert sorted(i for r in dynamodb.requests for i in r) == sorted(ids)
+    assert names['face0'] == 'name0'
+    assert names['face1'] is None
+    assert len(names) == 250
+
+
+def test_lookup_faces_cached(dynamodb):
+    awsiot.lookup_faces(['face0', 'face1'])
+    assert awsiot.lookup_faces(['face0', 'face1', 'face2']) == {'face0': 'name0', 'face1': None, 'face2': 'name2'}
+    assert [sorted(r) for r in dynamodb.requests] == [['face0', 'face1'], ['face2']]
+
+
+def test_lookup_faces_unprocessed_not_cached(dynamodb):
+    dynamodb.unprocessed = {'face4'}
+    assert awsiot.lookup_faces(['face2', 'face4']) == {'face2': 'name2', 'face4': None}
+    assert len(dynamodb.requests) == awsiot.BATCH_GET_RETRIES
+    dynamodb.unprocessed = set()
+    dynamodb.requests = []
+    assert awsiot.lookup_faces(['face2', 'face4']) == {'face2': 'name2', 'face4': 'name4'}
+    assert dynamodb.requests == [['face4']]
+
+
+def test_lookup_faces_retries_unprocessed(dynamodb):
+    calls = []
+    batch_get_item = dynamodb.batch_get_item
+
+    def flaky(RequestItems):
+        calls.append(1)
+        if len(calls) == 1:
+            dynamodb.unprocessed = {'face6'}
+        else:
+            dynamodb.unprocessed = set()
+        return batch_get_item(RequestItems)
+
+    dynamodb.batch_get_item = flaky
+    assert awsiot.lookup_faces(['face6', 'face8']) == {'face6': 'name6', 'face8': 'name8'}
+    assert dynamodb.requests[1] == ['face6']
+
+
+def test_warm_face_cache(dynamodb, monkeypatch):
+    monkeypatch.setattr(awsiot, '_face_cache_warmed', awsiot.threading.Event())
+    assert awsiot.warm_face_cache() == len(dynamodb.names)
+    assert awsiot.lookup_faces(['face0', 'face248']) == {'face0': 'name0', 'face248': 'name248'}
+    assert dynamodb.requests == []
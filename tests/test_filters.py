@@ -0,0 +1,68 @@
+import pytest
+
+import filters
+
+READINGS = [100.2, 99.8, 100.1, 400.0, 100.0, 99.9, 3.0, 100.3]
+
+
+def test_inliers():
+    assert list(filters.inliers(READINGS)) == [True, True, True, False, True, True, False, True]
+
+
+def test_inliers_steady_window():
+    # the noise floor keeps a reading just off a perfectly steady window
+    assert all(filters.inliers([50.0, 50.0, 50.0, 50.0, 51.0]))
+
+
+def test_robust_median():
+    assert filters.robust_median(READINGS) == pytest.approx(100.05)
+    assert filters.robust_median([]) is None
+    assert filters.robust_median([7, 1000]) == 503.5  # too few readings to judge outliers
+
+
+def test_ring_buffer():
+    b = filters.RingBuffer(3)
+    assert len(b) == 0
+    for v in range(5):
+        b.append(v)
+    assert len(b) == 3
+    assert sorted(b.window()) == [2.0, 3.0, 4.0]
+
+
+def test_filter_rejects_outliers():
+    f = filters.Filter()
+    results = [f.update(v) for v in READINGS]
+    assert results[3] is None
+    assert results[6] is None
+    assert all(abs(r - 100) < 1 for r in results if r is not None)
+
+
+def test_filter_follows_level_change():
+    f = filters.Filter(size=9)
+    for _ in range(9):
+        f.update(100.0)
+    results = [f.update(200.0) for _ in range(9)]
+    assert results[0] is None
+    assert results[-1] == 200.0
+
+
+def test_filter_ema():
+    f = filters.Filter(method=filters.EMA, alpha=0.5)
+    assert f.update(10) == 10
+    assert f.update(12) == 11
+
+
+def test_filter_kalman():
+    f = filters.Filter(method=filters.KALMAN)
+    assert f.update(10) == 10
+    assert 10 < f.update(12) < 12
+
+
+def test_filter_unknown_method():
+    with pytest.raises(ValueError):
+        filters.Filter(method='mean')
+
+
+def test_speed_of_sound():
+    assert filters.speed_of_sound(0) == pytest.approx(33130.0)
+    assert filters.speed_of_sound(20) > filters.speed_of_sound(0)
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+import metrics
+
+
+def test_histogram_buckets():
+    h = metrics.Histogram([0.1, 1.0])
+    for v in (0.05, 0.1, 0.5, 2.0):
+        h.observe(v)
+    assert h.counts == [2, 1, 1]
+    assert h.count == 4
+    assert h.sum == pytest.approx(2.65)
+    assert h.max == 2.0
+
+
+def test_histogram_percentiles():
+    h = metrics.Histogram()
+    assert h.percentile(50) == 0.0
+    for _ in range(98):
+        h.observe(0.003)
+    h.observe(0.3)
+    h.observe(40.0)
+    assert h.percentile(50) == 0.005
+    assert h.percentile(99) == 0.5
+    assert h.percentile(100) == 40.0
+
+
+def test_percentile_not_above_max():
+    h = metrics.Histogram()
+    h.observe(0.0012)
+    assert h.percentile(50) == 0.0012
+
+
+def test_counters_concurrent():
+    m = metrics.Metrics()
+
+    def count():
+        for _ in range(1000):
+            m.increment('events')
+            m.observe('latency_seconds', 0.001)
+    threads = [threading.Thread(target=count) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    summary = m.summary()
+    assert summary['events'] == 8000
+    assert summary['latency_seconds'][0] == 8000
+
+
+def test_gauges():
+    m = metrics.Metrics()
+    m.set_gauge('depth', 3)
+    m.gauge('queue', lambda: 7)
+    m.gauge('broken', lambda: 1 / 0)
+    summary = m.summary()
+    assert summary['depth'] == 3
+    assert summary['queue'] == 7
+    assert 'broken' not in summary
+
+
+def test_timed_records_when_raising():
+    m = metrics.Metrics()
+    with pytest.raises(ValueError):
+        with m.timed('work_seconds'):
+            raise ValueError()
+    assert m.summary()['work_seconds'][0] == 1
+
+
+def test_text():
+    m = metrics.Metrics()
+    m.increment('published', 2)
+    m.set_gauge('connected', 1)
+    m._histograms['ack_seconds'] = metrics.Histogram([0.1, 1.0])
+    m.observe('ack_seconds', 0.05)
+    m.observe('ack_seconds', 0.5)
+    m.observe('ack_seconds', 5.0)
+    assert m.text().splitlines() == [
+        '# TYPE published counter',
+        'published 2',
+        '# TYPE connected gauge',
+        'connected 1.0',
+        '# TYPE ack_seconds histogram',
+        'ack_seconds_bucket{le="0.1"} 1',
+        'ack_seconds_bucket{le="1.0"} 2',
+        'ack_seconds_bucket{le="+Inf"} 3',
+        'ack_seconds_sum 5.55',
+        'ack_seconds_count 3',
+    ]
+
+
+def test_serve():
+    m = metrics.Metrics()
+    m.increment('published')
+    server = metrics.serve(0, m)
+    try:
+        body = urlopen('http://127.0.0.1:{}/'.format(server.server_address[1])).read().decode('utf-8')
+    finally:
+        server.shutdown()
+    assert body == m.text()
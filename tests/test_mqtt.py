@@ -0,0 +1,64 @@
+import threading
+
+import metrics
+from fake_mqtt import FakeClient, connected_mqtt
+
+
+def test_publish_acked(tmpdir):
+    client = FakeClient()
+    mqtt = connected_mqtt(tmpdir, client)
+    delivered = threading.Event()
+    assert mqtt.publish('t', 'x', acked=delivered.set)
+    assert delivered.wait(1)
+    assert len(mqtt._inflight) == 0
+
+
+def test_publish_qos0_acked_at_once(tmpdir):
+    client = FakeClient(auto_ack=False)
+    mqtt = connected_mqtt(tmpdir, client)
+    delivered = threading.Event()
+    mqtt.publish('t', 'x', qos=0, acked=delivered.set)
+    assert delivered.is_set()
+    assert len(mqtt._inflight) == 0
+
+
+def test_publish_acked_before_publish_returns(tmpdir):
+    client = FakeClient(auto_ack=False)
+    mqtt = connected_mqtt(tmpdir, client)
+    publish_async = client.publishAsync
+
+    def ack_at_once(*args, **kwargs):
+        assert not mqtt._inflight_lock.locked()  # the SDK call may block, so no lock is held across it
+        mid = publish_async(*args, **kwargs)
+        client.ack()
+        return mid
+    client.publishAsync = ack_at_once
+    calls = []
+    assert mqtt.publish('t', 'x', acked=lambda: calls.append('acked'))
+    assert calls == ['acked']
+    assert len(mqtt._inflight) == 0
+    assert len(mqtt._early_acks) == 0
+
+
+def test_publish_queued_offline_not_tracked(tmpdir):
+    client = FakeClient()
+    client.queued = True
+    mqtt = connected_mqtt(tmpdir, client)
+    calls = []
+    assert not mqtt.publish('t', 'x', acked=lambda: calls.append('acked'), failed=lambda: calls.append('failed'))
+    assert not mqtt.publish('t', 'y')
+    assert len(mqtt._inflight) == 0
+    assert metrics.registry.summary()['mqtt_inflight'] == 0
+    assert calls == []
+
+
+def test_publish_error_calls_failed(tmpdir):
+    client = FakeClient()
+    mqtt = connected_mqtt(tmpdir, client)
+
+    def fail(*args, **kwargs):
+        raise Exception("offline")
+    client.publishAsync = fail
+    calls = []
+    mqtt.publish('t', 'x', acked=lambda: calls.append('acked'), failed=lambda: calls.append('failed'))
+    assert calls == ['failed']
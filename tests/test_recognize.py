@@ -0,0 +1,140 @@
+import io
+import os
+import time
+import threading
+
+import pytest
+import PIL.Image
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')  # recognize creates its clients on import
+import recognize
+
+RED = (255, 0, 0)
+BLUE = (0, 0, 255)
+
+
+def jpeg(size, boxes):
+    """Returns a grey JPEG of size with each (box, color) filled, box in Rekognition's relative units"""
+    image = PIL.Image.new('RGB', size, (128, 128, 128))
+    for box, color in boxes:
+        x, y = int(box['Left'] * size[0]), int(box['Top'] * size[1])
+        image.paste(color, (x, y, x + int(box['Width'] * size[0]), y + int(box['Height'] * size[1])))
+    stream = io.BytesIO()
+    image.save(stream, format='JPEG', quality=95)
+    return stream.getvalue()
+
+
+def box(left, top, width, height):
+    return {'Left': left, 'Top': top, 'Width': width, 'Height': height}
+
+
+class FakeRekognition(object):
+    """Finds faces at boxes and matches a face crop by the color at its center, answering the
+    colors in delays that many seconds late"""
+
+    def __init__(self, boxes, delays=None):
+        self.boxes = boxes
+        self.delays = delays or {}
+        self.crops = []
+        self._lock = threading.Lock()
+
+    def detect_labels(self, Image, MinConfidence):
+        return {'Labels': [{'Name': 'Person'}, {'Name': 'Car'}]}
+
+    def detect_faces(self, Image):
+        return {'FaceDetails': [{'BoundingBox': b} for b in self.boxes]}
+
+    def search_faces_by_image(self, CollectionId, Image):
+        crop = PIL.Image.open(io.BytesIO(Image['Bytes']))
+        r, g, b = crop.convert('RGB').getpixel((crop.size[0] // 2, crop.size[1] // 2))
+        color = RED if r > b else BLUE
+        with self._lock:
+            self.crops.append(crop)
+        time.sleep(self.delays.get(color, 0))
+        return {'FaceMatches': [{'Face': {'FaceId': 'red' if color == RED else 'blue'}}]}
+
+
+class FakeDynamoDB(object):
+    def get_item(self, TableName, Key):
+        return {'Item': {'name': {'S': Key['id']['S'].capitalize()}}}
+
+
+class FakeS3(object):
+    def __init__(self, body):
+        self.body = body
+        self.tag_sets = []
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.body)}
+
+    def get_object_tagging(self, Bucket, Key):
+        return {'TagSet': [{'Key': 'camera', 'Value': 'garage'}]}
+
+    def put_object_tagging(self, Bucket, Key, Tagging):
+        self.tag_sets.append(Tagging['TagSet'])
+
+
+RECORD = {'s3': {'bucket': {'name': 'snapshots'}, 'object': {'key': 'garage.jpg'}}}
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    def install(size, boxes, delays=None):
+        rekognition = FakeRekognition([b for b, _ in boxes], delays)
+        s3 = FakeS3(jpeg(size, boxes))
+        monkeypatch.setattr(recognize, 'rekognition', rekognition)
+        monkeypatch.setattr(recognize, 's3', s3)
+        monkeypatch.setattr(recognize, 'dynamodb', FakeDynamoDB())
+        return rekognition, s3
+    return install
+
+
+def test_draft_scale():
+    faces = [{'BoundingBox': box(0.1, 0.1, 0.25, 0.25)}]
+    assert recognize.draft_scale((1600, 1200), faces) == 2  # smallest side 300 px
+    assert recognize.draft_scale((4000, 3000), faces) == 8
+    assert recognize.draft_scale((4000, 3000), faces + [{'BoundingBox': box(0.5, 0.5, 0.02, 0.02)}]) == 1
+
+
+def test_parallel_map_keeps_order():
+    def slow(i):
+        time.sleep(0.01 * (5 - i))  # later items finish first
+        return i * 10
+    assert recognize.parallel_map(slow, range(5), 5) == [0, 10, 20, 30, 40]
+    assert recognize.parallel_map(slow, [], 5) == []
+
+
+def test_parallel_map_raises():
+    def fail(i):
+        if i == 2:
+            raise ValueError(i)
+        return i
+    with pytest.raises(ValueError):
+        recognize.parallel_map(fail, range(4), 2)
+
+
+def test_face_crop_from_draft_image(clients):
+    rekognition, s3 = clients((1600, 1200), [(box(0.25, 0.25, 0.25, 0.25), RED)])
+    recognize.process_record(RECORD)
+    # decoded at half size, 800x600, so the face is 200,150 - 400,300 and the crop 180,135 - 440,330
+    assert [c.size for c in rekognition.crops] == [(260, 195)]
+    crop = rekognition.crops[0].convert('RGB')
+    assert crop.getpixel((130, 97))[0] > 200
+    assert crop.getpixel((2, 2))[0] < 200  # the corner is outside the face
+    assert dict((t['Key'], t['Value']) for t in s3.tag_sets[0]) == \
+        {'camera': 'garage', 'recognize': 'Person+Car', 'identities': 'Red'}
+
+
+def test_identities_in_face_order(clients):
+    boxes = [(box(0.1, 0.2, 0.3, 0.4), RED), (box(0.55, 0.2, 0.3, 0.4), BLUE)]
+    rekognition, s3 = clients((640, 480), boxes, delays={RED: 0.05})  # the first face answers last
+    recognize.process_record(RECORD)
+    tags = dict((t['Key'], t['Value']) for t in s3.tag_sets[0])
+    assert tags == {'camera': 'garage', 'recognize': 'Person+Car', 'identities': 'Red+Blue'}
+
+
+def test_no_tags_not_written(clients, monkeypatch):
+    rekognition, s3 = clients((640, 480), [])
+    monkeypatch.setattr(rekognition, 'detect_labels', lambda Image, MinConfidence: {})
+    recognize.process_record(RECORD)
+    assert s3.tag_sets == []
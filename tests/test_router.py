@@ -0,0 +1,86 @@
+import awsiot
+
+TOPIC = 'home/garage/light'
+MESSAGES = [
+    'home/garage/light/on',
+    'home/garage/on',
+    'home/on',
+    'home/garage/light/pulse/3',
+    'home/pulse/1',
+    'home/garage/light',
+    'home/garage/light/a/b/c',
+    'other/on',
+    'home/garage/light/dim/50',
+]
+
+
+def router():
+    r = awsiot.TopicRouter([TOPIC])
+    r.add_handler(['on', 'off'], 'switch')
+    r.add_handler('pulse', 'pulse', arg=True)
+    return r
+
+
+def test_route_matches_topic_search():
+    r = awsiot.TopicRouter([TOPIC], default='default')
+    for message in MESSAGES:
+        handler, command, arg = r.route(message)
+        assert (command, arg) == (awsiot.topic_search(TOPIC, message) or (None, None)), message
+
+
+def test_route_handlers():
+    r = router()
+    assert r.route('home/garage/light/on') == ('switch', 'on', None)
+    assert r.route('home/pulse/3') == ('pulse', 'pulse', '3')
+    assert r.route('home/garage/light/dim/50') == (None, 'dim', '50')
+    assert r.route('other/on') == (None, None, None)
+
+
+def test_subscriptions_cover_routed_messages():
+    r = router()
+    filters = r.subscriptions()
+    for message in MESSAGES:
+        handler, command, arg = r.route(message)
+        if handler is not None:
+            assert any(awsiot.topic_matches(f, message) for f in filters), message
+    assert not any(awsiot.topic_matches(f, 'home/garage/light/dim/50') for f in filters)
+
+
+def test_subscriptions_collapse_to_wildcards():
+    r = awsiot.TopicRouter([TOPIC])
+    r.add_handler(['c{}'.format(i) for i in range(awsiot.SUBSCRIPTION_COLLAPSE + 1)], 'h')
+    assert r.subscriptions() == ['home/garage/light/+', 'home/garage/+', 'home/+']
+
+
+def test_plan_subscriptions_falls_back_to_roots():
+    topics = ['home/room{}/light'.format(i) for i in range(20)]
+    assert awsiot.plan_subscriptions(topics, ['on', 'off'], max_filters=10) == ['home/#']
+    assert len(awsiot.plan_subscriptions(topics, ['on', 'off'], max_filters=None)) > 10
+
+
+def test_minimal_filters():
+    assert awsiot.minimal_filters(['a/b', 'a/+', 'a/b', 'c/#', 'c/d/+']) == ['a/+', 'c/#']
+
+
+def test_merge_subscriptions_within_limit():
+    plans = [['a/on', 'a/off'], ['b/on']]
+    filters, chosen = awsiot.merge_subscriptions(plans, [['a/#'], ['b/#']], max_filters=3)
+    assert filters == ['a/on', 'a/off', 'b/on']
+    assert chosen == plans
+
+
+def test_merge_subscriptions_largest_plan_falls_back():
+    plans = [['a/on', 'a/off', 'a/x'], ['b/on']]
+    filters, chosen = awsiot.merge_subscriptions(plans, [['a/#'], ['b/#']], max_filters=2)
+    assert filters == ['a/#', 'b/on']
+    assert chosen == [['a/#'], ['b/on']]
+
+
+def test_route_falls_back_to_shallower_topic():
+    topics = ['home/garage', 'home/garage/on/x']
+    r = awsiot.TopicRouter(topics, default='default')
+    for message in ['home/garage/on', 'home/garage/on/x/off', 'home/on/3', 'home/garage/on/x']:
+        handler, command, arg = r.route(message)
+        expected = [awsiot.topic_search(t, message) for t in topics]
+        assert (command, arg) in [e for e in expected if e is not None and e[0] is not None], message
+    assert r.route('home/garage/on') == ('default', 'on', None)
@@ -0,0 +1,30 @@
+import awsiot
+
+
+class FakeS3(object):
+    def __init__(self):
+        self.uploads = []
+
+    def upload_file(self, file_name, bucket, key, ExtraArgs=None, Config=None):
+        self.uploads.append((file_name, bucket, key, ExtraArgs, Config))
+
+
+def test_upload_args():
+    assert awsiot.s3_upload_args('garage.mp4') == {'ContentType': 'video/mp4'}
+    assert awsiot.s3_upload_args('garage.jpg', {'source': 'garage ', 'created': '2017'}) in \
+        ({'ContentType': 'image/jpeg', 'Tagging': 'source=garage&created=2017'},
+         {'ContentType': 'image/jpeg', 'Tagging': 'created=2017&source=garage'})
+    assert awsiot.s3_upload_args('garage', {}) == {}
+
+
+def test_mv_to_s3(tmpdir, monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(awsiot, '_aws_clients', {'s3': s3})
+    path = tmpdir.join('garage.jpg')
+    path.write('jpeg')
+    awsiot.mv_to_s3(str(path), 'snapshots', {'source': 'garage'})
+    (file_name, bucket, key, extra, config), = s3.uploads
+    assert (file_name, bucket, key) == (str(path), 'snapshots', str(path))
+    assert extra == {'ContentType': 'image/jpeg', 'Tagging': 'source=garage'}
+    assert config.max_concurrency == awsiot.S3_UPLOAD_CONCURRENCY
+    assert not path.exists()
@@ -0,0 +1,125 @@
+import json
+import time
+import threading
+
+import awsiot
+from fake_mqtt import FakeClient, connected_mqtt
+
+
+def reported(client):
+    return [json.loads(p)[awsiot.STATE][awsiot.REPORTED] for p in client.payloads]
+
+
+def wait(event):
+    assert event.wait(1)
+
+
+def test_delta_reports_changes_only():
+    cache = awsiot.ShadowCache()
+    changes, refresh = cache.delta('t', {'a': 1, 'b': {'c': 2, 'd': 3}})
+    assert refresh
+    cache.commit('t', changes, refresh)
+    changes, refresh = cache.delta('t', {'a': 1, 'b': {'c': 2, 'd': 4}})
+    assert (changes, refresh) == ({'b': {'d': 4}}, False)
+    cache.commit('t', changes)
+    assert cache.delta('t', {'a': 1, 'b': {'c': 2, 'd': 4}}) == ({}, False)
+
+
+def test_delta_deadband():
+    cache = awsiot.ShadowCache(deadbands={'temperature': 0.5})
+    cache.commit('t', *cache.delta('t', {'temperature': 20.0}))
+    assert cache.delta('t', {'temperature': 20.4}) == ({}, False)
+    assert cache.delta('t', {'temperature': 20.6}) == ({'temperature': 20.6}, False)
+
+
+def test_refresh_reports_everything():
+    cache = awsiot.ShadowCache(refresh=0)
+    cache.commit('t', *cache.delta('t', {'a': 1, 'b': 2}))
+    assert cache.delta('t', {'b': 3}) == ({'a': 1, 'b': 3}, True)
+
+
+def test_delta_against_reports_in_flight():
+    cache = awsiot.ShadowCache()
+    cache.commit('t', *cache.delta('t', {'motion': 0}))
+    on, _ = cache.delta('t', {'motion': 1})
+    assert on == {'motion': 1}
+    assert cache.delta('t', {'motion': 1}) == ({}, False)
+    off, _ = cache.delta('t', {'motion': 0})
+    assert off == {'motion': 0}
+    cache.commit('t', on)
+    cache.commit('t', off)
+    assert cache.delta('t', {'motion': 0}) == ({}, False)
+
+
+def test_rollback_reports_again():
+    cache = awsiot.ShadowCache()
+    cache.commit('t', *cache.delta('t', {'motion': 0, 'light': 1}))
+    changes, _ = cache.delta('t', {'motion': 1})
+    cache.rollback('t', changes)
+    assert cache.delta('t', {'motion': 0, 'light': 1}) == ({'motion': 0}, False)
+
+
+def test_unacknowledged_report_expires():
+    cache = awsiot.ShadowCache(ack_timeout=0.05)
+    cache.commit('t', *cache.delta('t', {'motion': 0}))
+    cache.delta('t', {'motion': 1})
+    time.sleep(0.1)
+    assert cache.delta('t', {'motion': 1}) == ({'motion': 1}, False)
+
+
+def test_cache_file(tmpdir):
+    path = str(tmpdir.join('shadow.json'))
+    cache = awsiot.ShadowCache(path=path)
+    cache.commit('t', *cache.delta('t', {'a': 1}))
+    assert awsiot.ShadowCache(path=path).delta('t', {'a': 1}) == ({}, False)
+
+
+def test_report_reverted_while_unacknowledged(tmpdir):
+    client = FakeClient()
+    mqtt = connected_mqtt(tmpdir, client, shadow_cache=awsiot.ShadowCache())
+    delivered = threading.Event()
+    mqtt.report_shadow('pir', {'motion': 0}, acked=delivered.set)
+    wait(delivered)
+    client.auto_ack = False  # queued by the SDK while offline
+    mqtt.report_shadow('pir', {'motion': 1})
+    mqtt.report_shadow('pir', {'motion': 0})
+    assert reported(client) == [{'motion': 0}, {'motion': 1}, {'motion': 0}]
+    client.ack()
+    mqtt.report_shadow('pir', {'motion': 0})
+    assert len(client.payloads) == 3
+
+
+def test_failed_report_rolled_back(tmpdir):
+    client = FakeClient()
+    mqtt = connected_mqtt(tmpdir, client, shadow_cache=awsiot.ShadowCache())
+    delivered = threading.Event()
+    mqtt.report_shadow('pir', {'motion': 0}, acked=delivered.set)
+    wait(delivered)
+
+    def fail(*args, **kwargs):
+        raise Exception("offline")
+    publish = client.publishAsync
+    client.publishAsync = fail
+    mqtt.report_shadow('pir', {'motion': 1})
+    client.publishAsync = publish
+    mqtt.report_shadow('pir', {'motion': 1})
+    assert reported(client) == [{'motion': 0}, {'motion': 1}]
+
+
+def test_disconnect_waits_for_acks(tmpdir):
+    path = str(tmpdir.join('shadow.json'))
+    client = FakeClient()
+    mqtt = connected_mqtt(tmpdir, client, shadow_cache=awsiot.ShadowCache(path=path))
+    mqtt.report_shadow('host', {'cpu': 4})
+    mqtt.disconnect()
+    assert client.disconnected
+    assert awsiot.ShadowCache(path=path).delta('host', {'cpu': 4}) == ({}, False)
+
+
+def test_disconnect_gives_up_on_acks(tmpdir, monkeypatch):
+    monkeypatch.setattr(awsiot, 'DISCONNECT_ACK_TIMEOUT', 0.1)
+    client = FakeClient(auto_ack=False)
+    mqtt = connected_mqtt(tmpdir, client)
+    mqtt.publish('t', 'x')
+    mqtt.disconnect()
+    assert client.disconnected
@@ -0,0 +1,174 @@
+import os
+import threading
+
+import spool
+import awsiot
+from fake_mqtt import FakeClient, connected_mqtt
+
+
+def fill(s, n, prefix='t'):
+    for i in range(n):
+        assert s.append('{}/{}'.format(prefix, i), '{"i": %d}' % i)
+
+
+def read_all(s):
+    records = []
+    while True:
+        record = s.read()
+        if record is None:
+            return records
+        records.append(record)
+
+
+def test_read_ack_in_order(tmpdir):
+    s = spool.Spool(str(tmpdir))
+    fill(s, 5)
+    records = read_all(s)
+    assert [r[1] for r in records] == ['t/{}'.format(i) for i in range(5)]
+    assert s.in_flight == 5
+    for r in records:
+        s.ack(r[0])
+    assert s.in_flight == 0
+    assert s.acked == 5
+    assert not s.pending()
+
+
+def test_binary_payload(tmpdir):
+    s = spool.Spool(str(tmpdir))
+    s.append('t', bytearray(b'\xff\x00\xfe'), 0)
+    position, topic, payload, qos = s.read()
+    assert (topic, payload, qos) == ('t', b'\xff\x00\xfe', 0)
+    assert isinstance(payload, bytearray)  # the SDK takes no bytes on Python 3
+
+
+def test_reload_resends_unacked(tmpdir):
+    s = spool.Spool(str(tmpdir))
+    fill(s, 6)
+    records = read_all(s)
+    for r in records[:3]:
+        s.ack(r[0])
+    s.ack(records[4][0])  # acked out of order, still behind an unacked record
+    s.close()
+
+    s = spool.Spool(str(tmpdir))
+    assert [r[1] for r in read_all(s)] == ['t/3', 't/4', 't/5']
+
+
+def test_crash_without_close_resends(tmpdir):
+    s = spool.Spool(str(tmpdir))
+    fill(s, 3)
+    read_all(s)  # sent, never acked, and the process dies
+    s = spool.Spool(str(tmpdir))
+    assert [r[1] for r in read_all(s)] == ['t/0', 't/1', 't/2']
+
+
+def test_rewind(tmpdir):
+    s = spool.Spool(str(tmpdir))
+    fill(s, 4)
+    records = read_all(s)
+    s.ack(records[0][0])
+    s.rewind()
+    assert s.in_flight == 0
+    assert [r[1] for r in read_all(s)] == ['t/1', 't/2', 't/3']
+
+
+def test_segments_removed_once_acked(tmpdir):
+    s = spool.Spool(str(tmpdir), segment_bytes=100)
+    fill(s, 20)
+    assert len([f for f in os.listdir(str(tmpdir)) if f.endswith(spool.SEGMENT_SUFFIX)]) > 1
+    for r in read_all(s):
+        s.ack(r[0])
+    assert len([f for f in os.listdir(str(tmpdir)) if f.endswith(spool.SEGMENT_SUFFIX)]) == 1
+    assert not s.pending()
+
+
+def test_truncated_segment_skipped(tmpdir):
+    s = spool.Spool(str(tmpdir), segment_bytes=100)
+    fill(s, 10)
+    s.close()
+    first = os.path.join(str(tmpdir), spool.SEGMENT_FORMAT.format(0))
+    with open(first, 'rb') as f:
+        data = f.read()
+    with open(first, 'wb') as f:
+        f.write(data[:-5])  # the last record of the first segment was cut short
+    s = spool.Spool(str(tmpdir), segment_bytes=100)
+    topics = [r[1] for r in read_all(s)]
+    assert topics[-1] == 't/9'
+    assert len(topics) == 9
+
+
+def test_drop_newest_when_full(tmpdir):
+    s = spool.Spool(str(tmpdir), max_bytes=200, drop_policy=spool.DROP_NEWEST)
+    results = [s.append('t', 'x' * 20) for _ in range(10)]
+    assert results[0]
+    assert not results[-1]
+    assert s.size <= 200
+
+
+def test_drop_oldest_when_full(tmpdir):
+    s = spool.Spool(str(tmpdir), max_bytes=400, segment_bytes=100)
+    fill(s, 40)
+    assert s.size <= 400
+    topics = [r[1] for r in read_all(s)]
+    assert topics[-1] == 't/39'
+    assert 't/0' not in topics
+
+
+def draining_mqtt(s, client):
+    return connected_mqtt(s._path, client, spool=s, drain_rate=1000, max_drain_rate=1000)
+
+
+def test_drain(tmpdir):
+    s = spool.Spool(str(tmpdir))
+    fill(s, 30)
+    client = FakeClient()
+    draining_mqtt(s, client)._drain()
+    assert client.published == ['t/{}'.format(i) for i in range(30)]
+    assert not s.pending()
+
+
+def test_drain_resends_unacked(tmpdir, monkeypatch):
+    monkeypatch.setattr(awsiot, 'DRAIN_ACK_TIMEOUT', 0.2)
+    s = spool.Spool(str(tmpdir))
+    fill(s, 30)
+    client = FakeClient(drop=awsiot.DRAIN_WINDOW)
+    draining_mqtt(s, client)._drain()
+    assert client.published[-30:] == ['t/{}'.format(i) for i in range(30)]
+    assert len(client.published) == 30 + awsiot.DRAIN_WINDOW
+    assert not s.pending()
+
+
+def test_drain_gives_up_keeps_unacked(tmpdir, monkeypatch):
+    monkeypatch.setattr(awsiot, 'DRAIN_ACK_TIMEOUT', 0.05)
+    s = spool.Spool(str(tmpdir))
+    fill(s, 5)
+    client = FakeClient(drop=1000)
+    draining_mqtt(s, client)._drain()
+    assert len(client.published) == 5 * awsiot.DRAIN_RETRIES
+    assert s.in_flight == 0
+    assert len(read_all(s)) == 5
+
+
+class LateSpool(spool.Spool):
+    """Has a record appended just as the drain finds it empty"""
+
+    late = True
+
+    def read(self):
+        record = spool.Spool.read(self)
+        if record is None and self.late and self.in_flight == 0:
+            self.late = False
+            self.append('late', '{}')
+        return record
+
+
+def test_drain_sends_record_spooled_while_finishing(tmpdir):
+    s = LateSpool(str(tmpdir))
+    fill(s, 3)
+    client = FakeClient()
+    mqtt = draining_mqtt(s, client)
+    mqtt._drain_thread = threading.current_thread()  # as _start_drain sees it while the drain finishes
+    mqtt._drain()
+    assert client.published == ['t/0', 't/1', 't/2', 'late']
+    assert mqtt._drain_thread is None
+    assert not s.pending()
@@ -0,0 +1,68 @@
+import pytest
+
+import ultrasonic
+
+TRIGGER = 23
+ECHO = 24
+
+
+class FakeGPIO(object):
+    """Stands in for RPi.GPIO. When the trigger goes low, each (delay, level) edge of the next echo
+    moves the clock on by delay, sets the echo pin to level and calls the edge callback"""
+    OUT = 'out'
+    IN = 'in'
+    LOW = 0
+    HIGH = 1
+    BOTH = 'both'
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.echoes = []
+        self.level = 0
+        self.callback = None
+
+    def setup(self, pin, direction, initial=None):
+        pass
+
+    def add_event_detect(self, pin, edge, callback):
+        self.callback = callback
+
+    def remove_event_detect(self, pin):
+        self.callback = None
+
+    def input(self, pin):
+        return self.level
+
+    def output(self, pin, level):
+        if pin == TRIGGER and level == self.LOW:
+            for delay, level in self.echoes.pop(0):
+                self.clock[0] += delay
+                self.level = level
+                self.callback(ECHO)
+
+
+@pytest.fixture
+def gpio(monkeypatch):
+    clock = [100.0]
+    gpio = FakeGPIO(clock)
+    monkeypatch.setattr(ultrasonic, 'GPIO', gpio)
+    monkeypatch.setattr(ultrasonic, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(ultrasonic, 'ECHO_START_TIMEOUT', 0)  # pings without an echo give up at once
+    return gpio
+
+
+def test_ping(gpio):
+    sensor = ultrasonic.Ultrasonic(TRIGGER, ECHO, min_interval=0)
+    gpio.echoes = [[(0.001, 1), (0.002, 0)], []]
+    assert sensor.ping() == pytest.approx(34.3)
+    assert sensor.ping() is None
+
+
+def test_ping_ignores_stray_edges(gpio):
+    sensor = ultrasonic.Ultrasonic(TRIGGER, ECHO, min_interval=0)
+    gpio.echoes = [
+        [(0.0005, 0), (0.001, 1), (0.002, 0), (0.001, 1), (0.001, 0)],  # the end of an earlier echo comes first
+        [(0.001, 1), (0.005, 1), (0.002, 0)],  # the fall after the first rise was missed
+    ]
+    assert sensor.ping() == pytest.approx(34.3)
+    assert sensor.ping() == pytest.approx(34.3)
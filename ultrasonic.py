@@ -0,0 +1,179 @@
+"""HC-SR04 ultrasonic ranging that timestamps the echo pulse from GPIO edge interrupts.
+
+The echo pin is never polled: an edge-detection callback records when the pulse rises and
+falls on a monotonic clock, and ping() sleeps until both edges arrived or the pulse is longer
+than the maximum range allows.
+"""
+
+import os
+import time
+import threading
+import filters
+import hardware
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None  # only SimulatedUltrasonic works
+
+SPEED_OF_SOUND = 34300  # cm/s in air at 20C
+MAX_RANGE = 400  # cm, HC-SR04 limit
+MIN_PING_INTERVAL = 0.06  # seconds between pings so echoes of the previous ping have died out
+TRIGGER_PULSE = 0.00001  # seconds
+ECHO_START_TIMEOUT = 0.01  # seconds from trigger to the echo pulse starting
+SAMPLE_INTERVAL = 1  # seconds
+SAMPLE_WINDOW = 10  # readings kept by a Sampler
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 2
+    import ctypes
+    import ctypes.util
+
+    CLOCK_MONOTONIC = 1
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        def monotonic():
+            """Returns seconds on a clock that never goes backwards"""
+            t = _timespec()
+            if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec * 1e-9
+    except (OSError, AttributeError):
+        monotonic = time.time
+
+
+class Ultrasonic(object):
+    """HC-SR04 on BCM trigger and echo pins; the caller sets the GPIO mode and cleans up"""
+
+    def __init__(self, trigger, echo, max_range=MAX_RANGE, speed_of_sound=SPEED_OF_SOUND,
+                 min_interval=MIN_PING_INTERVAL):
+        self.trigger = trigger
+        self.echo = echo
+        self.max_range = max_range
+        self.speed_of_sound = speed_of_sound
+        self.min_interval = min_interval
+        self._rise = None
+        self._fall = None
+        self._echoed = threading.Event()
+        self._lock = threading.Lock()
+        self._last_ping = 0
+        GPIO.setup(trigger, GPIO.OUT, initial=GPIO.LOW)
+        GPIO.setup(echo, GPIO.IN)
+        GPIO.add_event_detect(echo, GPIO.BOTH, callback=self._edge)
+
+    def _edge(self, channel):
+        # the pulse is a rising edge followed by a falling one; a falling edge before any rise is
+        # the end of an earlier echo, and a second rise means the fall in between was missed
+        now = monotonic()
+        if self._echoed.is_set():
+            return
+        if GPIO.input(channel):
+            self._rise = now
+        elif self._rise is not None:
+            self._fall = now
+            self._echoed.set()
+
+    def ping(self):
+        """Returns the distance in cm, None if no echo came back from within max_range"""
+        with self._lock:
+            wait = self._last_ping + self.min_interval - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._rise = None
+            self._fall = None
+            self._echoed.clear()
+            GPIO.output(self.trigger, GPIO.HIGH)
+            time.sleep(TRIGGER_PULSE)
+            GPIO.output(self.trigger, GPIO.LOW)
+            self._last_ping = monotonic()
+            if not self._echoed.wait(ECHO_START_TIMEOUT + 2.0 * self.max_range / self.speed_of_sound):
+                return None
+            distance = (self._fall - self._rise) * self.speed_of_sound / 2
+            if distance > self.max_range:
+                return None
+            return distance
+
+    def pings(self, n):
+        """Returns the distances of n pings made back to back, leaving out pings without an echo"""
+        return [d for d in (self.ping() for _ in range(n)) if d is not None]
+
+    def close(self):
+        GPIO.remove_event_detect(self.echo)
+
+
+class SimulatedUltrasonic(Ultrasonic):
+    """HC-SR04 replaying the 'distance' trace of its trigger pin, see hardware; pings take their real time"""
+
+    def __init__(self, trigger, echo, max_range=MAX_RANGE, speed_of_sound=SPEED_OF_SOUND,
+                 min_interval=MIN_PING_INTERVAL):
+        self.trigger = trigger
+        self.echo = echo
+        self.max_range = max_range
+        self.speed_of_sound = speed_of_sound
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last_ping = 0
+        self._trace = hardware.trace('distance', trigger)
+
+    def ping(self):
+        with self._lock:
+            wait = self._last_ping + self.min_interval / hardware.speed - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_ping = monotonic()
+            recorded = self._trace.value()[0]
+            if recorded != recorded:  # nan, no echo
+                hardware.sleep(ECHO_START_TIMEOUT + 2.0 * self.max_range / self.speed_of_sound)
+                return None
+            # the echo takes as long as it did when recorded; the distance depends on the assumed speed of sound
+            echo = 2.0 * recorded / SPEED_OF_SOUND
+            hardware.sleep(echo)
+            distance = echo * self.speed_of_sound / 2
+            if distance > self.max_range:
+                return None
+            return distance
+
+    def close(self):
+        pass
+
+
+class Sampler(object):
+    """Pings a sensor every interval seconds from a background thread and keeps the last window readings"""
+
+    def __init__(self, sensor, interval=SAMPLE_INTERVAL, window=SAMPLE_WINDOW):
+        self.sensor = sensor
+        self.interval = interval
+        self._times = filters.RingBuffer(window)
+        self._distances = filters.RingBuffer(window)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ultrasonic-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            distance = self.sensor.ping()
+            if distance is not None:
+                with self._lock:
+                    self._times.append(monotonic())
+                    self._distances.append(distance)
+            self._stop.wait(self.interval)
+
+    def readings(self, max_age):
+        """Returns an array of the distances measured within the last max_age seconds"""
+        oldest = monotonic() - max_age
+        with self._lock:
+            return self._distances.window()[self._times.window() >= oldest]
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
@@ -1,51 +1,25 @@
 #!/usr/bin/env python
 
-import json
 import awsiot
+import metrics
+import encoding
 import logging
-import RPi.GPIO as GPIO
+import filters
+import hardware
 import time
 import sys
 
+SCHEMA = encoding.DISTANCE
+
 
 def pub(dist):
     if args.topic is not None and len(args.topic) > 0:
         for t in args.topic:
-            publisher.publish(t,
-                              json.dumps({"distance": dist, awsiot.MESSAGE: "distance: {}".format(dist)}))
-    publisher.publish(awsiot.iot_thing_topic(args.thing),
-                      awsiot.iot_payload(awsiot.REPORTED, {'distance': dist}))
-
-
-def get_distance():
-    # set Trigger to HIGH
-    GPIO.output(GPIO_TRIGGER, True)
-
-    # set Trigger after 0.01ms to LOW
-    time.sleep(0.00001)
-    GPIO.output(GPIO_TRIGGER, False)
-
-    start_time = time.time()
-    stop_time = time.time()
-
-    # save StartTime
-    while GPIO.input(GPIO_ECHO) == 0:
-        start_time = time.time()
+            publisher.publish_reading(t, {"distance": dist}, SCHEMA, "distance: {}".format(dist))
+    publisher.report_shadow(args.thing, {'distance': dist})
 
-    # save time of arrival
-    while GPIO.input(GPIO_ECHO) == 1:
-        stop_time = time.time()
 
-    # time difference between start and arrival
-    time_lapsed = stop_time - start_time
-    # multiply with the sonic speed (34300 cm/s)
-    # and divide by 2, because there and back
-    distance = (time_lapsed * 34300) / 2
-
-    return distance
-
-
-if __name__ == "__main__":
+def arg_parser():
     parser = awsiot.iot_arg_parser()
     parser.add_argument("--trigger_pin", help="trigger gpio pin (using BCM numbering)", type=int, required=True)
     parser.add_argument("--echo_pin", help="echo gpio pin (using BCM numbering)", type=int, required=True)
@@ -54,35 +28,77 @@ if __name__ == "__main__":
     parser.add_argument("--max_value", help="max distance", type=float, default=100.0)
     parser.add_argument("--min_value", help="min distance", type=float, default=2.0)
     parser.add_argument("--sleep_time", help="time in seconds between measurements", type=float, default=0.5)
+    parser.add_argument("--filter", help="smoothing %s" % filters.METHODS, choices=filters.METHODS,
+                        default=filters.MEDIAN)
+    parser.add_argument("--window", help="readings in the filter window", type=int, default=filters.WINDOW)
+    parser.add_argument("--temperature", help="air temperature (C) for the speed of sound", type=float)
+    parser.add_argument("--temperature_topic", help="topic with temperature readings to correct the speed of sound")
+    return parser
+
 
-    args = parser.parse_args()
+def start(a, client):
+    global args, publisher, sensor
+    args = a
+    publisher = client
 
+    hardware.configure(args)
     # GPIO Mode (BOARD / BCM)
-    GPIO.setmode(GPIO.BCM)
+    hardware.gpio_setup()
+    sensor = hardware.Ultrasonic(args.trigger_pin, args.echo_pin)
+    if args.temperature is not None:
+        sensor.speed_of_sound = filters.speed_of_sound(args.temperature)
+    if args.temperature_topic is not None:
+        # readings in a binary encoding arrive on a trailing encoding level, e.g. <topic>/$cbor
+        publisher.subscribe('{}/#'.format(args.temperature_topic), temperature_callback)
 
-    # set GPIO Pins
-    GPIO_TRIGGER = args.trigger_pin
-    GPIO_ECHO = args.echo_pin
 
-    # set GPIO direction (IN / OUT)
-    GPIO.setup(GPIO_TRIGGER, GPIO.OUT)
-    GPIO.setup(GPIO_ECHO, GPIO.IN)
+def temperature_callback(client, user_data, message):
+    try:
+        temperature = awsiot.decode_payload(message)['temperature']
+        if isinstance(temperature, list):  # batched readings
+            temperature = temperature[-1]
+        sensor.speed_of_sound = filters.speed_of_sound(float(temperature))
+        logging.debug("speed of sound {} cm/s at {} C".format(sensor.speed_of_sound, temperature))
+    except Exception as e:
+        logging.warning("temperature from {} unusable: {}".format(message.topic, e))
+
+
+def run():
+    smoother = filters.Filter(args.window, args.filter)
+    last_distance = None
+    while True:
+        with metrics.timed('distance_read_seconds'):
+            distance = sensor.ping()
+        if distance is None:
+            logging.debug("no echo")
+        else:
+            distance = smoother.update(distance)
+            if distance is None:
+                metrics.registry.increment('distance_outliers')
+            elif args.min_value <= distance <= args.max_value:
+                if last_distance is None or (abs(last_distance - distance) / last_distance) * 100.0 > args.pct_change:
+                    distance = round(distance, 1)
+                    logging.info("distance: {}".format(distance))
+                    pub(distance)
+                    last_distance = distance
+        time.sleep(args.sleep_time)  # sleep needed because CPU race
+
+
+def stop():
+    sensor.close()
+    hardware.gpio_cleanup()
+
+
+if __name__ == "__main__":
+    args = arg_parser().parse_args()
 
     logging.basicConfig(filename=awsiot.LOG_FILE, level=args.log_level, format=awsiot.LOG_FORMAT)
 
-    publisher = awsiot.MQTT(args.endpoint, args.rootCA, args.cert, args.key)
+    start(args, awsiot.mqtt_from_args(args))
 
     # Loop forever
     try:
-        last_distance = 1.0
-        while True:
-            distance = get_distance()
-            if args.min_value <= distance <= args.max_value:
-                if (abs(last_distance - distance) / last_distance) * 100.0 > args.pct_change:
-                    logging.info("distance: {}".format(distance))
-                    pub(distance)
-                    last_distance = distance
-            time.sleep(args.sleep_time)  # sleep needed because CPU race
+        run()
     except (KeyboardInterrupt, SystemExit):
-        GPIO.cleanup()
+        stop()
         sys.exit()